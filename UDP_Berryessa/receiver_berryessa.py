@@ -2,73 +2,168 @@
 # receiver_berryessa.py
 # usage: python3 receiver_berryessa.py --ip XXXX.XXXX.XXXX.XXXX
 # --port YYYY --packet_loss_percentage X
-# --round_trip_jitter Y --bdp Z --output output.txt
+# --round_trip_jitter Y --bdp Z --output output.txt [--window N] [--ack_every N --ack_delay S]
+# [--fsync never/close/BYTES] [--mmsg N] [--gro] [--mss BYTES] [--workers N] [--demux]
+# [--token_lifetime S] [--idle_timeout S]
 
 import socket
 import threading
 import argparse
+import atexit
+import heapq
+import itertools
 import zlib
-import struct
 import os
+import sys
 import time
 import random
+import select
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.ack import DelayedAck  # noqa: E402
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.gso import UDP_GRO, OffloadSocket, supported  # noqa: E402
+from udp_common.mmsg import BatchSocket, available as mmsg_available  # noqa: E402
+from udp_common.options import (COMPRESS_PERMITTED, COMPRESSED, DATAGRAM_SIZE, EARLY_DATA, FILE_SIZE, MSS,  # noqa: E402
+                                SACK, SACK_PERMITTED, SIZE, STRIPE, STRIPE_VALUE, TOKEN, ZLIB, pack_options,
+                                pack_sack, split)
+from udp_common.compression import decompress  # noqa: E402
+from udp_common.output import OutputFile, fsync_policy  # noqa: E402
+from udp_common.reassembly import ReassemblyBuffer  # noqa: E402
+from udp_common.tokens import TokenIssuer  # noqa: E402
+from udp_common.trace import TraceWriter  # noqa: E402
+from udp_common.workers import available as workers_available, run_workers, welcome_socket  # noqa: E402
+from udp_common.codec import Header, BERRYESSA  # noqa: E402
+
 
 def timestamp():
     timestamp = time.time()
     return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S%f')
 
 
-def file_logging(msg):
-    write_file = open(log_file_path, 'a')
-    write_file.write(msg + '\n')
-    write_file.close()
-    # print(msg)
-
-
 class ClientThread(threading.Thread):
-    def __init__(self, clientaddress, clientsocket, seq):
+    def __init__(self, clientaddress, clientsocket, seq, sack, size=None, mss=None, stripe=None, early=None):
         threading.Thread.__init__(self)
         self.csocket = clientsocket
         self.caddress = clientaddress
         self.seq = seq
+        self.sack = sack  # SACK blocks per ACK agreed on in the handshake, 0 if not in use
+        self.size = size  # file size the sender advertised, None if it did not
+        self.mss = mss or BUFFER_SIZE  # the largest datagram agreed on in the handshake
+        self.stripe = stripe  # (transfer id, offset, file size) of one stream of a striped transfer
+        self.early = early  # the data of a 0-RTT SYN, None after a full handshake
         print("New connection added: ", clientaddress)
 
     def run(self):
         try:
             print("Connection from : ", self.caddress)
-            os.makedirs(os.path.abspath(os.path.join('.', 'out_files', str(self.caddress[1])
-                                                     )), exist_ok=True)
-            output_file = os.path.abspath(os.path.join('.', 'out_files', str(self.caddress[1]
-                                                                             ), args.output))
-            download = []  # list holds the total of downloaded binary data
-            while self.csocket:
-                try:
-                    data, self.seq = listen(self.csocket, listen_seq=self.seq)
-                    download.append((self.seq, data))
-                except:
-                    break
-
-            sorted_data = sorted(download)
-            print(F"Writing output file: {output_file}")
-            with open(output_file, 'ab') as f:
-                for item in sorted_data:
-                    f.write(item[1])
+            # every segment is written in place as it arrives, reassembly only tracks the gaps
+            reassembly = ReassemblyBuffer(self.seq, max(1, args.window) * (self.mss - HEADER_SIZE))
+            # room in the socket for a window of the largest segments, the kernel caps it at rmem_max
+            self.csocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, max(1, args.window) * self.mss)
+            delayed = DelayedAck(args.ack_every, args.ack_delay)
+            output = open_output(self.caddress, self.seq, self.size, self.stripe)
+            if self.early:
+                reassembly.track(self.seq, len(self.early))
+                output.write(self.seq, self.early)
+            # receive segments and send ACKs in batches, one syscall each
+            batch = BatchSocket(self.csocket, args.mmsg, self.mss) if args.mmsg and mmsg_available() else None
+            # or take whole runs of segments the kernel coalesced
+            if args.gro and supported(self.csocket, UDP_GRO):
+                batch = OffloadSocket(self.csocket, gro=True, slot=self.mss)
+            try:
+                while self.csocket:
+                    try:
+                        listen(self.csocket, reassembly, output, self.sack, delayed, batch, self.mss)
+                    except:
+                        break
+            finally:
+                output.close()
         finally:
             print("Client at ", self.caddress, " disconnected...")
+            resumed.pop(self.caddress, None)
             self.csocket.close()
 
 
+class Connection:
+    # One client under --demux. Its datagrams arrive on the listening socket like everyone
+    # else's and demux() hands them to datagram(), handshake, data and FIN alike, so a client
+    # costs an entry in `connections` instead of a socket, a port and a thread.
+    def __init__(self, sock, address, conn_id, syn_header, syn_options, resumed=False):
+        self.sock = sock  # the listening socket, every reply goes out of it to `address`
+        self.address = address  # the client's (ip, port)
+        self.conn_id = conn_id  # sent as the port of the ACK/SYN, the client's receiver port from then on
+        self.syn_seq = syn_header.seq
+        self.sack, self.size, mss, self.stripe, self.trailer = negotiate(syn_options, address, resumed)
+        self.mss = mss or BUFFER_SIZE
+        # data starts right after the SYN and the final handshake ACK
+        self.reassembly = ReassemblyBuffer((self.syn_seq + 2) & SEQ_MASK,
+                                           max(1, args.window) * (self.mss - HEADER_SIZE))
+        self.delayed = DelayedAck(args.ack_every, args.ack_delay)
+        self.output = None
+        self.last_seen = time.monotonic()  # when the client last sent anything
+
+    # answer the SYN, again if the client repeats it
+    def accept_handshake(self):
+        data = ''.encode()
+        accept_handshake_header_p, accept_handshake_header = header(self.conn_id, self.address[1], data,
+                                                                    self.syn_seq, ack_seq=self.syn_seq + 1,
+                                                                    ack=True, syn=True, trailer=self.trailer)
+        send(self.sock, accept_handshake_header_p + data + self.trailer, self.address)
+
+    def establish(self):
+        if handshakes.get(self.address) is self:
+            del handshakes[self.address]
+        if self.output:
+            return
+        print(f"Connection established with {self.address}")
+        self.output = open_output(self.address, self.reassembly.expected, self.size, self.stripe)
+
+    # take the data of a 0-RTT SYN, the connection is open without the handshake ACK but stays
+    # in `handshakes` until the client sends more, in case it repeats the SYN
+    def resume(self, data):
+        print(f"Connection resumed with {self.address}")
+        self.output = open_output(self.address, self.reassembly.expected, self.size, self.stripe)
+        if data:
+            seq = self.reassembly.expected
+            self.reassembly.track(seq, len(data))
+            self.output.write(seq, data)
+
+    # handle one datagram from the client, returns False once the connection is closed
+    def datagram(self, r_header, r_data):
+        # the first data segment also completes the handshake if its ACK went missing
+        self.establish()
+        if r_header.win == HEADER_SIZE and not r_header.fin:  # the handshake ACK, or a repeat of it
+            return True
+        if r_header.fin and r_header.checksum == checksum_calc(r_data):
+            print(f"Disconnecting from: {self.address}")
+            finish(self.sock, self.address, self.conn_id)
+            return False
+        on_segment(self.sock, r_header, r_data, self.reassembly, self.output, self.sack, self.delayed,
+                   address=self.address)
+        return True
+
+    # the ACK delay ran out before enough segments arrived
+    def flush_ack(self):
+        rec_port, send_port, seq = self.delayed.pending
+        self.delayed.clear()
+        acknowledge(self.sock, self.reassembly, rec_port, send_port, seq, self.sack, address=self.address)
+
+    def close(self):
+        if handshakes.get(self.address) is self:
+            del handshakes[self.address]
+        if self.output:
+            self.output.close()
+        print("Client at ", self.address, " disconnected...")
+
+
 # header size
-HEADER_SIZE = 31
+HEADER_SIZE = BERRYESSA.size
 
 # signal to kill threads, or not, depending on their behavior
 kill_threads = threading.Event()
 
-log_file = f"receiver_berryessa_{timestamp()}.log"
-log_file_path = os.path.abspath(os.path.join('.', log_file))
-
 # create argument parser
 parser = argparse.ArgumentParser()
 
@@ -90,6 +185,45 @@ parser.add_argument('-o', '--output', type=str, required=True)
 # add the required bdp argument
 parser.add_argument('-b', '--bdp', type=int, default=20000)
 
+# add the window argument, the number of segments buffered ahead of a gap
+parser.add_argument('-w', '--window', type=int, default=64)
+
+# add the ack_every argument, ACK every Nth in order segment (1 = every segment)
+parser.add_argument('--ack_every', type=int, default=1)
+
+# add the ack_delay argument, the longest an ACK is held back in seconds
+parser.add_argument('--ack_delay', type=float, default=0.001)
+
+# add the sack argument, the most SACK blocks sent per ACK, 0 turns SACK off
+parser.add_argument('--sack', type=int, default=4)
+
+# add the fsync argument, when the output is flushed to disk: never, close or every BYTES written
+parser.add_argument('--fsync', type=fsync_policy, default='close')
+
+# add the mmsg argument, datagrams per recvmmsg/sendmmsg batch (Linux only), 0 sends one at a time
+parser.add_argument('--mmsg', type=int, default=0)
+
+# add the gro argument, receive runs of segments coalesced by the kernel (Linux UDP GRO)
+parser.add_argument('--gro', action='store_true')
+
+# add the mss argument, the largest datagram this side takes, header included
+parser.add_argument('--mss', type=int, default=65507)
+
+# record packets in a binary trace instead of the text log
+parser.add_argument('--trace', action='store_true')
+
+# add the workers argument, processes sharing the port with SO_REUSEPORT, each owns its connections
+parser.add_argument('--workers', type=int, default=1)
+
+# add the demux argument, serve every connection from the listening socket on one thread
+parser.add_argument('--demux', action='store_true')
+
+# add the token_lifetime argument, seconds a resumption token is good for, 0 turns 0-RTT off
+parser.add_argument('--token_lifetime', type=int, default=600)
+
+# add the idle_timeout argument, seconds a --demux connection may stay silent before it is dropped, 0 keeps it
+parser.add_argument('--idle_timeout', type=float, default=60)
+
 # parse the arguments
 args = parser.parse_args()
 
@@ -108,14 +242,41 @@ packet_loss = args.packet_loss_percentage
 # the bdp, bandwidth-delay product
 bdp = args.bdp
 
+
+def open_logs(name=''):
+    global logger, tracer
+    log_file = f"receiver_berryessa_{timestamp()}{name}.log"
+    log_file_path = os.path.abspath(os.path.join('.', log_file))
+    trace_file = f"receiver_berryessa_{timestamp()}{name}.trace"
+    trace_file_path = os.path.abspath(os.path.join('.', trace_file))
+    logger = None
+    tracer = None
+    if args.trace:
+        tracer = TraceWriter(trace_file_path, HEADER_SIZE)
+        atexit.register(tracer.close)
+    else:
+        logger = AsyncLogger(log_file_path, time_format='%Y%m%d%H%M%S%f')
+
+
+# a worker process exits without running atexit, so it closes its logs itself
+def close_logs():
+    for log in (logger, tracer):
+        if log:
+            log.close()
+
+
+# the parent of --workers only forks, every worker opens logs of its own
+WORKERS = args.workers if args.workers > 1 and workers_available() else 1
+if args.workers > 1 and WORKERS == 1:
+    print("--workers needs SO_REUSEPORT and fork, serving from one process")
+if WORKERS == 1:
+    open_logs()
+
 # receive 16 bytes each time
 BUFFER_SIZE = 1000
 
-# create socket to listen on
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-# bind the socket to the SERVER_HOST and SERVER_PORT
-s.bind((host, port))
+# the largest datagram answered in the ACK/SYN, a connection uses the smaller of both sides' sizes
+MSS_OFFER = max(HEADER_SIZE + 1, min(args.mss, 65507))
 
 SEQ = 0
 
@@ -145,55 +306,305 @@ def checksum_calc(data):
     return checksum
 
 
-def accept(sock, tcp=None):
-    r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
-    tcp_port = 0
+# handshakes that got their ACK/SYN and wait for the client's ACK, keyed by the client's (ip, port),
+# so clients that connect at the same time (the streams of a striped transfer) do not mix
+pending = {}
+
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+
+# 0-RTT connections by the client's (ip, port): the SYN's seq, the connection socket and the
+# ACK/SYN, so a repeated SYN is answered again instead of being taken for a replay
+resumed = {}
+
+# issues and redeems resumption tokens, every worker has its own, None with --token_lifetime 0
+tokens = None
+
+
+# what a SYN's options settle: SACK blocks per ACK, file size, datagram size, stripe, and the
+# options trailer of the ACK/SYN that answers them, `resumed` when the SYN's data was taken
+def negotiate(syn_options, address=None, resumed=False):
+    # use SACK if the client offers it, with the smaller of the two block counts
+    sack = 0
+    if SACK_PERMITTED in syn_options and args.sack > 0:
+        sack = min(args.sack, syn_options[SACK_PERMITTED][0])
+    options = [(SACK_PERMITTED, bytes([sack]))] if sack else []
+    size = None
+    if FILE_SIZE in syn_options:
+        size, = SIZE.unpack(syn_options[FILE_SIZE])
+    # a client that does not offer its datagram size sends the usual one
+    mss = None
+    if MSS in syn_options:
+        mss = min(MSS_OFFER, DATAGRAM_SIZE.unpack(syn_options[MSS])[0])
+        options.append((MSS, DATAGRAM_SIZE.pack(MSS_OFFER)))
+    if syn_options.get(COMPRESS_PERMITTED) == bytes([ZLIB]):  # the client may send compressed segments
+        options.append((COMPRESS_PERMITTED, bytes([ZLIB])))
+    # one stream of a striped transfer, echoed so the client knows it lands in place
+    stripe = None
+    if STRIPE in syn_options:
+        stripe = STRIPE_VALUE.unpack(syn_options[STRIPE])
+        options.append((STRIPE, syn_options[STRIPE]))
+    # a new token for the client's next connection, whether it used one this time or not
+    if TOKEN in syn_options and tokens:
+        options.append((TOKEN, tokens.issue(address[0])))
+    if resumed:
+        options.append((EARLY_DATA, b''))
+    return sack, size, mss, stripe, pack_options(options)
+
+
+# whether the SYN's data is taken right away (0-RTT): it arrived intact and its token is good,
+# anything else, a replayed token included, gets the full handshake
+def redeem(r_header, r_data, syn_options, address):
+    if not tokens or not syn_options.get(TOKEN) or r_header.checksum != checksum_calc(r_data):
+        return False
+    return tokens.redeem(syn_options[TOKEN], address[0])
+
+
+# the output file of a connection, opened once its handshake is done
+def open_output(address, base, size=None, stripe=None):
+    # the streams of a striped transfer share one file, named after the transfer
+    directory = f"{stripe[0]:016x}" if stripe else str(address[1])
+    os.makedirs(os.path.abspath(os.path.join('.', 'out_files', directory)), exist_ok=True)
+    output_file = os.path.abspath(os.path.join('.', 'out_files', directory, args.output))
+    print(F"Writing output file: {output_file}")
+    if stripe:  # this stream's bytes go to their own place in the file
+        return OutputFile(output_file, base, stripe[2], args.fsync, stripe[1], shared=True)
+    return OutputFile(output_file, base, size, args.fsync)
+
+
+def accept(sock):
+    while True:
+        readable, _, _ = select.select([sock] + [waiting[0] for waiting in pending.values()], [], [])
+        for address, (tcp, syn_seq, sack, size, mss, stripe) in list(pending.items()):
+            if tcp in readable:  # data arrived before the ACK, the ACK went missing
+                print(f"Connection established with {address}")
+                del pending[address]
+                tcp.connect(address)
+                # data starts right after the SYN and the final handshake ACK
+                return tcp, address, (syn_seq + 2) & SEQ_MASK, sack, size, mss, stripe, None
+        if sock not in readable:
+            continue
+        # the emulated loss reads again after a drop, that must not block the other handshakes
+        sock.setblocking(False)
+        try:
+            # a SYN may carry a whole segment
+            r_header, r_data, r_address = receive(sock, buffer=MSS_OFFER)
+        except BlockingIOError:
+            continue
+        tcp_port = 0
+        data = ''.encode()
+        address = (r_address[0], r_header.sport)
+        if r_header.syn and not r_header.ack and not r_header.fin and address in resumed:
+            syn_seq, tcp_sock, accept_handshake = resumed[address]
+            if r_header.seq == syn_seq:  # the ACK/SYN of a 0-RTT connection went missing, send it again
+                try:
+                    send(tcp_sock, accept_handshake, address)
+                except OSError:  # the connection is over already
+                    pass
+                continue
+        if r_header.syn and not r_header.ack and not r_header.fin:  # initial welcome handshake received
+            payload = r_data
+            r_data, syn_options = split(r_data, r_header.win - HEADER_SIZE)
+            early = r_data if redeem(r_header, payload, syn_options, address) else None
+            sack, size, mss, stripe, trailer = negotiate(syn_options, address, early is not None)
+            if address in pending:  # the client repeated its SYN, answer from the socket that is already waiting
+                tcp_sock = pending[address][0]
+            else:
+                tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                tcp_sock.bind((host, tcp_port))
+                print(f"binding listener to {host}:{tcp_sock.getsockname()[1]}")
+            pending[address] = (tcp_sock, r_header.seq, sack, size, mss, stripe)
+            accept_handshake_header_p, accept_handshake_header = header(tcp_sock.getsockname()[1],
+                                                                        r_address[1], data, r_header.seq,
+                                                                        ack_seq=r_header.seq + 1, ack=True, syn=True,
+                                                                        trailer=trailer)
+            # the ACK/SYN already comes from the connection socket the client will talk to
+            send(tcp_sock, accept_handshake_header_p + data + trailer, address)
+            if early is not None:  # open already, the client sends no handshake ACK
+                print(f"Connection resumed with {address}")
+                del pending[address]
+                resumed[address] = (r_header.seq, tcp_sock, accept_handshake_header_p + data + trailer)
+                tcp_sock.connect(address)
+                return tcp_sock, address, (r_header.seq + 2) & SEQ_MASK, sack, size, mss, stripe, early
+        elif not r_header.syn and r_header.ack and not r_header.fin and address in pending:
+            print(f"Connection established with {address}")
+            tcp, syn_seq, sack, size, mss, stripe = pending.pop(address)
+            # data, ACK and FIN traffic of this connection all go through the connected socket
+            tcp.connect(address)
+            return tcp, address, r_header.ack_seq, sack, size, mss, stripe, None
+        else:
+            print("did not receive handshake")
+
+
+# connections under --demux by the client's (ip, port) and the id handed out in the ACK/SYN, which
+# the client puts in the receiver port of everything it sends after its SYN
+connections = {}
+
+# the same connections by the client's (ip, port) until their handshake is done
+handshakes = {}
+
+# the last connection id handed out
+last_id = 0
+
+# replies the emulated jitter holds back under --demux, a heap of (due, order, socket, packet, address)
+# the one thread serving every connection sends them once they are due instead of sleeping
+held = []
+held_order = itertools.count()
+
+
+# a connection id for a client, never the listening port so a SYN is told apart from the rest
+def connection_id(address):
+    global last_id
+    while True:
+        last_id = last_id % 0xFFFF + 1
+        if last_id != port and (*address, last_id) not in connections:
+            return last_id
+
+
+# answer a FIN with the FIN/ACK and forget the connection, no need to wait for a response
+def finish(sock, address, conn_id):
     data = ''.encode()
-    if r_header[7] and not r_header[6] and not r_header[8]:  # initial welcome handshake received
-        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        tcp_sock.bind((host, tcp_port))
-        print(f"binding listener to {host}:{tcp_sock.getsockname()[1]}")
-        accept_handshake_header_p, accept_handshake_header = header(tcp_sock.getsockname()[1],
-                                                                    r_address[1], data, r_header[4],
-                                                                    ack_seq=r_header[4] + 1, ack=True, syn=True)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            send(s, accept_handshake_header_p + data, (r_address[0], r_header[0]))
-        return accept(sock, tcp_sock)
-    elif not r_header[7] and r_header[6] and not r_header[8]:
-        print(f"Connection established with {(r_address[0], r_header[0])}")
-        return tcp, (r_address[0], r_header[0]), r_header[5]
-    else:
-        print("did not receive handshake")
-
-
-def listen(sock, listen_seq=0):
-    r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
-    send_port = r_header[0]
-    rec_port = r_header[1]
-    win = r_header[2]
-    checksum = r_header[3]
-    seq = r_header[4]
-    ack_seq = r_header[5]
-    ack = r_header[6]
-    syn = r_header[7]
-    fin = r_header[8]
+    close_header_p, close_header = header(conn_id, address[1], data, 0, ack=True, fin=True)
+    send(sock, close_header_p + data, address)
+
+
+# serve every connection from the listening socket: look each datagram up in `connections` and
+# hand it over, and send the ACKs that were held back once they are due
+def demux(sock):
+    # room for a window of the largest segments, the kernel caps it at rmem_max
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, max(1, args.window) * MSS_OFFER)
+    delaying = set()  # connections holding back an ACK
+    # idle connections are looked for a few times per --idle_timeout
+    sweep_every = args.idle_timeout / 4 if args.idle_timeout > 0 else None
+    next_sweep = time.monotonic() + sweep_every if sweep_every else None
+    try:
+        while True:
+            now = time.monotonic()
+            while held and held[0][0] <= now:
+                due, order, s, packet, address = heapq.heappop(held)
+                put(s, packet, address)
+            for connection in list(delaying):
+                if connection.delayed.timeout() == 0:
+                    delaying.discard(connection)
+                    connection.flush_ack()
+            if next_sweep is not None and now >= next_sweep:
+                forget_idle(now, delaying)
+                next_sweep = now + sweep_every
+            timeouts = [connection.delayed.timeout() for connection in delaying]
+            if held:
+                timeouts.append(held[0][0] - now)
+            if connections and next_sweep is not None:
+                timeouts.append(next_sweep - now)
+            timeout = min(timeouts, default=None)
+            sock.settimeout(None if timeout is None else max(timeout, 0.0001))
+            try:
+                r_header, r_data, r_address = receive(sock, buffer=MSS_OFFER)
+            except socket.timeout:
+                continue
+            address = (r_address[0], r_header.sport)
+            if r_header.syn and not r_header.ack and not r_header.fin:  # initial welcome handshake received
+                connection = handshakes.get(address)
+                if connection is None:  # not a repeated SYN
+                    payload = r_data
+                    r_data, syn_options = split(r_data, r_header.win - HEADER_SIZE)
+                    taken = redeem(r_header, payload, syn_options, address)
+                    connection = Connection(sock, address, connection_id(address), r_header, syn_options, taken)
+                    connections[(*address, connection.conn_id)] = handshakes[address] = connection
+                    if taken:
+                        connection.resume(r_data)
+                connection.last_seen = time.monotonic()
+                connection.accept_handshake()
+                continue
+            connection = connections.get((*address, r_header.rport))
+            if connection is not None:
+                connection.last_seen = time.monotonic()
+            if connection is None and r_header.fin:  # its FIN/ACK went missing, the connection is gone
+                finish(sock, address, r_header.rport)
+            elif connection is None:
+                print("did not receive handshake")
+            elif not connection.datagram(r_header, r_data):
+                del connections[(*address, connection.conn_id)]
+                delaying.discard(connection)
+                connection.close()
+            elif connection.delayed.pending:
+                delaying.add(connection)
+            else:
+                delaying.discard(connection)
+    finally:
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+
+
+# drop the connections under --demux whose client sent nothing for --idle_timeout seconds, a
+# half-open handshake or a client that went away without a FIN, and close their output
+def forget_idle(now, delaying):
+    for key, connection in list(connections.items()):
+        if now - connection.last_seen > args.idle_timeout:
+            print(f"{connection.address} silent for {args.idle_timeout} seconds, dropping the connection")
+            del connections[key]
+            delaying.discard(connection)
+            connection.close()
+
+
+def listen(sock, reassembly, output, sack=0, delayed=None, batch=None, mss=BUFFER_SIZE):
+    # wake up in time to send an ACK that was held back
+    timeout = delayed.timeout() if delayed else None
+    sock.settimeout(None if timeout is None else max(timeout, 0.0001))
+    try:
+        r_header, r_data, r_address = receive(sock, buffer=mss, batch=batch)
+    except socket.timeout:
+        rec_port, send_port, seq = delayed.pending
+        delayed.clear()
+        acknowledge(sock, reassembly, rec_port, send_port, seq, sack, batch)
+        return
+    if r_header.fin and r_header.checksum == checksum_calc(r_data):
+        if batch:  # the last ACKs go out before the FIN's
+            batch.flush()
+        close(sock, (r_address[0], r_header.sport), ack=True)
+        return
+    on_segment(sock, r_header, r_data, reassembly, output, sack, delayed, batch)
+
+
+# write a data segment and ACK it, or ask for it again if it arrived corrupted
+# `address` is the client's when `sock` is the listening socket of --demux
+def on_segment(sock, r_header, r_data, reassembly, output, sack=0, delayed=None, batch=None, address=None):
+    send_port = r_header.sport
+    rec_port = r_header.rport
+    checksum = r_header.checksum
+    seq = r_header.seq
     rec_checksum = checksum_calc(r_data)
     # print(f"checksum: {checksum} \nrec_checksum: {rec_checksum}")
     if checksum == rec_checksum:  # data received, not corrupted
-        if fin:
-            close(sock, (r_address[0], send_port), ack=True)
-        elif ack and ack_seq != listen_seq:
-            data = ''.encode()
-            reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=listen_seq + win, ack=True)
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                send(s, reply_header_p + data, (r_address[0], send_port))
-        return r_data, listen_seq + win
+        r_data, r_options = split(r_data, r_header.win - HEADER_SIZE)
+        if COMPRESSED in r_options:  # the checksum covered the compressed bytes
+            r_data = decompress(r_data, DATAGRAM_SIZE.unpack(r_options[COMPRESSED])[0])
+        new, ready = reassembly.track(seq, len(r_data))
+        if new:
+            output.write(seq, r_data)
+        # a segment out of order, or one that closed a gap, is ACKed right away
+        in_order = ready == 1 and not reassembly.segments
+        if delayed is None or delayed.on_segment(in_order, (rec_port, send_port, seq)):
+            acknowledge(sock, reassembly, rec_port, send_port, seq, sack, batch, address)
     else:  # data received is corrupted, request the message again
         print("data corrupted or not received")
+        if delayed:  # the request carries the cumulative ACK as well
+            delayed.clear()
         data = ''.encode()
-        reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=listen_seq, ack=True)
-        send(sock, reply_header_p + data, (r_address[0], send_port))
-        return data, listen_seq
+        reply_header_p, reply_header = header(rec_port, send_port, data, reassembly.expected,
+                                              ack_seq=reassembly.expected, ack=True)
+        send(sock, reply_header_p + data, address, batch=batch)
+
+
+def acknowledge(sock, reassembly, rec_port, send_port, seq, sack=0, batch=None, address=None):
+    # ack_seq is the next byte expected, seq names the segment this ACK answers
+    data = ''.encode()
+    # SACK blocks tell the sender which segments past a gap already arrived
+    blocks = reassembly.sack_blocks(sack) if sack else []
+    trailer = pack_options([(SACK, pack_sack(blocks))]) if blocks else b''
+    reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=reassembly.expected, ack=True,
+                                          trailer=trailer)
+    send(sock, reply_header_p + data + trailer, address, batch=batch)
 
 
 def close(sock, address, tries=0, ack=False):
@@ -204,17 +615,16 @@ def close(sock, address, tries=0, ack=False):
             data = ''.encode()
             close_header_p, close_header = header(sock.getsockname()[1], address[1], data,
                                                   0, ack=ack, fin=True)
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                send(s, close_header_p + data, address)
+            send(sock, close_header_p + data)
             if ack:
                 # sent acknowledgment, no need to wait for response
-                s.close()
+                sock.close()
             else:
                 try:
                     r_header, r_data, r_address = receive(sock)
-                    if r_header[6] and r_header[8]:
+                    if r_header.ack and r_header.fin:
                         print("Client responded to disconnect.")
-                        s.close()
+                        sock.close()
                     else:
                         close(sock, address, tries + 1)
                 except:
@@ -223,70 +633,115 @@ def close(sock, address, tries=0, ack=False):
             sock.close()
 
 
-def send(s, packet, address):
+# send on a connected socket, or to address while the handshake is still in progress
+# `batch` queues the packet for the connection's next sendmmsg instead
+def send(s, packet, address=None, batch=None):
     sleepy_time = round_trip_jitter()
+    if sleepy_time and args.demux:  # one thread serves every connection, hold the reply instead of sleeping
+        heapq.heappush(held, (time.monotonic() + sleepy_time, next(held_order), s, packet, address))
+        return
     time.sleep(sleepy_time)  # sleep the receiver for the value of round trip jitter in seconds
-    s.sendto(packet, address)
-    header = packet[:HEADER_SIZE]
-    header = unpack_header(header)
-    file_logging(f"{header[0]} | {header[1]} | {msg_type(header)} | {header[2]} | {header[9]} | {timestamp()}")
+    put(s, packet, address, batch)
+
+
+# send a reply right away
+def put(s, packet, address=None, batch=None):
+    if batch:
+        batch.send(packet)
+    elif address:
+        s.sendto(packet, address)
+    else:
+        s.send(packet)
+    header = BERRYESSA.unpack(packet)
+    log_packet(header)
 
 
-def receive(rec_sock, buffer=BUFFER_SIZE):
+def receive(rec_sock, buffer=BUFFER_SIZE, batch=None):
     global CONGESTION
-    r, r_address = rec_sock.recvfrom(buffer)
-    r_header = r[:HEADER_SIZE]
-    r_header = unpack_header(r_header)
-    if r_header[9] > args.bdp:  # trigger congestion window
+    if batch:
+        r, r_address = batch.recv(rec_sock.gettimeout())
+    else:
+        r, r_address = rec_sock.recvfrom(buffer)
+    r_header, data = BERRYESSA.decode(r)
+    if r_header.bdp > args.bdp:  # trigger congestion window
         CONGESTION = CONGESTION * 3
     else:  # congestion slowed, return to normal
         CONGESTION = 1
-    data = r[HEADER_SIZE:]
     if not ploss():  # if there is no packet loss continue
-        file_logging(f"{r_header[0]} | {r_header[1]} | {msg_type(r_header)} | {r_header[2]} | {r_header[9]} | {timestamp()}")
+        log_packet(r_header)
         return r_header, data, r_address
     else:  # there was packet loss, pretend like we did not receive the package, act cool, act normal
-        return receive(rec_sock, buffer)
+        return receive(rec_sock, buffer, batch)
 
 
-def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False, bdp=args.bdp):
-    # create the header ('struct format', 'sender port', 'receiver port', 'win',
+def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False, bdp=args.bdp,
+           trailer=b''):
+    # create the header ('sender port', 'receiver port', 'win',
     # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin', 'bdp')
+    # the options trailer is sent after the data, outside of win but covered by the checksum
     win = len(data) + HEADER_SIZE
-    checksum = checksum_calc(data)
+    checksum = checksum_calc(data + trailer)
     if ack_seq == 0:
         ack_seq = seq
-    header_packed = struct.pack("!IIIIII???I", sender_port, receiver_port, win, checksum, seq,
-                                ack_seq, ack, syn, fin, bdp)
-    return header_packed, unpack_header(header_packed)
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin, bdp)
+    return BERRYESSA.pack(fields), fields
 
 
-def unpack_header(header):
-    return struct.unpack("!IIIIII???I", header)
+# write a sent or received header to the packet trace or the text log
+def log_packet(header):
+    if tracer:
+        tracer.record(header.sport, header.rport, header.win, header.bdp, header.seq, header.ack_seq, header.ack, header.syn,
+                      header.fin)
+    else:
+        logger.log(header.sport, header.rport, msg_type(header), header.win, header.bdp)
 
 
 def msg_type(header):
-    if header[2] > HEADER_SIZE:
+    if header.win > HEADER_SIZE:
         return "DATA"
-    elif header[6] and header[7]:
+    elif header.ack and header.syn:
         return "ACK/SYN"
-    elif header[6]:
+    elif header.ack:
         return "ACK"
-    elif header[7]:
+    elif header.syn:
         return "SYN"
-    elif header[8]:
+    elif header.fin:
         return "FIN"
 
 
-try:
-    while True:
-        print("Listening as " + host + ":" + str(port))
-        client_socket, address, seq = accept(s)
-        ClientThread(address, client_socket, seq).start()
-except KeyboardInterrupt:
-    print("Keyboard Interrupt, closing server.")
-    kill_threads.set()
-
-
-# close the server socket
-s.close()
+# accept connections until interrupted, `index` is the worker's number under --workers
+def serve(index=None):
+    global tokens
+    if index is not None:
+        open_logs(f"_worker{index}")
+    # made after the fork, a token is only good at the worker that knows whether it was used
+    tokens = TokenIssuer(args.token_lifetime) if args.token_lifetime > 0 else None
+    # create socket to listen on, bound to the SERVER_HOST and SERVER_PORT
+    s = welcome_socket(host, port, reuse_port=index is not None)
+    listening = "Listening as " + host + ":" + str(port) + ("" if index is None else f" (worker {index})")
+    try:
+        if args.demux:  # runs until interrupted
+            print(listening)
+            demux(s)
+        while True:
+            print(listening)
+            client_socket, address, seq, sack, size, mss, stripe, early = accept(s)
+            ClientThread(address, client_socket, seq, sack, size, mss, stripe, early).start()
+    except KeyboardInterrupt:
+        print("Keyboard Interrupt, closing server.")
+        kill_threads.set()
+
+    # close the server socket
+    s.close()
+    if index is not None:  # a worker does not wait for its threads on exit
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join()
+        close_logs()
+
+
+if WORKERS > 1:
+    run_workers(WORKERS, serve)
+else:
+    serve()
@@ -0,0 +1,432 @@
+#! python3
+# receiver_berryessa_async.py
+# usage: python3 receiver_berryessa_async.py --ip XXXX.XXXX.XXXX.XXXX
+# --port YYYY --packet_loss_percentage X
+# --round_trip_jitter Y --bdp Z --output output.txt [--window N] [--ack_every N --ack_delay S]
+# [--fsync never/close/BYTES] [--mss BYTES] [--idle_timeout S]
+#
+# asyncio version of receiver_berryessa.py, every connection is a coroutine
+# on one event loop instead of a thread blocking on its own socket
+
+import asyncio
+import argparse
+import socket
+import atexit
+import zlib
+import os
+import sys
+import time
+import random
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.ack import DelayedAck  # noqa: E402
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.options import (COMPRESS_PERMITTED, COMPRESSED, DATAGRAM_SIZE, FILE_SIZE, MSS, SACK,  # noqa: E402
+                                SACK_PERMITTED, SIZE, STRIPE, STRIPE_VALUE, ZLIB, pack_options, pack_sack, split)
+from udp_common.compression import decompress  # noqa: E402
+from udp_common.output import OutputFile, fsync_policy  # noqa: E402
+from udp_common.reassembly import ReassemblyBuffer  # noqa: E402
+from udp_common.trace import TraceWriter  # noqa: E402
+from udp_common.codec import Header, BERRYESSA  # noqa: E402
+
+
+def timestamp():
+    timestamp = time.time()
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S%f')
+
+
+# header size
+HEADER_SIZE = BERRYESSA.size
+
+log_file = f"receiver_berryessa_{timestamp()}.log"
+log_file_path = os.path.abspath(os.path.join('.', log_file))
+trace_file = f"receiver_berryessa_{timestamp()}.trace"
+trace_file_path = os.path.abspath(os.path.join('.', trace_file))
+
+# create argument parser
+parser = argparse.ArgumentParser()
+
+# add required server_ip argument
+parser.add_argument('-s', '--ip', type=str, required=True)
+
+# add the required server_port argument
+parser.add_argument('-p', '--port', type=int, required=True)
+
+# add the required packet_loss_percentage argument
+parser.add_argument('-l', '--packet_loss_percentage', type=int, default=10)
+
+# add the required round_trip_jitter argument
+parser.add_argument('-j', '--round_trip_jitter', type=float, default=0.5)
+
+# add the required output argument
+parser.add_argument('-o', '--output', type=str, required=True)
+
+# add the required bdp argument
+parser.add_argument('-b', '--bdp', type=int, default=20000)
+
+# add the window argument, the number of segments buffered ahead of a gap
+parser.add_argument('-w', '--window', type=int, default=64)
+
+# add the ack_every argument, ACK every Nth in order segment (1 = every segment)
+parser.add_argument('--ack_every', type=int, default=1)
+
+# add the ack_delay argument, the longest an ACK is held back in seconds
+parser.add_argument('--ack_delay', type=float, default=0.001)
+
+# add the sack argument, the most SACK blocks sent per ACK, 0 turns SACK off
+parser.add_argument('--sack', type=int, default=4)
+
+# add the fsync argument, when the output is flushed to disk: never, close or every BYTES written
+parser.add_argument('--fsync', type=fsync_policy, default='close')
+
+# add the mss argument, the largest datagram this side takes, header included
+parser.add_argument('--mss', type=int, default=65507)
+
+# record packets in a binary trace instead of the text log
+parser.add_argument('--trace', action='store_true')
+
+# add the idle_timeout argument, seconds a connection may stay silent before it is dropped, 0 keeps it
+parser.add_argument('--idle_timeout', type=float, default=60)
+
+# parse the arguments
+args = parser.parse_args()
+
+# ip address or hostname of the hose
+host = args.ip
+
+# port the host is listening for connections on
+port = args.port
+
+# the amount of round trip jitter
+jitter = args.round_trip_jitter
+
+# the packet loss percentage
+packet_loss = args.packet_loss_percentage
+
+# the bdp, bandwidth-delay product
+bdp = args.bdp
+
+logger = None
+tracer = None
+if args.trace:
+    tracer = TraceWriter(trace_file_path, HEADER_SIZE)
+    atexit.register(tracer.close)
+else:
+    logger = AsyncLogger(log_file_path, time_format='%Y%m%d%H%M%S%f')
+
+# receive 16 bytes each time
+BUFFER_SIZE = 1000
+
+# the largest datagram answered in the ACK/SYN, a connection uses the smaller of both sides' sizes
+MSS_OFFER = max(HEADER_SIZE + 1, min(args.mss, 65507))
+
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+
+# used to simulate a congestion state
+CONGESTION = 1
+
+# connections from their SYN until they close, keyed by the client's (ip, port), so a late
+# duplicate SYN finds its connection instead of opening a second one
+connections = {}
+
+
+def ploss():
+    p = random.randrange(0, 100)
+    if p <= packet_loss * CONGESTION:
+        print("packet lost")
+        return True
+
+
+def round_trip_jitter():
+    j = random.uniform(0, 1)
+    if (j * CONGESTION) > jitter:
+        print(f'jitter for {j} seconds')
+        return j
+    else:
+        return 0
+
+
+# checksum calculator for ensuring our data is being transferred
+def checksum_calc(data):
+    checksum = zlib.crc32(data)
+    return checksum
+
+
+class Connection:
+    # One client. Datagrams for it are queued by its ConnectionProtocol and handled by
+    # run(), which moves through the handshake, data transfer and FIN states.
+    def __init__(self, address, syn_header, syn_options):
+        self.address = address  # the client's (ip, port)
+        self.syn_seq = syn_header.seq
+        # use SACK if the client offers it, with the smaller of the two block counts
+        self.sack = 0
+        if SACK_PERMITTED in syn_options and args.sack > 0:
+            self.sack = min(args.sack, syn_options[SACK_PERMITTED][0])
+        # a client that does not offer its datagram size sends the usual one
+        self.mss = BUFFER_SIZE
+        self.mss_offered = MSS in syn_options
+        if self.mss_offered:
+            self.mss = min(MSS_OFFER, DATAGRAM_SIZE.unpack(syn_options[MSS])[0])
+        self.compress = syn_options.get(COMPRESS_PERMITTED) == bytes([ZLIB])
+        # (transfer id, offset, file size) of one stream of a striped transfer, None otherwise
+        self.stripe = STRIPE_VALUE.unpack(syn_options[STRIPE]) if STRIPE in syn_options else None
+        self.queue = asyncio.Queue()
+        self.transport = None
+        self.established = False
+        # data starts right after the SYN and the final handshake ACK, the window holds
+        # `window` segments of the largest size
+        self.reassembly = ReassemblyBuffer((self.syn_seq + 2) & SEQ_MASK,
+                                           max(1, args.window) * (self.mss - HEADER_SIZE))
+        self.delayed = DelayedAck(args.ack_every, args.ack_delay)
+        self.ack_timer = None  # sends the held back ACK once it is due
+        self.output = None
+        # file size the sender advertised, None if it did not
+        self.size = SIZE.unpack(syn_options[FILE_SIZE])[0] if FILE_SIZE in syn_options else None
+
+    @property
+    def local_port(self):
+        return self.transport.get_extra_info('sockname')[1]
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: ConnectionProtocol(self), local_addr=(host, 0))
+        print(f"binding listener to {host}:{self.local_port}")
+        # room in the socket for a window of the largest segments, the kernel caps it at rmem_max
+        self.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                                           max(1, args.window) * self.mss)
+        self.accept_handshake()
+        try:
+            await self.run()
+        finally:
+            if connections.get(self.address) is self:
+                del connections[self.address]
+            if self.ack_timer:
+                self.ack_timer.cancel()
+            if self.output:
+                self.output.close()
+            print("Client at ", self.address, " disconnected...")
+
+    # answer the SYN, the ACK/SYN comes from the port the client will send its data to
+    def accept_handshake(self):
+        data = ''.encode()
+        options = [(SACK_PERMITTED, bytes([self.sack]))] if self.sack else []
+        if self.mss_offered:
+            options.append((MSS, DATAGRAM_SIZE.pack(MSS_OFFER)))
+        if self.compress:  # the client may send compressed segments
+            options.append((COMPRESS_PERMITTED, bytes([ZLIB])))
+        if self.stripe:  # echoed so the client knows its stream lands in place
+            options.append((STRIPE, STRIPE_VALUE.pack(*self.stripe)))
+        trailer = pack_options(options)
+        accept_handshake_header_p, accept_handshake_header = header(self.local_port, self.address[1], data,
+                                                                    self.syn_seq, ack_seq=self.syn_seq + 1,
+                                                                    ack=True, syn=True, trailer=trailer)
+        send(self.transport, accept_handshake_header_p + data + trailer, self.address)
+
+    def establish(self):
+        if self.established:
+            return
+        self.established = True
+        print(f"Connection established with {self.address}")
+        # the streams of a striped transfer share one file, named after the transfer
+        directory = f"{self.stripe[0]:016x}" if self.stripe else str(self.address[1])
+        os.makedirs(os.path.abspath(os.path.join('.', 'out_files', directory)), exist_ok=True)
+        output_file = os.path.abspath(os.path.join('.', 'out_files', directory, args.output))
+        print(F"Writing output file: {output_file}")
+        # every segment is written in place as it arrives, reassembly only tracks the gaps
+        if self.stripe:  # this stream's bytes go to their own place in the file
+            self.output = OutputFile(output_file, self.reassembly.expected, self.stripe[2], args.fsync,
+                                     self.stripe[1], shared=True)
+        else:
+            self.output = OutputFile(output_file, self.reassembly.expected, self.size, args.fsync)
+
+    async def run(self):
+        while True:
+            try:
+                r_header, r_data = await asyncio.wait_for(self.queue.get(), args.idle_timeout or None)
+            except asyncio.TimeoutError:  # a half-open handshake or a client gone without a FIN
+                print(f"{self.address} silent for {args.idle_timeout} seconds, dropping the connection")
+                self.transport.close()
+                return
+            if not self.listen(r_header, r_data):
+                return
+
+    # handle one datagram from the client, returns False once the connection is closed
+    def listen(self, r_header, r_data):
+        send_port = r_header.sport
+        rec_port = r_header.rport
+        checksum = r_header.checksum
+        seq = r_header.seq
+        fin = r_header.fin
+        # the first data segment also completes the handshake if its ACK went missing
+        self.establish()
+        if checksum == checksum_calc(r_data):  # data received, not corrupted
+            if fin:
+                print(f"Disconnecting from: {self.address}")
+                data = ''.encode()
+                close_header_p, close_header = header(self.local_port, send_port, data, 0, ack=True, fin=True)
+                # sent acknowledgment, no need to wait for response
+                send(self.transport, close_header_p + data, self.address, then_close=True)
+                return False
+            r_data, r_options = split(r_data, r_header.win - HEADER_SIZE)
+            if COMPRESSED in r_options:  # the checksum covered the compressed bytes
+                r_data = decompress(r_data, DATAGRAM_SIZE.unpack(r_options[COMPRESSED])[0])
+            new, ready = self.reassembly.track(seq, len(r_data))
+            if new:
+                self.output.write(seq, r_data)
+            # a segment out of order, or one that closed a gap, is ACKed right away
+            in_order = ready == 1 and not self.reassembly.segments
+            if self.delayed.on_segment(in_order, (rec_port, send_port, seq)):
+                self.acknowledge(rec_port, send_port, seq)
+            elif self.ack_timer is None:
+                self.ack_timer = asyncio.get_running_loop().call_later(self.delayed.timeout(), self.flush_ack)
+        else:  # data received is corrupted, request the message again
+            print("data corrupted or not received")
+            self.delayed.clear()  # the request carries the cumulative ACK as well
+            data = ''.encode()
+            reply_header_p, reply_header = header(rec_port, send_port, data, self.reassembly.expected,
+                                                  ack_seq=self.reassembly.expected, ack=True)
+            send(self.transport, reply_header_p + data, self.address)
+        return True
+
+    def acknowledge(self, rec_port, send_port, seq):
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        # ack_seq is the next byte expected, seq names the segment this ACK answers
+        data = ''.encode()
+        # SACK blocks tell the sender which segments past a gap already arrived
+        blocks = self.reassembly.sack_blocks(self.sack) if self.sack else []
+        trailer = pack_options([(SACK, pack_sack(blocks))]) if blocks else b''
+        reply_header_p, reply_header = header(rec_port, send_port, data, seq,
+                                              ack_seq=self.reassembly.expected, ack=True, trailer=trailer)
+        send(self.transport, reply_header_p + data + trailer, self.address)
+
+    # the ACK delay ran out before enough segments arrived
+    def flush_ack(self):
+        self.ack_timer = None
+        if self.delayed.pending and not self.transport.is_closing():
+            rec_port, send_port, seq = self.delayed.pending
+            self.delayed.clear()
+            self.acknowledge(rec_port, send_port, seq)
+
+
+class ConnectionProtocol(asyncio.DatagramProtocol):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def datagram_received(self, r, r_address):
+        if r_address != self.connection.address:  # not from this connection's client
+            return
+        received = receive(r)
+        if received:
+            self.connection.queue.put_nowait(received)
+
+
+class WelcomeProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, r, r_address):
+        received = receive(r)
+        if not received:
+            return
+        r_header, r_data = received
+        address = (r_address[0], r_header.sport)
+        if r_header.syn and not r_header.ack and not r_header.fin:  # initial welcome handshake received
+            connection = connections.get(address)
+            if connection is None:
+                r_data, syn_options = split(r_data, r_header.win - HEADER_SIZE)
+                connection = connections[address] = Connection(address, r_header, syn_options)
+                asyncio.get_running_loop().create_task(connection.start())
+            elif connection.transport and not connection.established:  # the client repeated its SYN
+                connection.accept_handshake()
+        elif not r_header.syn and r_header.ack and not r_header.fin:
+            connection = connections.get(address)
+            if connection:
+                connection.establish()
+        else:
+            print("did not receive handshake")
+
+
+# the emulated round trip jitter is scheduled on the loop instead of sleeping
+def send(transport, packet, address, then_close=False):
+    sleepy_time = round_trip_jitter()
+    if sleepy_time:
+        asyncio.get_running_loop().call_later(sleepy_time, transmit, transport, packet, address, then_close)
+    else:
+        transmit(transport, packet, address, then_close)
+
+
+def transmit(transport, packet, address, then_close=False):
+    if transport.is_closing():
+        return
+    transport.sendto(packet, address)
+    header = BERRYESSA.unpack(packet)
+    log_packet(header)
+    if then_close:
+        transport.close()
+
+
+# parse a datagram, returns None when the emulated network dropped it
+def receive(r):
+    global CONGESTION
+    r_header, data = BERRYESSA.decode(r)
+    if r_header.bdp > args.bdp:  # trigger congestion window
+        CONGESTION = CONGESTION * 3
+    else:  # congestion slowed, return to normal
+        CONGESTION = 1
+    if not ploss():  # if there is no packet loss continue
+        log_packet(r_header)
+        return r_header, data
+
+
+def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False, bdp=args.bdp,
+           trailer=b''):
+    # create the header ('sender port', 'receiver port', 'win',
+    # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin', 'bdp')
+    # the options trailer is sent after the data, outside of win but covered by the checksum
+    win = len(data) + HEADER_SIZE
+    checksum = checksum_calc(data + trailer)
+    if ack_seq == 0:
+        ack_seq = seq
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin, bdp)
+    return BERRYESSA.pack(fields), fields
+
+
+# write a sent or received header to the packet trace or the text log
+def log_packet(header):
+    if tracer:
+        tracer.record(header.sport, header.rport, header.win, header.bdp, header.seq, header.ack_seq, header.ack, header.syn,
+                      header.fin)
+    else:
+        logger.log(header.sport, header.rport, msg_type(header), header.win, header.bdp)
+
+
+def msg_type(header):
+    if header.win > HEADER_SIZE:
+        return "DATA"
+    elif header.ack and header.syn:
+        return "ACK/SYN"
+    elif header.ack:
+        return "ACK"
+    elif header.syn:
+        return "SYN"
+    elif header.fin:
+        return "FIN"
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(WelcomeProtocol, local_addr=(host, port))
+    print("Listening as " + host + ":" + str(port))
+    try:
+        await loop.create_future()
+    finally:
+        transport.close()
+
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print("Keyboard Interrupt, closing server.")
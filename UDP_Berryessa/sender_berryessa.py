@@ -1,24 +1,40 @@
 #! python3
 # sender_berryessa.py
 # usage: python3 sender_berryessa.py --dest_ip XXXX.XXXX.XXXX.XXXX
-# --dest_port YYYY --tcp_version tahoe/reno --input input.txt
+# --dest_port YYYY --tcp_version tahoe/reno/cubic/bbr --input input.txt [--mss BYTES [--probe]]
+# [--compress LEVEL] [--streams N] [--resume TOKENS.json]
 
 import socket
 import argparse
+import atexit
+import errno
 import zlib
-import struct
 import random
 import time
 import os
-import threading
-from queue import Queue
+import sys
+import heapq
+import multiprocessing
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.gso import UDP_SEGMENT, OffloadSocket, supported  # noqa: E402
+from udp_common.mmsg import BatchSocket, available as mmsg_available  # noqa: E402
+from udp_common.rtt import RttEstimator  # noqa: E402
+from udp_common.options import (COMPRESS_PERMITTED, COMPRESSED, DATAGRAM_SIZE, EARLY_DATA, FILE_SIZE, MSS,  # noqa: E402
+                                SACK, SACK_PERMITTED, SIZE, STRIPE, STRIPE_VALUE, TOKEN, ZLIB, pack_options,
+                                padding, parse_sack, split)
+from udp_common.compression import Compressor  # noqa: E402
+from udp_common.trace import TraceWriter  # noqa: E402
+from udp_common.congestion import CONTROLLERS, DUP_THRESH, create  # noqa: E402
+from udp_common.codec import Header, BERRYESSA  # noqa: E402
+from udp_common.segments import SegmentReader, send_segment  # noqa: E402
+from udp_common.tokens import TokenCache  # noqa: E402
+
 
 # header size
-HEADER_SIZE = 31
-# signal to kill threads, or not, depending on their behavior
-kill_threads = threading.Event()
+HEADER_SIZE = BERRYESSA.size
 # port the client will use
 client_port = 0
 # create argument parser
@@ -30,7 +46,25 @@ parser.add_argument('-p', '--dest_port', type=int, required=True)
 # add the required input argument
 parser.add_argument('-i', '--input', type=str, required=True)
 # add the required tcp_version argument
-parser.add_argument('-t', '--tcp_version', type=str)
+parser.add_argument('-t', '--tcp_version', type=str, choices=sorted(CONTROLLERS))
+# add the sack argument, the most SACK blocks asked for per ACK, 0 turns SACK off
+parser.add_argument('--sack', type=int, default=4)
+# record packets in a binary trace instead of the text log
+parser.add_argument('--trace', action='store_true')
+# datagrams per sendmmsg/recvmmsg batch (Linux only), 0 sends one at a time
+parser.add_argument('--mmsg', type=int, default=0)
+# send each window as runs of equal sized segments, one sendmsg per run (Linux UDP GSO)
+parser.add_argument('--gso', action='store_true')
+# add the mss argument, the largest datagram this side offers to send, header included
+parser.add_argument('--mss', type=int, default=1000)
+# start at the usual datagram size and probe the path up to the agreed one
+parser.add_argument('--probe', action='store_true')
+# add the compress argument, the zlib level segments are compressed with (1 is fastest), 0 sends them as they are
+parser.add_argument('--compress', type=int, default=0)
+# add the streams argument, the file is cut into this many byte ranges, each sent by its own process
+parser.add_argument('--streams', type=int, default=1)
+# add the resume argument, a file keeping the receivers' tokens, with one the first segment (the whole initial window) goes in the SYN
+parser.add_argument('--resume', type=str, default=None)
 # parse the arguments
 args = parser.parse_args()
 # ip address or hostname of the hose
@@ -43,48 +77,38 @@ BUFFER_SIZE = 1000
 message = "Ping"
 # Sequence to use for the file transfer
 SEQ = random.getrandbits(32)
-# set the initial TIMEOUT_INTERVAL
-TIMEOUT_INTERVAL = .002
-# the total number of timeouts/packet loss for this session
-TIMEOUT_COUNT = 0
-# used to compare packets lost between CWND transmits
-TIMEOUT_COMPARE = 0
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+# set the initial TIMEOUT_INTERVAL, used until the first RTT sample
+TIMEOUT_INTERVAL = .05
+# the shortest retransmission timeout
+MIN_TIMEOUT_INTERVAL = .005
+# the longest a retransmitted segment waits for its ACK
+MAX_TIMEOUT_INTERVAL = 2
+# smoothed RTT and RTT variance, they set the retransmission timeout
+rtt = RttEstimator(TIMEOUT_INTERVAL, MIN_TIMEOUT_INTERVAL, MAX_TIMEOUT_INTERVAL)
 # the total number of packets sent for this session
 PACKET_COUNT = 0
-# CWND
-CWND = 1
-# Initial CWND
-INIT_CWND = CWND
-# ssthresh
-ssthresh = 16
-# transmission round
-TRANSMISSION_ROUND = 0
-# congestion control state
-CONGESTION_STATE = "SLOW START"
-
-
-class ServerThread(threading.Thread):
-    def __init__(self, send_queue, resend_queue):
-        threading.Thread.__init__(self)
-        self.send_queue = send_queue
-        self.resend_queue = resend_queue
-
-    def run(self):
-        packet, saddress, r_sock = self.send_queue.get()
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                send_and_wait_respond(s, packet, saddress, r_sock)
-        except KeyboardInterrupt:
-            close(s, saddress)
-            close(r_sock, saddress)
-            kill_threads.set()
-        except TimeoutError:
-            self.resend_queue.put((packet, saddress, r_sock))
-        finally:
-            self.send_queue.task_done()
-
-    def join(self, timeout=None):
-        threading.Thread.join(self, timeout)
+# the total number of bytes sent for this session
+BYTE_COUNT = 0
+# initial congestion window and slow start threshold, in segments
+INIT_CWND = 1
+INIT_SSTHRESH = 16
+# the largest UDP payload over IPv4
+MAX_DATAGRAM = 65507
+# the largest datagram offered in the SYN
+MSS_OFFER = max(HEADER_SIZE + 1, min(args.mss, MAX_DATAGRAM))
+# the receivers' resumption tokens, None without --resume
+tokens = TokenCache(args.resume) if args.resume else None
+# a size is given up on after this many lost probes, and probing stops once the next
+# step up would be smaller than PROBE_STEP bytes
+PROBE_ATTEMPTS = 3
+PROBE_STEP = 256
+# don't fragment for path MTU probes (Linux), every other datagram keeps the socket's own setting
+IP_MTU_DISCOVER = 10 if sys.platform.startswith('linux') else None
+IP_PMTUDISC_PROBE = 3
+# the option that marks a compressed segment
+COMPRESSED_OVERHEAD = len(pack_options([(COMPRESSED, DATAGRAM_SIZE.pack(0))]))
 
 
 def timestamp():
@@ -92,124 +116,133 @@ def timestamp():
     return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S%f')
 
 
-def file_logging(msg, file):
-    with open(file, 'a') as write_file:
-        write_file.write(msg + '\n')
-    #print(msg)
-
-
-log_file = f"sender_berryessa_{timestamp()}.log"
-log_file_path = os.path.abspath(os.path.join('.', log_file))
-stats_file = f"sender_berryessa_{timestamp()}_TRAN_CWND.log"
-stats_file_path = os.path.abspath(os.path.join('.', stats_file))
-final_stats_file = f"sender_berryessa_{timestamp()}_final_stats.log"
-final_stats_file_path = os.path.abspath(os.path.join('.', final_stats_file))
-
-
-# calculate a new timeout interval
-def timeout_calc(sec=0.0, pack_l=False, calc=False, triple_ack=False):
-    global TIMEOUT_INTERVAL
-    global TIMEOUT_COUNT
-    global TIMEOUT_COMPARE
-    global CWND
-    global ssthresh
-    global CONGESTION_STATE
-    if pack_l:
-        TIMEOUT_COUNT += 1
-    if calc:
-        print("WINDOW Processed")
-        if TIMEOUT_COUNT > TIMEOUT_COMPARE:  # packet loss in the most recent window
-            pack_l = True
-            TIMEOUT_COMPARE = TIMEOUT_COUNT
-        if args.tcp_version == 'tahoe':
-            if pack_l:
-                ssthresh = int(CWND/2)
-                CWND = 1
-                CONGESTION_STATE = "SLOW START"
-            elif CWND < ssthresh:
-                CWND = CWND * 2
-                CONGESTION_STATE = "FAST RETRANSMIT"
-            elif CWND >= ssthresh:
-                CWND += 1
-                CONGESTION_STATE = "AIMD"
-        elif args.tcp_version == 'reno':
-            if triple_ack or pack_l:
-                CWND = int(CWND / 2)
-                ssthresh = int(CWND / 2)
-                CONGESTION_STATE = "FAST RECOVERY"
-            elif CWND < ssthresh:
-                CWND = CWND * 2
-                CONGESTION_STATE = "FAST RETRANSMIT"
-            elif CWND >= ssthresh:
-                CWND += 1
-                CONGESTION_STATE = "AIMD"
-        else:
-            t = .5
-            print(f"TIMEOUT INTERVAL = {TIMEOUT_INTERVAL}\n Packet Loss = {TIMEOUT_COUNT}\nPackets Sent = {PACKET_COUNT}")
-            if TIMEOUT_COUNT == 1:
-                TIMEOUT_INTERVAL = sec
-            else:
-                TIMEOUT_INTERVAL = (1.0-t) * TIMEOUT_INTERVAL + (t*sec)
+# open the log files, every stream of a striped transfer writes its own
+def open_logs(name=''):
+    global logger, tracer, stats_logger, final_stats_logger
+    log_file = f"sender_berryessa_{timestamp()}{name}.log"
+    log_file_path = os.path.abspath(os.path.join('.', log_file))
+    stats_file = f"sender_berryessa_{timestamp()}{name}_TRAN_CWND.log"
+    stats_file_path = os.path.abspath(os.path.join('.', stats_file))
+    final_stats_file = f"sender_berryessa_{timestamp()}{name}_final_stats.log"
+    final_stats_file_path = os.path.abspath(os.path.join('.', final_stats_file))
+    trace_file = f"sender_berryessa_{timestamp()}{name}.trace"
+    trace_file_path = os.path.abspath(os.path.join('.', trace_file))
+    logger = None
+    tracer = None
+    if args.trace:
+        tracer = TraceWriter(trace_file_path, HEADER_SIZE)
+        atexit.register(tracer.close)
+    else:
+        logger = AsyncLogger(log_file_path, time_format='%Y%m%d%H%M%S%f')
+    stats_logger = AsyncLogger(stats_file_path)
+    final_stats_logger = AsyncLogger(final_stats_file_path)
+
+
+# a worker process exits without running atexit, so it closes its logs itself
+def close_logs():
+    for log in (logger, tracer, stats_logger, final_stats_logger):
+        if log:
+            log.close()
+
+
+open_logs()
 
 
 # checksum calculator for ensuring our data is being transferred
-def checksum_calc(data):
-    checksum = zlib.crc32(data)
+# `value` continues the checksum of the bytes before `data`
+def checksum_calc(data, value=0):
+    checksum = zlib.crc32(data, value)
     return checksum
 
 
-def connect(conn_host, conn_port):
+# `stripe` is the (transfer id, offset, length, file size) this connection sends of a striped transfer
+def connect(conn_host, conn_port, cc, stripe=None):
     server = (conn_host, conn_port)
-    # initialize the socket to use for incoming
-    in_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # initialize the socket to use for outgoing
-    out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # bind the incoming socket to listen for connections from the server
-    in_sock.bind(('localhost', client_port))
+    # initialize the socket used for the handshake and the whole connection
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # bind the socket to listen for the server's responses
+    tcp_sock.bind(('localhost', client_port))
     print(f"Establishing connection to {server}")
+    # offer SACK, a receiver that does not know the option ignores it
+    options = [(SACK_PERMITTED, bytes([min(args.sack, 255)]))] if args.sack > 0 else []
+    # advertise the file size so the receiver can preallocate the output
+    if stripe:  # where this stream's bytes go in the receiver's file
+        transfer_id, offset, length, total = stripe
+        options.append((STRIPE, STRIPE_VALUE.pack(transfer_id, offset, total)))
+    elif os.path.isfile(args.input):
+        options.append((FILE_SIZE, SIZE.pack(os.path.getsize(args.input))))
+    # the largest datagram we send, the receiver answers with the largest it takes
+    options.append((MSS, DATAGRAM_SIZE.pack(MSS_OFFER)))
+    if args.compress:
+        options.append((COMPRESS_PERMITTED, bytes([ZLIB])))
+    # a token from the last connection lets the first segment go with the SYN, without one the SYN asks for one
+    token = None
+    if tokens and not stripe:
+        token, token_mss = tokens.take(f"{conn_host}:{conn_port}")
+        options.append((TOKEN, token or b''))
+    trailer = pack_options(options)
+    early = ''.encode()
+    if token:
+        # the first window is INIT_CWND segments, one, so it all fits in the SYN and nothing else
+        # goes out before the ACK/SYN: the receiver only has the connection's socket after that
+        # no bigger than the datagrams agreed on last time, the usual size while the path is probed
+        room = (BUFFER_SIZE if args.probe else min(token_mss, MSS_OFFER)) - HEADER_SIZE - len(trailer)
+        with open(args.input, 'rb') as f:
+            early = f.read(max(room, 0))
     # create the header
-    first_handshake_header_p, first_handshake_header = header(in_sock.getsockname()[1], conn_port,
-                                                              ''.encode(), SEQ, syn=True)
+    first_handshake_header_p, first_handshake_header = header(tcp_sock.getsockname()[1], conn_port,
+                                                              early, SEQ, syn=True, trailer=trailer)
     # send the header to the server
-    in_header, in_data, in_address = send_and_wait_respond(out_sock, first_handshake_header_p,
-                                                           server, in_sock)
-    if in_header[6] and in_header[7] and (in_header[5] == SEQ + 1):
-        tcp_port = client_port
-        # initialize the socket to use for the connection
-        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # bind the incoming socket to listen for connections from the server
-        tcp_sock.bind(('localhost', tcp_port))
-        second_handshake_header_p, second_handshake_header = header(tcp_sock.getsockname()[1], conn_port, ''.encode(), SEQ,
-                                                                    ack_seq=in_header[5] + 1,
+    in_header, in_data, in_address = send_and_wait_respond(tcp_sock, first_handshake_header_p + early + trailer,
+                                                           server, cc)
+    if in_header.ack and in_header.syn and (in_header.ack_seq == SEQ + 1):
+        in_data, in_options = split(in_data, in_header.win - HEADER_SIZE)
+        # the receiver echoes the option with the block count it will send
+        sack = in_options[SACK_PERMITTED][0] if SACK_PERMITTED in in_options and args.sack > 0 else 0
+        # a receiver that does not know the option gets the usual size
+        mss = min(MSS_OFFER, DATAGRAM_SIZE.unpack(in_options[MSS])[0]) if MSS in in_options else BUFFER_SIZE
+        # compress only if the receiver answers with the same method
+        compress = args.compress > 0 and in_options.get(COMPRESS_PERMITTED) == bytes([ZLIB])
+        # a receiver that does not echo the stripe would write it at the start of a file of its own
+        striped = stripe is None or STRIPE in in_options
+        if tokens and in_options.get(TOKEN):  # for the next connection to this receiver
+            tokens.put(f"{conn_host}:{conn_port}", in_options[TOKEN], mss)
+        # the receiver took the data in the SYN and counts the connection as open already, a
+        # receiver that did not (no token, a used or expired one) gets the data again after the ACK
+        resumed = EARLY_DATA in in_options
+        if resumed:
+            print(f"0-RTT: the receiver took {len(early)} bytes with the SYN")
+        # the ACK already names the connection's port, a receiver with one socket for all clients
+        # (--demux) sends from its listening port and tells connections apart by it
+        second_handshake_header_p, second_handshake_header = header(tcp_sock.getsockname()[1], in_header.sport,
+                                                                    ''.encode(), SEQ,
+                                                                    ack_seq=in_header.ack_seq + 1,
                                                                     ack=True)
-        send(out_sock, second_handshake_header_p, server)
-        print(f"binding listener socket to localhost:{tcp_port}")
-
-        in_sock.close()
-        out_sock.close()
-        return tcp_sock, (server[0], in_header[0])
+        if not resumed:
+            send(tcp_sock, second_handshake_header_p, server)
+        # connect the socket to where the ACK/SYN came from, data, ACK and FIN traffic all use it
+        tcp_sock.connect(in_address)
+        print(f"connected socket localhost:{tcp_sock.getsockname()[1]} to {in_address}")
+        return tcp_sock, (server[0], in_header.sport), sack, mss, compress, striped, len(early) if resumed else 0
     else:
-        in_sock.close()
-        out_sock.close()
-        return None, None
+        tcp_sock.close()
+        return None, None, 0, BUFFER_SIZE, False, False, 0
 
 
-def close(sock, address):
+def close(sock, address, cc):
     print(f"Disconnecting from: {address}")
     try:
         data = ''.encode()
         close_header_p, close_header = header(sock.getsockname()[1], address[1], data,
                                               0, fin=True)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                r_header, r_data, r_address = send_and_wait_respond(s, close_header_p + data,
-                                                                    address, sock)
-            if r_header[6] and r_header[8]:
+            r_header, r_data, r_address = send_and_wait_respond(sock, close_header_p + data, cc=cc)
+            if r_header.ack and r_header.fin:
                 print("server responded to disconnect.")
                 sock.close()
             else:
                 print("else")
-                close(sock, address)
+                close(sock, address, cc)
         except:
             sock.close()
         print("Finished closing connection.")
@@ -217,148 +250,609 @@ def close(sock, address):
         pass
 
 
-def send(s, packet, address):
-    global PACKET_COUNT
+# send on a connected socket, or to address while the handshake is still in progress
+# a payload goes out behind the packet without copying the two into one buffer
+# `batch` queues the packet for the connection's next sendmmsg instead
+def send(s, packet, address=None, payload=None, batch=None):
+    global PACKET_COUNT, BYTE_COUNT
     PACKET_COUNT += 1
-    s.sendto(packet, address)
-    header = packet[:HEADER_SIZE]
-    header = unpack_header(header)
+    BYTE_COUNT += len(packet) + (len(payload) if payload is not None else 0)
+    if batch:
+        batch.send(packet, payload)
+    elif payload is not None:
+        send_segment(s, packet, payload, address)
+    elif address:
+        s.sendto(packet, address)
+    else:
+        s.send(packet)
+    header = BERRYESSA.unpack(packet)
     print_header(header)
-    file_logging(f"{header[0]} | {header[1]} | {msg_type(header)} | {header[2]} | {header[9]} | {timestamp()}", log_file_path)
+    log_packet(header)
 
 
-def send_and_wait_respond(s, packet, address, re_sock):
-    global TIMEOUT_INTERVAL
-    # for i in range(0, 3):
-    while True:
-        re_sock.settimeout(TIMEOUT_INTERVAL)
+def send_and_wait_respond(s, packet, address=None, cc=None):
+    retries = 0
+    while s.fileno() != -1:  # stop once the connection has been closed
+        s.settimeout(rtt.rto)
         t1 = time.time()
         try:
             send(s, packet, address)
-            s_header = packet[:HEADER_SIZE]
-            s_header = unpack_header(s_header)
-            r_header, r_data, r_address = receive(re_sock)
+            s_header = BERRYESSA.unpack(packet)
+            r_header, r_data, r_address = receive(s)
             t2 = time.time()
-            timeout_calc(t2-t1)
-            if r_header[5] == s_header[5] and not r_header[8]:  # data not received by receiver, it requested the same packet
-                timeout_calc(calc=True, triple_ack=True)
-                return send_and_wait_respond(s, packet, address, re_sock)
+            if retries == 0:  # Karn's rule, the reply to a resent packet may answer either copy
+                rtt.sample(t2-t1)
+            if r_header.ack_seq == s_header.seq and not r_header.fin:  # data not received by receiver, it still expects this packet
+                cc.on_loss()
+                return send_and_wait_respond(s, packet, address, cc)
             else:
                 return r_header, r_data, r_address
         except KeyboardInterrupt:
-            close(re_sock, address)
+            close(s, address or s.getpeername(), cc)
+            break
+        except ConnectionRefusedError:  # the receiver's socket is gone, retrying will not help
             break
         except:  # timed out try sending the same packet again
-            t2 = time.time()
-            timeout_calc(t2-t1, pack_l=True)
+            cc.on_rto()
+            rtt.backoff()
+            retries += 1
     raise TimeoutError
 
 
-def receive(rec_sock, buffer=BUFFER_SIZE):
-    r, r_address = rec_sock.recvfrom(buffer)
-    r_header = r[:HEADER_SIZE]
-    r_header = unpack_header(r_header)
-    data = r[HEADER_SIZE:]
-    file_logging(f"{r_header[0]} | {r_header[1]} | {msg_type(r_header)} | {r_header[2]} | {r_header[9]} | {timestamp()}", log_file_path)
+def receive(rec_sock, buffer=BUFFER_SIZE, batch=None):
+    if batch:
+        r, r_address = batch.recv(rec_sock.gettimeout())
+    else:
+        r, r_address = rec_sock.recvfrom(buffer)
+    r_header, data = BERRYESSA.decode(r)
+    log_packet(r_header)
     print_header(r_header)
     return r_header, data, r_address
 
 
-def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False):
-    # create the header ('struct format', 'sender port', 'receiver port', 'win',
+def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False, trailer=b'',
+           cwnd=INIT_CWND, mss=BUFFER_SIZE):
+    # create the header ('sender port', 'receiver port', 'win',
     # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin', 'bdp')
+    # the options trailer is sent after the data, outside of win but covered by the checksum
     win = len(data)+HEADER_SIZE
-    checksum = checksum_calc(data)
+    checksum = checksum_calc(trailer, checksum_calc(data))
     if ack_seq == 0:
         ack_seq = seq
-    header_packed = struct.pack("!IIIIII???I", sender_port, receiver_port, win, checksum, seq,
-                                ack_seq, ack, syn, fin, CWND * BUFFER_SIZE)
-    return header_packed, unpack_header(header_packed)
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin, cwnd * mss)
+    return BERRYESSA.pack(fields), fields
 
 
-def unpack_header(header):
-    return struct.unpack("!IIIIII???I", header)
+# write a sent or received header to the packet trace or the text log
+def log_packet(header):
+    if tracer:
+        tracer.record(header.sport, header.rport, header.win, header.bdp, header.seq, header.ack_seq, header.ack, header.syn,
+                      header.fin)
+    else:
+        logger.log(header.sport, header.rport, msg_type(header), header.win, header.bdp)
 
 
 def msg_type(header):
-    if header[2] > HEADER_SIZE:
+    if header.win > HEADER_SIZE:
         return "DATA"
-    elif header[6] and header[7]:
+    elif header.ack and header.syn:
         return "ACK/SYN"
-    elif header[6]:
+    elif header.ack:
         return "ACK"
-    elif header[7]:
+    elif header.syn:
         return "SYN"
-    elif header[8]:
+    elif header.fin:
         return "FIN"
 
 
 def print_header(header):
-    print(f"{header[0]} | {header[1]} | {header[2]} | {header[3]} | {header[4]} | {header[5]} | {header[6]} | {header[7]} | {header[8]} | {header[9]}")
-
-
-send_window = Queue()
-resend_window = Queue()
-
-tcp_sock, address = connect(host, port)
-print(f"handhsake complete, server address = {address}")
-
-connected = True
-
-start_time = time.time()
-start_timestamp = timestamp()
-
-if tcp_sock:
-    seq = SEQ
-    ack_seq = seq + BUFFER_SIZE
-    with open(args.input, 'rb') as f:
-        while connected:
-            for i in range(CWND):
-                data = f.read(BUFFER_SIZE-HEADER_SIZE)
-                print(send_window.qsize())
-                if data:
-                    try:
-                        ping_pong_header_p, ping_pong_header = header(tcp_sock.getsockname()[1], address[1],
-                                                                      data, seq, ack_seq=ack_seq, ack=True)
-                        packet = ping_pong_header_p + data
-                        send_window.put((packet, address, tcp_sock))
-                        ack_seq += ping_pong_header[2]
-                        newthread = ServerThread(send_window, resend_window)
-                        newthread.start()
-                    except KeyboardInterrupt:
-                        print("Keyboard Interrupt, exiting and closing connections.")
-                        close(tcp_sock, address)
-                        kill_threads.set()
-                        break
-                    except TypeError:
-                        kill_threads.set()
-                        break
+    print(f"{header.sport} | {header.rport} | {header.win} | {header.checksum} | {header.seq} | {header.ack_seq} | {header.ack} | {header.syn} | {header.fin} | {header.bdp}")
+
+
+class Segment:
+    __slots__ = ('offset', 'data', 'payload', 'options', 'sent', 'deadline', 'retries', 'sacked', 'lost', 'delivered', 'delivered_time')
+
+    def __init__(self, offset, data):
+        self.offset = offset
+        self.data = data
+        self.payload = data  # what goes on the wire, the compressed data if it was compressed
+        self.options = b''  # its options trailer
+        self.sent = 0.0
+        self.deadline = 0.0  # when its retransmission timer runs out
+        self.retries = 0
+        self.sacked = False  # the receiver holds it past a gap
+        self.lost = False  # resent because of SACK information, or by the go-back after a timeout
+        self.delivered = 0  # segments delivered when it was sent (bbr)
+        self.delivered_time = 0.0
+
+
+class Connection:
+    # One transmit/receive event loop per connection. Outstanding segments are keyed by byte
+    # offset, their retransmission deadlines sit in a heap, and every ACK is matched against
+    # them through its cumulative ack_seq, so no thread ever waits on a particular ACK.
+    # The window and pacing rate come from the connection's own congestion controller `cc`.
+    # Segments are at most `mss` bytes on the wire, with `probe` they start at the usual size
+    # and grow as padded probes show the path takes more. A `compressor` compresses new segments.
+    def __init__(self, sock, address, base, cc, sack=0, batch=None, mss=BUFFER_SIZE, probe=False,
+                 compressor=None):
+        self.sock = sock
+        self.batch = batch  # BatchSocket or OffloadSocket sending whole windows, None without --mmsg/--gso
+        self.address = address
+        self.base = base
+        self.cc = cc
+        self.sack = sack  # SACK blocks per ACK agreed on in the handshake, 0 if not in use
+        self.segments = {}  # offset -> Segment, in offset order
+        self.sacked = 0  # number of SACKed segments in self.segments
+        self.timers = []  # heap of (deadline, offset)
+        self.snd_una = 0  # oldest unacknowledged offset
+        self.next_offset = 0  # offset of the next new segment
+        self.round_end = None  # the round is over once everything before this offset is ACKed
+        self.rounds = 0  # transmission rounds so far
+        self.dupacks = 0  # duplicate ACKs in a row
+        self.in_recovery = False
+        self.recover = 0  # fast recovery lasts until everything sent before this offset is ACKed
+        self.round_recovery = False  # fast recovery set the window during this round
+        # after a timeout every segment past the oldest is taken as lost, they are resent in order
+        # from resend_from as the window opens and no longer count as in flight until then
+        self.resend_from = None
+        self.lost_out = 0  # segments taken as lost by the timeout and not resent, ACKed or SACKed yet
+        self.next_send = 0.0  # pacing, the earliest time the next new segment may leave
+        self.reader = None  # SegmentReader of the input file
+        self.compressor = compressor
+        self.max_mss = mss  # the largest datagram agreed on in the handshake, lowered by lost probes
+        self.mss = min(BUFFER_SIZE, mss) if probe else mss  # the datagram size of new segments
+        self.probe = probe
+        self.probe_size = 0  # datagram size being probed, 0 while not probing
+        self.probe_due = False  # the next new segment is padded out to probe_size
+        self.probing = None  # the probe segment while its padded copy is in flight
+        self.probe_failures = 0  # lost probes of probe_size
+        self.pmtu_policy = None  # the socket's own IP_MTU_DISCOVER, restored after every probe
+        if probe and IP_MTU_DISCOVER is not None:
+            try:
+                self.pmtu_policy = sock.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+            except OSError:
+                pass
+
+    # segments that still count against the window
+    def flight(self):
+        return len(self.segments) - self.sacked - self.lost_out
+
+    # taken as lost by the last timeout and not resent since
+    def awaiting_resend(self, segment):
+        return (self.resend_from is not None and segment.offset >= self.resend_from
+                and not segment.lost and not segment.sacked)
+
+    def wire_seq(self, offset):
+        return (self.base + offset) & SEQ_MASK
+
+    # offset of a sequence number from the receiver, None if it is outside the window
+    def offset_of(self, seq):
+        distance = (seq - self.wire_seq(self.snd_una)) & SEQ_MASK
+        if distance > self.next_offset - self.snd_una:
+            return None
+        return self.snd_una + distance
+
+    def transmit(self, segment):
+        payload, trailer = segment.payload, segment.options
+        # the first copy of a probe is padded, a resent one goes out at the usual size
+        probe = segment is self.probing and segment.retries == 0
+        if probe:
+            trailer += padding(self.probe_size - HEADER_SIZE - len(payload) - len(trailer))
+        # seq is the position of the segment, ack_seq the position right after it, both count
+        # the bytes of the file whether they were compressed or not
+        ping_pong_header_p, ping_pong_header = header(self.sock.getsockname()[1], self.address[1], payload,
+                                                      self.wire_seq(segment.offset),
+                                                      ack_seq=self.wire_seq(segment.offset + len(segment.data)),
+                                                      ack=True, trailer=trailer, cwnd=self.cc.cwnd, mss=self.mss)
+        if trailer:
+            payload = bytes(payload) + trailer
+        if not probe:
+            send(self.sock, ping_pong_header_p, payload=payload, batch=self.batch)
+        elif not self.send_probe(ping_pong_header_p, payload):
+            self.probe_lost()
+            return self.transmit(segment)
+        segment.sent = time.time()
+        self.arm(segment, segment.sent)
+        self.cc.on_send(segment, segment.sent)
+
+    # a probe goes out on its own with don't fragment set, False if the route cannot take its size
+    def send_probe(self, packet, payload):
+        if self.batch:
+            self.batch.flush()
+        if self.pmtu_policy is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+        try:
+            send(self.sock, packet, payload=payload)
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE:
+                raise
+            return False
+        finally:
+            if self.pmtu_policy is not None:
+                self.sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, self.pmtu_policy)
+        return True
+
+    # once per round the next new segment is padded out to a size between the current one and
+    # the largest that may still work, a binary search that ends close below the path MTU
+    def next_probe(self):
+        if not self.probe or self.probing is not None or self.in_recovery:
+            return
+        if not self.probe_size:
+            if self.max_mss - self.mss < PROBE_STEP:
+                return
+            self.probe_size = (self.mss + self.max_mss + 1) // 2
+        self.probe_due = True
+
+    def probe_acked(self):
+        self.probing = None
+        self.probe_failures = 0
+        self.resize(self.probe_size)
+        self.probe_size = 0
+        print(f"path MTU probe passed, sending {self.mss} byte datagrams")
+
+    # a lost probe only says the path may not take its size, it is no sign of congestion
+    def probe_lost(self):
+        self.probing = None
+        self.probe_failures += 1
+        if self.probe_failures >= PROBE_ATTEMPTS:
+            print(f"path MTU probe of {self.probe_size} bytes failed")
+            self.max_mss = self.probe_size - 1
+            self.probe_size = 0
+            self.probe_failures = 0
+
+    # new segments are cut to the new size, the ones in flight keep theirs
+    def resize(self, mss):
+        self.mss = mss
+        self.reader.resize(mss - HEADER_SIZE)
+
+    # (re)start the retransmission timer of a segment, with the RTO as backed off by timeouts
+    def arm(self, segment, now):
+        segment.deadline = now + rtt.rto
+        heapq.heappush(self.timers, (segment.deadline, segment.offset))
+
+    def retransmit(self, segment):
+        if self.awaiting_resend(segment):
+            self.lost_out -= 1
+        segment.lost = True
+        segment.retries += 1
+        self.transmit(segment)
+
+    def on_dupack(self):
+        self.dupacks += 1
+        segment = self.segments[self.snd_una]
+        if segment is self.probing:  # the padded probe went missing, resend its data without padding
+            if self.dupacks == DUP_THRESH:
+                self.probe_lost()
+                self.retransmit(segment)
+            return
+        if not self.cc.fast_recovery:  # the controller keeps its window, a loss only means a resend
+            if self.dupacks == DUP_THRESH and not segment.lost:
+                self.cc.on_loss()
+                self.retransmit(segment)
+            return
+        if self.in_recovery:
+            if not self.sack:  # every duplicate ACK is a segment that left the network
+                self.cc.on_recovery_dupack()
+        elif self.dupacks == DUP_THRESH and self.snd_una >= self.recover:
+            self.in_recovery = True
+            self.round_recovery = True
+            self.recover = self.next_offset
+            self.cc.enter_recovery(len(self.segments) - self.sacked)
+            self.retransmit(self.segments[self.snd_una])
+
+    # NewReno, an ACK that moves snd_una but not past `recover` means the next segment was lost too
+    def on_new_ack(self, acked_segments):
+        self.dupacks = 0
+        if not self.in_recovery:
+            return
+        if self.snd_una >= self.recover:  # the whole window is ACKed, deflate it
+            self.in_recovery = False
+            self.cc.exit_recovery()
+        else:
+            self.cc.on_partial_ack(acked_segments)
+            segment = self.segments.get(self.snd_una)
+            if segment is not None and not segment.sacked:
+                self.retransmit(segment)
+
+    # mark the segments inside the SACK blocks and resend the holes below them
+    # returns the segments that were SACKed for the first time
+    def on_sack(self, blocks):
+        newly_sacked = []
+        for start, end in blocks:
+            first, last = self.offset_of(start), self.offset_of(end)
+            if first is None or last is None:
+                continue
+            for offset, segment in self.segments.items():
+                if offset >= last:
+                    break
+                if offset >= first and not segment.sacked:
+                    if self.awaiting_resend(segment):
+                        self.lost_out -= 1
+                    segment.sacked = True
+                    self.sacked += 1
+                    newly_sacked.append(segment)
+                    if segment is self.probing:
+                        self.probe_acked()
+        sacked_above = 0
+        for segment in reversed(self.segments.values()):
+            if segment.sacked:
+                sacked_above += 1
+            elif sacked_above >= DUP_THRESH and not segment.lost:
+                if segment is self.probing:
+                    self.probe_lost()
+                else:
+                    self.cc.on_loss()
+                self.retransmit(segment)
+        return newly_sacked
+
+    def on_ack(self, r_header, r_data, now):
+        acked = self.offset_of(r_header.ack_seq)
+        if acked is None:
+            return
+        answered = self.segments.get(self.offset_of(r_header.seq))
+        rtt_sample = None
+        if answered is not None and answered.retries == 0:  # Karn's rule, only segments sent once
+            rtt_sample = now - answered.sent
+            rtt.sample(rtt_sample)
+        delivered = []  # segments the receiver got since the last ACK
+        acked_segments = 0
+        recovering = self.in_recovery
+        if acked > self.snd_una:
+            while self.segments:
+                offset = next(iter(self.segments))
+                if offset >= acked:
+                    break
+                segment = self.segments.pop(offset)
+                if self.awaiting_resend(segment):
+                    self.lost_out -= 1
+                self.reader.release(segment.data)
+                if segment is self.probing:
+                    self.probe_acked()
+                if segment.sacked:
+                    self.sacked -= 1
                 else:
-                    print("Finished transferring")
-                    close(tcp_sock, address)
-                    kill_threads.set()
-                    connected = False
+                    delivered.append(segment)
+                acked_segments += 1
+            self.snd_una = acked
+            if self.snd_una in self.segments:  # new data was ACKed, restart the timer of the oldest segment
+                self.arm(self.segments[self.snd_una], now)
+            if self.cc.fast_recovery:
+                self.on_new_ack(acked_segments)
+        elif self.segments and self.cc.fast_retransmit:
+            self.on_dupack()
+        elif r_header.seq == r_header.ack_seq and acked in self.segments:
+            # the receiver got a corrupted copy and asks for this segment again
+            segment = self.segments[acked]
+            if segment is self.probing:
+                self.probe_lost()
+            else:
+                self.cc.on_loss()
+            self.retransmit(segment)
+        if self.sack:
+            r_data, r_options = split(r_data, r_header.win - HEADER_SIZE)
+            if SACK in r_options:
+                delivered += self.on_sack(parse_sack(r_options[SACK]))
+        if (acked_segments or delivered) and not recovering and not self.in_recovery:
+            self.cc.on_ack(acked_segments, delivered, now, rtt_sample, self.flight())
+        if self.round_end is not None and self.snd_una >= self.round_end:  # the window was processed
+            self.round_end = None
+            self.rounds += 1
+            print(f"WINDOW Processed, {rtt}")
+            self.cc.on_round_end(recovery=self.round_recovery)
+            print(self.cc)
+            self.next_probe()
+            self.round_recovery = self.in_recovery
+            stats_logger.write(f"{self.rounds} | {self.cc.cwnd} | {self.cc.ssthresh}")
+
+    def on_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            deadline, offset = heapq.heappop(self.timers)
+            segment = self.segments.get(offset)
+            if segment is None or segment.deadline != deadline:  # ACKed, resent or restarted since
+                continue
+            if offset != self.snd_una:
+                # like one timer per connection only the oldest segment is resent, the ones
+                # after it are most likely waiting behind the same gap
+                self.arm(segment, now)
+                continue
+            if segment is self.probing:
+                self.probe_lost()
+                segment.retries += 1
+                self.transmit(segment)
+                continue
+            # a timeout ends fast recovery and restarts from slow start before the segment is
+            # resent, the inflated recovery window must not send it out again
+            # the duplicate ACKs the go-back draws must not start fast recovery either
+            self.recover = self.next_offset
+            self.in_recovery = False
+            self.round_recovery = False
+            self.dupacks = 0
+            self.cc.on_rto(len(self.segments) - self.sacked)
+            rtt.backoff()
+            segment.retries += 1
+            self.transmit(segment)
+            self.go_back(segment)
+
+    # the segments after the timed out one are resent by resend() as the window opens
+    def go_back(self, segment):
+        self.resend_from = segment.offset + len(segment.data)
+        self.lost_out = 0
+        for later in self.segments.values():
+            if later.offset < self.resend_from or later.sacked:
+                continue
+            later.lost = False  # resent again, whatever SACK recovery did before the timeout
+            self.lost_out += 1
+        if not self.lost_out:
+            self.resend_from = None
+
+    # resend the segments taken as lost by the last timeout, oldest first, while the window allows
+    def resend(self):
+        while self.resend_from is not None and self.flight() < self.cc.cwnd:
+            offset = max(self.resend_from, self.snd_una)
+            segment = self.segments.get(offset)
+            if segment is None:  # everything up to the newest segment was ACKed or resent
+                self.resend_from = None
+                self.lost_out = 0
+                return
+            if self.awaiting_resend(segment):  # SACKed ones and ones resent since are skipped
+                self.retransmit(segment)
+            self.resend_from = offset + len(segment.data)
+
+    # send `length` bytes of f from its current position, all of the rest with None
+    def run(self, f, length=None):
+        self.reader = SegmentReader(f, self.mss - HEADER_SIZE, length)
+        eof = False
+        while True:
+            self.resend()
+            # fill the congestion window with new segments
+            # SACKed segments have left the network and no longer count against the window
+            while not eof and self.resend_from is None and self.flight() < self.cc.cwnd:
+                now = time.time()
+                if now < self.next_send:  # paced, wait for the next send time
                     break
-            send_window.join()
-            TRANSMISSION_ROUND += 1
-            timeout_calc(calc=True)
-            file_logging(f"{TRANSMISSION_ROUND} | {CWND} | {ssthresh}", stats_file_path)
-            for i in range(resend_window.qsize()):  # resend packets that were triggered to be resent
-                newthread = ServerThread(resend_window, resend_window)
-                newthread.start()
-                resend_window.join()
+                data = self.reader.read()
+                if not data:
+                    eof = True
+                    break
+                segment = Segment(self.next_offset, data)
+                self.segments[segment.offset] = segment
+                if self.compressor:
+                    compressed = self.compressor.compress(data, COMPRESSED_OVERHEAD)
+                    if compressed is not None:
+                        segment.payload = compressed
+                        segment.options = pack_options([(COMPRESSED, DATAGRAM_SIZE.pack(len(data)))])
+                if self.probe_due:
+                    self.probe_due = False
+                    self.probing = segment
+                self.next_offset += len(data)
+                self.transmit(segment)
+                if self.cc.pacing_rate:
+                    self.next_send = max(self.next_send, now) + 1 / self.cc.pacing_rate
+            if self.round_end is None:
+                self.round_end = self.next_offset
+            if eof and not self.segments:
+                if self.batch:
+                    self.batch.flush()
+                return
+            # wait for an ACK until the earliest retransmission deadline
+            while self.timers and self.timers[0][1] not in self.segments:
+                heapq.heappop(self.timers)
+            deadline = self.timers[0][0] if self.timers else self.next_send
+            if not eof and self.resend_from is None and self.flight() < self.cc.cwnd:  # only pacing holds the next segment back
+                deadline = min(deadline, self.next_send)
+            self.sock.settimeout(max(deadline - time.time(), 0.0001))
+            try:
+                r_header, r_data, r_address = receive(self.sock, batch=self.batch)
+                self.on_ack(r_header, r_data, time.time())
+            except ConnectionRefusedError:  # the receiver's socket is gone
+                raise
+            except OSError:  # socket.timeout
+                self.on_timers(time.time())
+
+
+# send the input file, or with `stripe` (transfer id, offset, length, file size) one range of it
+# returns the packets and bytes sent and the packets lost
+def transfer(stripe=None):
+    # congestion state of this connection, the handshake's losses count towards it too
+    cc = create(args.tcp_version, rtt, INIT_CWND, INIT_SSTHRESH)
+    tcp_sock, address, sack, mss, compress, striped, early = connect(host, port, cc, stripe)
+    print(f"handhsake complete, server address = {address}")
+
+    start_time = time.time()
+    start_timestamp = timestamp()
+
+    compressor = None
+    if tcp_sock and not striped:
+        print("Server does not take striped transfers.")
+        close(tcp_sock, address, cc)
+    elif tcp_sock:
+        # the first data byte follows the SYN, the final handshake ACK and whatever the SYN carried
+        batch = None
+        if args.gso and supported(tcp_sock, UDP_SEGMENT):
+            batch = OffloadSocket(tcp_sock, gso=True, slot=mss)
+        elif args.gso:
+            print("UDP GSO not available, sending one datagram at a time")
+        if batch is None and args.mmsg and mmsg_available():
+            batch = BatchSocket(tcp_sock, args.mmsg, mss)
+        elif batch is None and args.mmsg:
+            print("sendmmsg/recvmmsg not available, sending one datagram at a time")
+        print(f"datagrams of up to {mss} bytes")
+        compressor = Compressor(args.compress) if compress else None
+        if args.compress and not compress:
+            print("receiver does not take compressed segments, sending them as they are")
+        connection = Connection(tcp_sock, address, (SEQ + 2 + early) & SEQ_MASK, cc, sack, batch, mss, args.probe,
+                                compressor)
+        with open(args.input, 'rb') as f:
+            try:
+                if stripe:
+                    f.seek(stripe[1])
+                elif early:  # the receiver has these bytes from the SYN
+                    f.seek(early)
+                connection.run(f, stripe[2] if stripe else None)
+                print("Finished transferring")
+                close(tcp_sock, address, cc)
+            except KeyboardInterrupt:
+                print("Keyboard Interrupt, exiting and closing connections.")
+                close(tcp_sock, address, cc)
+            except ConnectionRefusedError:
+                print("Receiver closed the connection.")
+                tcp_sock.close()
+    else:
+        print("Server rejected the connection.")
+
+    end_time = time.time()
+    report(start_timestamp, timestamp(), end_time - start_time, PACKET_COUNT, BYTE_COUNT, cc.losses, compressor)
+    return PACKET_COUNT, BYTE_COUNT, cc.losses
+
+
+def report(start_timestamp, end_timestamp, elapsed, packets, byte_count, losses, compressor=None):
+    total_bwidth = byte_count / elapsed
+    print(f"Start Time: {start_timestamp}\nEnd Time: {end_timestamp}\nTotal Time: {elapsed}")
+    print(f"Total Packets Sent (Including Retransmits): {packets}")
+    print(f"Total Packets Lost: {losses}")
+    print(f"Total Bandwidth Achieved: {total_bwidth}")
+    final_stats_logger.write(f"Start Time: {start_timestamp}\nEnd Time: {end_timestamp}\nTotal Time: {elapsed}")
+    final_stats_logger.write(f"Total Packets Sent (Including Retransmits): {packets}")
+    final_stats_logger.write(f"Total Packets Lost: {losses}")
+    final_stats_logger.write(f"Total Bandwidth Achieved: {total_bwidth}")
+    if compressor:
+        print(f"Total Bytes Compressed: {compressor.raw} file bytes sent as {compressor.sent}")
+        final_stats_logger.write(f"Total Bytes Compressed: {compressor.raw} file bytes sent as {compressor.sent}")
+
+
+# stream number `index` of a striped transfer, in a forked worker process
+def stream(index, stripe):
+    global SEQ
+    SEQ = random.getrandbits(32)  # random is reseeded after the fork, every stream gets its own ISN
+    open_logs(f"_stream{index}")
+    try:
+        return transfer(stripe)
+    finally:
+        close_logs()
+
+
+streams = max(1, args.streams)
+if streams > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+    print("--streams needs the fork start method, sending over one connection")
+    streams = 1
+if streams > 1 and not os.path.isfile(args.input):
+    print("--streams needs a regular file to cut into ranges, sending over one connection")
+    streams = 1
+if streams > 1:
+    # cut the file into one byte range per stream, each stream connects on its own and the
+    # receiver writes its range straight into place in the shared output file
+    file_size = os.path.getsize(args.input)
+    length = max(1, -(-file_size // streams))
+    transfer_id = random.getrandbits(64)
+    stripes = [(transfer_id, offset, min(length, file_size - offset), file_size)
+               for offset in range(0, file_size, length)] or [(transfer_id, 0, 0, 0)]
+    start_time = time.time()
+    start_timestamp = timestamp()
+    with multiprocessing.get_context('fork').Pool(len(stripes), maxtasksperchild=1) as pool:
+        results = pool.starmap(stream, enumerate(stripes), chunksize=1)
+    print(f"All {len(stripes)} streams finished")
+    report(start_timestamp, timestamp(), time.time() - start_time, sum(r[0] for r in results),
+           sum(r[1] for r in results), sum(r[2] for r in results))
 else:
-    print("Server rejected the connection.")
-    kill_threads.set()
-
-end_time = time.time()
-end_timestamp = timestamp()
-total_bwidth = (PACKET_COUNT * BUFFER_SIZE) / (end_time - start_time)
-print(f"Start Time: {start_timestamp}\nEnd Time: {end_timestamp}\nTotal Time: {end_time - start_time}")
-print(f"Total Packets Sent (Including Retransmits): {PACKET_COUNT}")
-print(f"Total Packets Lost: {TIMEOUT_COUNT}")
-print(f"Total Bandwidth Achieved: {total_bwidth}")
-file_logging(f"Start Time: {start_timestamp}\nEnd Time: {end_timestamp}\nTotal Time: {end_time - start_time}", final_stats_file_path)
-file_logging(f"Total Packets Sent (Including Retransmits): {PACKET_COUNT}", final_stats_file_path)
-file_logging(f"Total Packets Lost: {TIMEOUT_COUNT}", final_stats_file_path)
-file_logging(f"Total Bandwidth Achieved: {total_bwidth}", final_stats_file_path)
\ No newline at end of file
+    transfer()
\ No newline at end of file
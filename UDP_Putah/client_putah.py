@@ -5,27 +5,25 @@
 import socket
 import argparse
 import zlib
-import struct
 import random
 import time
 import os
+import sys
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.codec import Header, PUTAH  # noqa: E402
+
 
 def timestamp():
     timestamp = time.time()
     return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S')
 
 
-def file_logging(msg):
-    write_file = open(log_file_path, 'a')
-    write_file.write(msg + '\n')
-    write_file.close()
-    print(msg)
-
-
 log_file = f"client_putah_{timestamp()}.log"
 log_file_path = os.path.abspath(os.path.join('.', log_file))
+logger = AsyncLogger(log_file_path, echo=True)
 
 # create argument parser
 parser = argparse.ArgumentParser()
@@ -77,10 +75,10 @@ def connect(conn_host, conn_port):
     # send the header to the server
     send(out_sock, first_handshake_header_p, server)
     in_header, in_data, in_address = receive(in_sock)
-    if in_header[6] and in_header[7] and (in_header[5] == seq + 1):
+    if in_header.ack and in_header.syn and (in_header.ack_seq == seq + 1):
         tcp_port = find_open_ports()
         second_handshake_header_p, second_handshake_header = header(tcp_port, conn_port, ''.encode(), seq,
-                                                                    ack_seq=in_header[5] + 1,
+                                                                    ack_seq=in_header.ack_seq + 1,
                                                                     ack=True)
         send(out_sock, second_handshake_header_p, server)
         # initialize the socket to use for the connection
@@ -91,7 +89,7 @@ def connect(conn_host, conn_port):
 
         in_sock.close()
         out_sock.close()
-        return tcp_sock, (server[0], in_header[0])
+        return tcp_sock, (server[0], in_header.sport)
     else:
         in_sock.close()
         out_sock.close()
@@ -110,7 +108,7 @@ def close(s, address, tries=0):
                 with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
                     send(s, close_header_p + data, address)
                 r_header, r_data, r_address = receive(s)
-                if r_header[6] and r_header[8]:
+                if r_header.ack and r_header.fin:
                     print("server responded to disconnect.")
                     s.close()
                 else:
@@ -127,34 +125,27 @@ def close(s, address, tries=0):
 
 def send(s, packet, address):
     s.sendto(packet, address)
-    header = packet[:27]
-    header = unpack_header(header)
-    file_logging(f"{header[0]} | {header[1]} | {msg_type(header)} | {header[2]} | {timestamp()}")
+    header = PUTAH.unpack(packet)
+    logger.log(header.sport, header.rport, msg_type(header), header.win)
 
 
 def receive(rec_sock, buffer=1024):
     r, r_address = rec_sock.recvfrom(buffer)
-    r_header = r[:27]
-    r_header = unpack_header(r_header)
-    data = r[27:]
-    file_logging(f"{r_header[0]} | {r_header[1]} | {msg_type(r_header)} | {r_header[2]} | {timestamp()}")
+    r_header, data = PUTAH.decode(r)
+    logger.log(r_header.sport, r_header.rport, msg_type(r_header), r_header.win)
     return r_header, data, r_address
 
 
 def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False):
-    # create the header ('struct format', 'sender port', 'receiver port', 'win',
+    # create the header ('sender port', 'receiver port', 'win',
     # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin')
     win = len(data)
     checksum = checksum_calc(data)
     if ack_seq == 0:
         ack_seq = seq
-    header_packed = struct.pack("!IIIIII???", sender_port, receiver_port, win, checksum, seq,
-                                ack_seq, ack, syn, fin)
-    return header_packed, unpack_header(header_packed)
-
-
-def unpack_header(header):
-    return struct.unpack("!IIIIII???", header)
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin)
+    return PUTAH.pack(fields), fields
 
 
 def find_open_ports():
@@ -165,15 +156,15 @@ def find_open_ports():
                 return p
 
 def msg_type(header):
-    if header[2] > 0:
+    if header.win > 0:
         return "DATA"
-    elif header[6] and header[7]:
+    elif header.ack and header.syn:
         return "ACK/SYN"
-    elif header[6]:
+    elif header.ack:
         return "ACK"
-    elif header[7]:
+    elif header.syn:
         return "SYN"
-    elif header[8]:
+    elif header.fin:
         return "FIN"
 
 
@@ -191,7 +182,7 @@ if tcp_sock:
             with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
                 send(s, ping_pong_header_p + data, address)
             r_header, r_data, r_address = receive(tcp_sock)
-            r_data = r_data.decode()
+            r_data = bytes(r_data).decode()
             ack_seq += 1
         except KeyboardInterrupt:
             print("Keyboard Interrupt, exiting and closing connections.")
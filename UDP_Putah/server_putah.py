@@ -6,24 +6,21 @@ import socket
 import threading
 import argparse
 import zlib
-import struct
 import os
+import sys
 import time
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.codec import Header, PUTAH  # noqa: E402
+
 
 def timestamp():
     timestamp = time.time()
     return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S')
 
 
-def file_logging(msg):
-    write_file = open(log_file_path, 'a')
-    write_file.write(msg + '\n')
-    write_file.close()
-    print(msg)
-
-
 class ClientThread(threading.Thread):
     def __init__(self, clientAddress, clientsocket):
         threading.Thread.__init__(self)
@@ -42,6 +39,7 @@ class ClientThread(threading.Thread):
 
 log_file = f"server_putah_{timestamp()}.log"
 log_file_path = os.path.abspath(os.path.join('.', log_file))
+logger = AsyncLogger(log_file_path, echo=True)
 
 # create argument parser
 parser = argparse.ArgumentParser()
@@ -84,33 +82,33 @@ def accept(sock):
     tcp_port = find_open_ports()
     m = ''
     data = m.encode()
-    if r_header[7] and not r_header[6] and not r_header[8]:  # initial welcome handshake received
-        accept_handshake_header_p, accept_handshake_header = header(tcp_port, r_address[1], data, r_header[4],
-                                         ack_seq=r_header[4] + 1, ack=True, syn=True)
+    if r_header.syn and not r_header.ack and not r_header.fin:  # initial welcome handshake received
+        accept_handshake_header_p, accept_handshake_header = header(tcp_port, r_address[1], data, r_header.seq,
+                                         ack_seq=r_header.seq + 1, ack=True, syn=True)
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            send(s, accept_handshake_header_p + data, (r_address[0], r_header[0]))
+            send(s, accept_handshake_header_p + data, (r_address[0], r_header.sport))
         return accept(sock)
-    elif not r_header[7] and r_header[6] and not r_header[8]:
-        print(f"Connection established with {(r_address[0], r_header[0])}")
+    elif not r_header.syn and r_header.ack and not r_header.fin:
+        print(f"Connection established with {(r_address[0], r_header.sport)}")
         tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         tcp_sock.bind((host, tcp_port))
         print(f"binding listener to {host}:{tcp_port}")
-        return tcp_sock, (r_address[0], r_header[0])
+        return tcp_sock, (r_address[0], r_header.sport)
     else:
         print("did not receive ack")
 
 
 def listen(sock, listen_seq=0):
     r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
-    send_port = r_header[0]
-    rec_port = r_header[1]
-    win = r_header[2]
-    checksum = r_header[3]
-    seq = r_header[4]
-    ack_seq = r_header[5]
-    ack = r_header[6]
-    syn = r_header[7]
-    fin = r_header[8]
+    send_port = r_header.sport
+    rec_port = r_header.rport
+    win = r_header.win
+    checksum = r_header.checksum
+    seq = r_header.seq
+    ack_seq = r_header.ack_seq
+    ack = r_header.ack
+    syn = r_header.syn
+    fin = r_header.fin
     rec_checksum = checksum_calc(r_data)
     print(f"checksum: {checksum} \nrec_checksum: {rec_checksum}")
     if checksum == rec_checksum:  # data received, not corrupted
@@ -118,7 +116,7 @@ def listen(sock, listen_seq=0):
             close(sock, (r_address[0], send_port), ack=True)
             print("Connection closed")
         elif ack and ack_seq > listen_seq:
-            r_message = r_data.decode()
+            r_message = bytes(r_data).decode()
             print(f"received: {r_message} from {r_address}")
             data = message.encode()
             reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=ack_seq + 1, ack=True)
@@ -148,7 +146,7 @@ def close(s, address, tries=0, ack=False):
             else:
                 try:
                     r_header, r_data, r_address = receive(s)
-                    if r_header[6] and r_header[8]:
+                    if r_header.ack and r_header.fin:
                         print("Client responded to disconnect.")
                         s.close()
                     else:
@@ -161,35 +159,28 @@ def close(s, address, tries=0, ack=False):
 
 def send(s, packet, address):
     s.sendto(packet, address)
-    header = packet[:27]
-    header = unpack_header(header)
-    file_logging(f"{header[0]} | {header[1]} | {msg_type(header)} | {header[2]} | {timestamp()}")
+    header = PUTAH.unpack(packet)
+    logger.log(header.sport, header.rport, msg_type(header), header.win)
 
 
 
 def receive(rec_sock, buffer=1024):
     r, r_address = rec_sock.recvfrom(buffer)
-    r_header = r[:27]
-    r_header = unpack_header(r_header)
-    data = r[27:]
-    file_logging(f"{r_header[0]} | {r_header[1]} | {msg_type(r_header)} | {r_header[2]} | {timestamp()}")
+    r_header, data = PUTAH.decode(r)
+    logger.log(r_header.sport, r_header.rport, msg_type(r_header), r_header.win)
     return r_header, data, r_address
 
 
 def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False):
-    # create the header ('struct format', 'sender port', 'receiver port', 'win',
+    # create the header ('sender port', 'receiver port', 'win',
     # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin')
     win = len(data)
     checksum = checksum_calc(data)
     if ack_seq == 0:
         ack_seq = seq
-    header_packed = struct.pack("!IIIIII???", sender_port, receiver_port, win, checksum, seq,
-                       ack_seq, ack, syn, fin)
-    return header_packed, unpack_header(header_packed)
-
-
-def unpack_header(header):
-    return struct.unpack("!IIIIII???", header)
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin)
+    return PUTAH.pack(fields), fields
 
 
 def find_open_ports():
@@ -201,15 +192,15 @@ def find_open_ports():
 
 
 def msg_type(header):
-    if header[2] > 0:
+    if header.win > 0:
         return "DATA"
-    elif header[6] and header[7]:
+    elif header.ack and header.syn:
         return "ACK/SYN"
-    elif header[6]:
+    elif header.ack:
         return "ACK"
-    elif header[7]:
+    elif header.syn:
         return "SYN"
-    elif header[8]:
+    elif header.fin:
         return "FIN"
 
 
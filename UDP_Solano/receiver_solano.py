@@ -1,31 +1,36 @@
 #! python3
 # receiver_solano.py
 # usage: python3 receiver_solano.py --ip XXXX.XXXX.XXXX.XXXX --port YYYY
-# --packet_loss_percentage X --round_trip_jitter Y --output output.txt
+# --packet_loss_percentage X --round_trip_jitter Y --output output.txt [--window N] [--fsync never/close/BYTES]
+# [--ack_every N --ack_delay S] [--workers N] [--demux] [--idle_timeout S]
 
 import socket
 import threading
 import argparse
+import heapq
+import itertools
 import zlib
-import struct
 import os
+import sys
 import time
 import random
+import select
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.ack import DelayedAck  # noqa: E402
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.output import OutputFile, fsync_policy  # noqa: E402
+from udp_common.reassembly import ReassemblyBuffer  # noqa: E402
+from udp_common.codec import Header, SOLANO  # noqa: E402
+from udp_common.workers import available as workers_available, run_workers, welcome_socket  # noqa: E402
+
 
 def timestamp():
     timestamp = time.time()
     return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S')
 
 
-def file_logging(msg):
-    write_file = open(log_file_path, 'a')
-    write_file.write(msg + '\n')
-    write_file.close()
-    # print(msg)
-
-
 class ClientThread(threading.Thread):
     def __init__(self, clientaddress, clientsocket, seq):
         threading.Thread.__init__(self)
@@ -36,24 +41,22 @@ class ClientThread(threading.Thread):
 
     def run(self):
         print("Connection from : ", self.caddress)
-        os.makedirs(os.path.abspath(os.path.join('.', 'out_files', str(self.caddress[1])
-                                                 )), exist_ok=True)
-        output_file = os.path.abspath(os.path.join('.', 'out_files', str(self.caddress[1]
-                                                                         ), args.output))
-        while self.csocket:
-            try:
-                data, self.seq = listen(self.csocket, listen_seq=self.seq)
-                with open(output_file, 'ab') as f:
-                    f.write(data)
-            except:
-                break
+        # every segment is written in place as it arrives, reassembly only tracks the gaps
+        output = open_output(self.caddress, self.seq)
+        reassembly = ReassemblyBuffer(self.seq, RECEIVE_WINDOW)
+        delayed = DelayedAck(args.ack_every, args.ack_delay)
+        try:
+            while self.csocket:
+                try:
+                    listen(self.csocket, reassembly, output, delayed)
+                except:
+                    break
+        finally:
+            output.close()
         print("Client at ", self.caddress, " disconnected...")
         self.csocket.close()
 
 
-log_file = f"receiver_solano_{timestamp()}.log"
-log_file_path = os.path.abspath(os.path.join('.', log_file))
-
 # create argument parser
 parser = argparse.ArgumentParser()
 
@@ -72,6 +75,27 @@ parser.add_argument('-j', '--round_trip_jitter', type=float, default=0.5)
 # add the required output argument
 parser.add_argument('-o', '--output', type=str, required=True)
 
+# add the window argument, the number of segments buffered ahead of a gap (1 = go-back-n)
+parser.add_argument('-w', '--window', type=int, default=64)
+
+# add the ack_every argument, ACK every Nth in order segment (1 = every segment)
+parser.add_argument('--ack_every', type=int, default=1)
+
+# add the ack_delay argument, the longest an ACK is held back in seconds
+parser.add_argument('--ack_delay', type=float, default=0.01)
+
+# add the fsync argument, when the output is flushed to disk: never, close or every BYTES written
+parser.add_argument('--fsync', type=fsync_policy, default='close')
+
+# add the workers argument, processes sharing the port with SO_REUSEPORT, each owns its connections
+parser.add_argument('--workers', type=int, default=1)
+
+# add the demux argument, serve every connection from the listening socket on one thread
+parser.add_argument('--demux', action='store_true')
+
+# add the idle_timeout argument, seconds a --demux connection may stay silent before it is dropped, 0 keeps it
+parser.add_argument('--idle_timeout', type=float, default=60)
+
 # parse the arguments
 args = parser.parse_args()
 
@@ -90,13 +114,79 @@ packet_loss = args.packet_loss_percentage
 # receive 16 bytes each time
 BUFFER_SIZE = 1000
 
-# create socket to listen on
-s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# how far ahead of the next expected byte a segment may start and still be buffered
+RECEIVE_WINDOW = max(1, args.window) * (BUFFER_SIZE - SOLANO.size)
+
+
+class Connection:
+    # One client under --demux. Its datagrams arrive on the listening socket like everyone
+    # else's and demux() hands them to datagram(), handshake, data and FIN alike, so a client
+    # costs an entry in `connections` instead of a socket, a port and a thread.
+    def __init__(self, sock, address, conn_id, syn_header):
+        self.sock = sock  # the listening socket, every reply goes out of it to `address`
+        self.address = address  # the client's (ip, port)
+        self.conn_id = conn_id  # sent as the port of the ACK/SYN, the client's receiver port from then on
+        self.syn_seq = syn_header.seq
+        # data starts right after the SYN and the final handshake ACK
+        self.reassembly = ReassemblyBuffer((self.syn_seq + 2) & SEQ_MASK, RECEIVE_WINDOW)
+        self.delayed = DelayedAck(args.ack_every, args.ack_delay)
+        self.output = None
+        self.last_seen = time.monotonic()  # when the client last sent anything
+
+    # answer the SYN, again if the client repeats it
+    def accept_handshake(self):
+        data = ''.encode()
+        accept_handshake_header_p, accept_handshake_header = header(self.conn_id, self.address[1], data,
+                                                                    self.syn_seq, ack_seq=self.syn_seq + 1,
+                                                                    ack=True, syn=True)
+        send(self.sock, accept_handshake_header_p + data, self.address)
+
+    def establish(self):
+        if self.output:
+            return
+        handshakes.pop(self.address, None)
+        print(f"Connection established with {self.address}")
+        self.output = open_output(self.address, self.reassembly.expected)
+
+    # handle one datagram from the client, returns False once the connection is closed
+    def datagram(self, r_header, r_data):
+        # the first data segment also completes the handshake if its ACK went missing
+        self.establish()
+        if r_header.win == SOLANO.size and not r_header.fin:  # the handshake ACK, or a repeat of it
+            return True
+        if r_header.fin and r_header.checksum == checksum_calc(r_data):
+            print(f"Disconnecting from: {self.address}")
+            finish(self.sock, self.address, self.conn_id)
+            return False
+        on_segment(self.sock, r_header, r_data, self.reassembly, self.output, self.delayed, address=self.address)
+        return True
+
+    # the ACK delay ran out before enough segments arrived
+    def flush_ack(self):
+        rec_port, send_port, seq = self.delayed.pending
+        self.delayed.clear()
+        acknowledge(self.sock, self.reassembly, rec_port, send_port, seq, address=self.address)
+
+    def close(self):
+        handshakes.pop(self.address, None)
+        if self.output:
+            self.output.close()
+        print("Client at ", self.address, " disconnected...")
+
+
+def open_logs(name=''):
+    global logger
+    log_file = f"receiver_solano_{timestamp()}{name}.log"
+    log_file_path = os.path.abspath(os.path.join('.', log_file))
+    logger = AsyncLogger(log_file_path)
 
-# bind the socket to the SERVER_HOST and SERVER_PORT
-s.bind((host, port))
 
-SEQ = 0
+# the parent of --workers only forks, every worker opens a log of its own
+WORKERS = args.workers if args.workers > 1 and workers_available() else 1
+if args.workers > 1 and WORKERS == 1:
+    print("--workers needs SO_REUSEPORT and fork, serving from one process")
+if WORKERS == 1:
+    open_logs()
 
 
 def round_trip_jitter():
@@ -119,57 +209,220 @@ def checksum_calc(data):
     return checksum
 
 
-def accept(sock, tcp=None):
-    r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
-    tcp_port = 0
+# handshakes that got their ACK/SYN and wait for the client's ACK, keyed by the client's (ip, port),
+# so clients that connect at the same time do not mix
+pending = {}
+
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+
+
+# the output file of a connection, opened once its handshake is done
+def open_output(address, base):
+    os.makedirs(os.path.abspath(os.path.join('.', 'out_files', str(address[1])
+                                             )), exist_ok=True)
+    output_file = os.path.abspath(os.path.join('.', 'out_files', str(address[1]
+                                                                     ), args.output))
+    return OutputFile(output_file, base, fsync=args.fsync)
+
+
+def accept(sock):
+    while True:
+        readable, _, _ = select.select([sock] + [waiting[0] for waiting in pending.values()], [], [])
+        for address, (tcp, syn_seq) in list(pending.items()):
+            if tcp in readable:  # data arrived before the ACK, the ACK went missing
+                print(f"Connection established with {address}")
+                del pending[address]
+                tcp.connect(address)
+                # data starts right after the SYN and the final handshake ACK
+                return tcp, address, (syn_seq + 2) & SEQ_MASK
+        if sock not in readable:
+            continue
+        # the emulated jitter reads again after a drop, that must not block the other handshakes
+        sock.setblocking(False)
+        try:
+            r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
+        except BlockingIOError:
+            continue
+        tcp_port = 0
+        data = ''.encode()
+        address = (r_address[0], r_header.sport)
+        if r_header.syn and not r_header.ack and not r_header.fin:  # initial welcome handshake received
+            if address in pending:  # the client repeated its SYN, answer from the socket that is already waiting
+                tcp_sock = pending[address][0]
+            else:
+                tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                tcp_sock.bind((host, tcp_port))
+                print(f"binding listener to {host}:{tcp_sock.getsockname()[1]}")
+            pending[address] = (tcp_sock, r_header.seq)
+            accept_handshake_header_p, accept_handshake_header = header(tcp_sock.getsockname()[1],
+                                                                        r_address[1], data, r_header.seq,
+                                                                        ack_seq=r_header.seq + 1, ack=True, syn=True)
+            # the ACK/SYN already comes from the connection socket the client will talk to
+            send(tcp_sock, accept_handshake_header_p + data, address)
+        elif not r_header.syn and r_header.ack and not r_header.fin and address in pending:
+            print(f"Connection established with {address}")
+            tcp, syn_seq = pending.pop(address)
+            # data, ACK and FIN traffic of this connection all go through the connected socket
+            tcp.connect(address)
+            return tcp, address, r_header.ack_seq
+        else:
+            print("did not receive handshake")
+
+
+# connections under --demux by the client's (ip, port) and the id handed out in the ACK/SYN, which
+# the client puts in the receiver port of everything it sends after its SYN
+connections = {}
+
+# the same connections by the client's (ip, port) until their handshake is done
+handshakes = {}
+
+# the last connection id handed out
+last_id = 0
+
+# replies the emulated delay holds back under --demux, a heap of (due, order, socket, packet, address)
+# the one thread serving every connection sends them once they are due instead of sleeping
+held = []
+held_order = itertools.count()
+
+
+# a connection id for a client, never the listening port so a SYN is told apart from the rest
+def connection_id(address):
+    global last_id
+    while True:
+        last_id = last_id % 0xFFFF + 1
+        if last_id != port and (*address, last_id) not in connections:
+            return last_id
+
+
+# answer a FIN with the FIN/ACK and forget the connection, no need to wait for a response
+def finish(sock, address, conn_id):
     data = ''.encode()
-    if r_header[7] and not r_header[6] and not r_header[8]:  # initial welcome handshake received
-        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        tcp_sock.bind((host, tcp_port))
-        print(f"binding listener to {host}:{tcp_sock.getsockname()[1]}")
-        accept_handshake_header_p, accept_handshake_header = header(tcp_sock.getsockname()[1],
-                                                                    r_address[1], data, r_header[4],
-                                                                    ack_seq=r_header[4] + 1, ack=True, syn=True)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            send(s, accept_handshake_header_p + data, (r_address[0], r_header[0]))
-        return accept(sock, tcp_sock)
-    elif not r_header[7] and r_header[6] and not r_header[8]:
-        print(f"Connection established with {(r_address[0], r_header[0])}")
-        return tcp, (r_address[0], r_header[0])
-    else:
-        print("did not receive handshake")
-
-
-def listen(sock, listen_seq=0):
-    r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
-    send_port = r_header[0]
-    rec_port = r_header[1]
-    win = r_header[2]
-    checksum = r_header[3]
-    seq = r_header[4]
-    ack_seq = r_header[5]
-    ack = r_header[6]
-    syn = r_header[7]
-    fin = r_header[8]
+    close_header_p, close_header = header(conn_id, address[1], data, 0, ack=True, fin=True)
+    send(sock, close_header_p + data, address)
+
+
+# serve every connection from the listening socket: look each datagram up in `connections` and
+# hand it over, and send the ACKs that were held back once they are due
+def demux(sock):
+    delaying = set()  # connections holding back an ACK
+    # idle connections are looked for a few times per --idle_timeout
+    sweep_every = args.idle_timeout / 4 if args.idle_timeout > 0 else None
+    next_sweep = time.monotonic() + sweep_every if sweep_every else None
+    try:
+        while True:
+            now = time.monotonic()
+            while held and held[0][0] <= now:
+                due, order, s, packet, address = heapq.heappop(held)
+                put(s, packet, address)
+            for connection in list(delaying):
+                if connection.delayed.timeout() == 0:
+                    delaying.discard(connection)
+                    connection.flush_ack()
+            if next_sweep is not None and now >= next_sweep:
+                forget_idle(now, delaying)
+                next_sweep = now + sweep_every
+            timeouts = [connection.delayed.timeout() for connection in delaying]
+            if held:
+                timeouts.append(held[0][0] - now)
+            if connections and next_sweep is not None:
+                timeouts.append(next_sweep - now)
+            timeout = min(timeouts, default=None)
+            sock.settimeout(None if timeout is None else max(timeout, 0.0001))
+            try:
+                r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            address = (r_address[0], r_header.sport)
+            if r_header.syn and not r_header.ack and not r_header.fin:  # initial welcome handshake received
+                connection = handshakes.get(address)
+                if connection is None:  # not a repeated SYN
+                    connection = Connection(sock, address, connection_id(address), r_header)
+                    connections[(*address, connection.conn_id)] = handshakes[address] = connection
+                connection.last_seen = time.monotonic()
+                connection.accept_handshake()
+                continue
+            connection = connections.get((*address, r_header.rport))
+            if connection is not None:
+                connection.last_seen = time.monotonic()
+            if connection is None and r_header.fin:  # its FIN/ACK went missing, the connection is gone
+                finish(sock, address, r_header.rport)
+            elif connection is None:
+                print("did not receive handshake")
+            elif not connection.datagram(r_header, r_data):
+                del connections[(*address, connection.conn_id)]
+                delaying.discard(connection)
+                connection.close()
+            elif connection.delayed.pending:
+                delaying.add(connection)
+            else:
+                delaying.discard(connection)
+    finally:
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+
+
+# drop the connections under --demux whose client sent nothing for --idle_timeout seconds, a
+# half-open handshake or a client that went away without a FIN, and close their output
+def forget_idle(now, delaying):
+    for key, connection in list(connections.items()):
+        if now - connection.last_seen > args.idle_timeout:
+            print(f"{connection.address} silent for {args.idle_timeout} seconds, dropping the connection")
+            del connections[key]
+            delaying.discard(connection)
+            connection.close()
+
+
+def listen(sock, reassembly, output, delayed=None):
+    # wake up in time to send an ACK that was held back
+    timeout = delayed.timeout() if delayed else None
+    sock.settimeout(None if timeout is None else max(timeout, 0.0001))
+    try:
+        r_header, r_data, r_address = receive(sock, buffer=BUFFER_SIZE)
+    except socket.timeout:
+        rec_port, send_port, seq = delayed.pending
+        delayed.clear()
+        acknowledge(sock, reassembly, rec_port, send_port, seq)
+        return
+    if r_header.fin and r_header.checksum == checksum_calc(r_data):
+        close(sock, (r_address[0], r_header.sport), ack=True)
+        return
+    on_segment(sock, r_header, r_data, reassembly, output, delayed)
+
+
+# write a data segment and ACK it, or ask for it again if it arrived corrupted
+# `address` is the client's when `sock` is the listening socket of --demux
+def on_segment(sock, r_header, r_data, reassembly, output, delayed=None, address=None):
+    send_port = r_header.sport
+    rec_port = r_header.rport
+    checksum = r_header.checksum
+    seq = r_header.seq
     rec_checksum = checksum_calc(r_data)
     # print(f"checksum: {checksum} \nrec_checksum: {rec_checksum}")
     if checksum == rec_checksum:  # data received, not corrupted
-        if fin:
-            close(sock, (r_address[0], send_port), ack=True)
-        elif ack and ack_seq != listen_seq:
-            r_message = r_data.decode()
-            # print(f"received: {r_message} from {r_address}")
-            data = ''.encode()
-            reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=listen_seq + win, ack=True)
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                send(s, reply_header_p + data, (r_address[0], send_port))
-        return r_data, listen_seq + win
+        new, ready = reassembly.track(seq, len(r_data))
+        if new:
+            output.write(seq, r_data)
+        # a segment out of order, or one that closed a gap, is ACKed right away
+        in_order = ready == 1 and not reassembly.segments
+        if delayed is None or delayed.on_segment(in_order, (rec_port, send_port, seq)):
+            acknowledge(sock, reassembly, rec_port, send_port, seq, address)
     else:  # data received is corrupted, request the message again
         print("data corrupted or not received")
+        if delayed:  # the request carries the cumulative ACK as well
+            delayed.clear()
         data = ''.encode()
-        reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=listen_seq, ack=True)
-        send(sock, reply_header_p + data, (r_address[0], send_port))
-        return data, listen_seq
+        reply_header_p, reply_header = header(rec_port, send_port, data, reassembly.expected,
+                                              ack_seq=reassembly.expected, ack=True)
+        send(sock, reply_header_p + data, address)
+
+
+def acknowledge(sock, reassembly, rec_port, send_port, seq, address=None):
+    # ack_seq is the next byte expected, seq names the segment this ACK answers
+    data = ''.encode()
+    reply_header_p, reply_header = header(rec_port, send_port, data, seq, ack_seq=reassembly.expected, ack=True)
+    send(sock, reply_header_p + data, address)
 
 
 def close(sock, address, tries=0, ack=False):
@@ -180,17 +433,16 @@ def close(sock, address, tries=0, ack=False):
             data = ''.encode()
             close_header_p, close_header = header(sock.getsockname()[1], address[1], data,
                                                   0, ack=ack, fin=True)
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                send(s, close_header_p + data, address)
+            send(sock, close_header_p + data)
             if ack:
                 # sent acknowledgment, no need to wait for response
-                s.close()
+                sock.close()
             else:
                 try:
                     r_header, r_data, r_address = receive(sock)
-                    if r_header[6] and r_header[8]:
+                    if r_header.ack and r_header.fin:
                         print("Client responded to disconnect.")
-                        s.close()
+                        sock.close()
                     else:
                         close(sock, address, tries + 1)
                 except:
@@ -199,64 +451,89 @@ def close(sock, address, tries=0, ack=False):
             sock.close()
 
 
-def send(s, packet, address):
+# send on a connected socket, or to address while the handshake is still in progress
+def send(s, packet, address=None):
     sleepy_time = ploss()
+    if sleepy_time and args.demux:  # one thread serves every connection, hold the reply instead of sleeping
+        heapq.heappush(held, (time.monotonic() + sleepy_time, next(held_order), s, packet, address))
+        return
     time.sleep(sleepy_time)  # sleep the receiver for the value of packet loss percentage in seconds
-    s.sendto(packet, address)
-    header = packet[:27]
-    header = unpack_header(header)
-    file_logging(f"{header[0]} | {header[1]} | {msg_type(header)} | {header[2]} | {timestamp()}")
+    put(s, packet, address)
+
+
+# send a reply right away
+def put(s, packet, address=None):
+    if address:
+        s.sendto(packet, address)
+    else:
+        s.send(packet)
+    header = SOLANO.unpack(packet)
+    logger.log(header.sport, header.rport, msg_type(header), header.win)
 
 
 def receive(rec_sock, buffer=BUFFER_SIZE):
     r, r_address = rec_sock.recvfrom(buffer)
     if not round_trip_jitter():  # if there is no jitter continue
-        r_header = r[:27]
-        r_header = unpack_header(r_header)
-        data = r[27:]
-        file_logging(f"{r_header[0]} | {r_header[1]} | {msg_type(r_header)} | {r_header[2]} | {timestamp()}")
+        r_header, data = SOLANO.decode(r)
+        logger.log(r_header.sport, r_header.rport, msg_type(r_header), r_header.win)
         return r_header, data, r_address
     else:  # there was jitter, pretend like we did not receive the package
         return receive(rec_sock, buffer)
 
 
 def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False):
-    # create the header ('struct format', 'sender port', 'receiver port', 'win',
+    # create the header ('sender port', 'receiver port', 'win',
     # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin')
-    win = len(data) + 27
+    win = len(data) + SOLANO.size
     checksum = checksum_calc(data)
     if ack_seq == 0:
         ack_seq = seq
-    header_packed = struct.pack("!IIIIII???", sender_port, receiver_port, win, checksum, seq,
-                                ack_seq, ack, syn, fin)
-    return header_packed, unpack_header(header_packed)
-
-
-def unpack_header(header):
-    return struct.unpack("!IIIIII???", header)
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin)
+    return SOLANO.pack(fields), fields
 
 
 def msg_type(header):
-    if header[2] > 27:
+    if header.win > SOLANO.size:
         return "DATA"
-    elif header[6] and header[7]:
+    elif header.ack and header.syn:
         return "ACK/SYN"
-    elif header[6]:
+    elif header.ack:
         return "ACK"
-    elif header[7]:
+    elif header.syn:
         return "SYN"
-    elif header[8]:
+    elif header.fin:
         return "FIN"
 
 
-while True:
-    try:
-        print("Listening as " + host + ":" + str(port))
-        client_socket, address = accept(s)
-        ClientThread(address, client_socket, SEQ).start()
-    except KeyboardInterrupt:
-        print("Keyboard Interrupt, closing server.")
-        break
-
-# close the server socket
-s.close()
+# accept connections until interrupted, `index` is the worker's number under --workers
+def serve(index=None):
+    if index is not None:
+        open_logs(f"_worker{index}")
+    # create socket to listen on, bound to the SERVER_HOST and SERVER_PORT
+    s = welcome_socket(host, port, reuse_port=index is not None)
+    listening = "Listening as " + host + ":" + str(port) + ("" if index is None else f" (worker {index})")
+    while True:
+        try:
+            print(listening)
+            if args.demux:  # runs until interrupted
+                demux(s)
+            client_socket, address, seq = accept(s)
+            ClientThread(address, client_socket, seq).start()
+        except KeyboardInterrupt:
+            print("Keyboard Interrupt, closing server.")
+            break
+
+    # close the server socket
+    s.close()
+    if index is not None:  # a worker does not wait for its threads on exit, nor close its log
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join()
+        logger.close()
+
+
+if WORKERS > 1:
+    run_workers(WORKERS, serve)
+else:
+    serve()
@@ -1,16 +1,23 @@
 #! python3
 # sender_solano.py
 # usage: python3 sender_solano.py --dest_ip XXXX.XXXX.XXXX.XXXX --dest_port YYYY --input input.txt
+# [--window N --mode gbn/sr]
 
 import socket
 import argparse
 import zlib
-import struct
 import random
 import time
 import os
+import sys
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.logger import AsyncLogger  # noqa: E402
+from udp_common.rtt import RttEstimator  # noqa: E402
+from udp_common.codec import Header, SOLANO  # noqa: E402
+from udp_common.segments import SegmentReader, send_segment  # noqa: E402
+
 
 # port the client will use
 client_port = 0
@@ -22,6 +29,10 @@ parser.add_argument('-s', '--dest_ip', type=str, required=True)
 parser.add_argument('-p', '--dest_port', type=int, required=True)
 # add the required input argument
 parser.add_argument('-i', '--input', type=str, required=True)
+# add the window argument, the number of segments allowed in flight
+parser.add_argument('-w', '--window', type=int, default=1)
+# add the mode argument, go-back-n or selective repeat retransmission
+parser.add_argument('-m', '--mode', type=str, choices=['gbn', 'sr'], default='gbn')
 # parse the arguments
 args = parser.parse_args()
 # ip address or hostname of the hose
@@ -34,10 +45,20 @@ BUFFER_SIZE = 1000
 message = "Ping"
 # Sequence to use for the file transfer
 SEQ = random.getrandbits(32)
-# set the initial TIMEOUT_INTERVAL
+# set the initial TIMEOUT_INTERVAL, used until the first RTT sample
 TIMEOUT_INTERVAL = 1
+# the shortest retransmission timeout
+MIN_TIMEOUT_INTERVAL = .01
+# the longest a retransmitted segment waits for its ACK
+MAX_TIMEOUT_INTERVAL = 8
+# smoothed RTT and RTT variance, they set the retransmission timeout
+rtt = RttEstimator(TIMEOUT_INTERVAL, MIN_TIMEOUT_INTERVAL, MAX_TIMEOUT_INTERVAL)
 # the total number of timeouts for this session
 TIMEOUT_COUNT = 0
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+# timeouts in a row a segment may hit before the sender gives up
+MAX_RETRIES = 3
 
 
 def timestamp():
@@ -45,28 +66,16 @@ def timestamp():
     return datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S')
 
 
-def file_logging(msg):
-    write_file = open(log_file_path, 'a')
-    write_file.write(msg + '\n')
-    write_file.close()
-    print(msg)
-
-
 log_file = f"sender_solano_{timestamp()}.log"
 log_file_path = os.path.abspath(os.path.join('.', log_file))
+logger = AsyncLogger(log_file_path, echo=True)
 
 
-# calculate a new timeout interval
-def timeout_calc(sec):
-    global TIMEOUT_INTERVAL
+# count a timeout, timed out packets are never used as RTT samples
+def count_timeout():
     global TIMEOUT_COUNT
     TIMEOUT_COUNT += 1
-    t = .5
-    print(f"TIMEOUT INTERVAL = {TIMEOUT_INTERVAL}\n TIMEOUT COUNT = {TIMEOUT_COUNT}")
-    if TIMEOUT_COUNT == 1:
-        TIMEOUT_INTERVAL = sec
-    else:
-        TIMEOUT_INTERVAL = 1-t*TIMEOUT_INTERVAL + t*sec
+    print(f"{rtt}\n TIMEOUT COUNT = {TIMEOUT_COUNT}")
 
 
 # checksum calculator for ensuring our data is being transferred
@@ -77,37 +86,30 @@ def checksum_calc(data):
 
 def connect(conn_host, conn_port):
     server = (conn_host, conn_port)
-    # initialize the socket to use for incoming
-    in_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # initialize the socket to use for outgoing
-    out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # bind the incoming socket to listen for connections from the server
-    in_sock.bind(('localhost', client_port))
+    # initialize the socket used for the handshake and the whole connection
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # bind the socket to listen for the server's responses
+    tcp_sock.bind(('localhost', client_port))
     print(f"Establishing connection to {server}")
     # create the header
-    first_handshake_header_p, first_handshake_header = header(in_sock.getsockname()[1], conn_port,
+    first_handshake_header_p, first_handshake_header = header(tcp_sock.getsockname()[1], conn_port,
                                                               ''.encode(), SEQ, syn=True)
     # send the header to the server
-    in_header, in_data, in_address = send_and_wait_respond(out_sock, first_handshake_header_p,
-                                                           server, in_sock)
-    if in_header[6] and in_header[7] and (in_header[5] == SEQ + 1):
-        tcp_port = client_port
-        # initialize the socket to use for the connection
-        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # bind the incoming socket to listen for connections from the server
-        tcp_sock.bind(('localhost', tcp_port))
-        second_handshake_header_p, second_handshake_header = header(tcp_sock.getsockname()[1], conn_port, ''.encode(), SEQ,
-                                                                    ack_seq=in_header[5] + 1,
+    in_header, in_data, in_address = send_and_wait_respond(tcp_sock, first_handshake_header_p, server)
+    if in_header.ack and in_header.syn and (in_header.ack_seq == SEQ + 1):
+        # the ACK already names the connection's port, a receiver with one socket for all clients
+        # (--demux) sends from its listening port and tells connections apart by it
+        second_handshake_header_p, second_handshake_header = header(tcp_sock.getsockname()[1], in_header.sport,
+                                                                    ''.encode(), SEQ,
+                                                                    ack_seq=in_header.ack_seq + 1,
                                                                     ack=True)
-        send(out_sock, second_handshake_header_p, server)
-        print(f"binding listener socket to localhost:{tcp_port}")
-
-        in_sock.close()
-        out_sock.close()
-        return tcp_sock, (server[0], in_header[0])
+        send(tcp_sock, second_handshake_header_p, server)
+        # connect the socket to where the ACK/SYN came from, data, ACK and FIN traffic all use it
+        tcp_sock.connect(in_address)
+        print(f"connected socket localhost:{tcp_sock.getsockname()[1]} to {in_address}")
+        return tcp_sock, (server[0], in_header.sport)
     else:
-        in_sock.close()
-        out_sock.close()
+        tcp_sock.close()
         return None, None
 
 
@@ -118,10 +120,8 @@ def close(sock, address):
         close_header_p, close_header = header(sock.getsockname()[1], address[1], data,
                                               0, fin=True)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                r_header, r_data, r_address = send_and_wait_respond(s, close_header_p + data,
-                                                                    address, sock)
-            if r_header[6] and r_header[8]:
+            r_header, r_data, r_address = send_and_wait_respond(sock, close_header_p + data)
+            if r_header.ack and r_header.fin:
                 print("server responded to disconnect.")
                 sock.close()
             else:
@@ -134,103 +134,218 @@ def close(sock, address):
         pass
 
 
-def send(s, packet, address):
-    s.sendto(packet, address)
-    header = packet[:27]
-    header = unpack_header(header)
-    file_logging(f"{header[0]} | {header[1]} | {msg_type(header)} | {header[2]} | {timestamp()}")
+# send on a connected socket, or to address while the handshake is still in progress
+# a payload goes out behind the packet without copying the two into one buffer
+def send(s, packet, address=None, payload=None):
+    if payload is not None:
+        send_segment(s, packet, payload, address)
+    elif address:
+        s.sendto(packet, address)
+    else:
+        s.send(packet)
+    header = SOLANO.unpack(packet)
+    logger.log(header.sport, header.rport, msg_type(header), header.win)
 
 
-def send_and_wait_respond(s, packet, address, re_sock):
+def send_and_wait_respond(s, packet, address=None):
     for i in range(0, 3):
-        re_sock.settimeout(TIMEOUT_INTERVAL)
+        s.settimeout(rtt.rto)
         t1 = time.time()
         try:
             send(s, packet, address)
-            s_header = packet[:27]
-            s_header = unpack_header(s_header)
-            r_header, r_data, r_address = receive(re_sock)
-            if r_header[5] == s_header[5] and not r_header[8]:  # data not received by receiver, it requested the same packet
-                return send_and_wait_respond(s, packet, address, re_sock)
+            s_header = SOLANO.unpack(packet)
+            r_header, r_data, r_address = receive(s)
+            if i == 0:  # Karn's rule, the reply to a resent packet may answer either copy
+                rtt.sample(time.time() - t1)
+            if r_header.ack_seq == s_header.ack_seq and not r_header.fin:  # data not received by receiver, it requested the same packet
+                return send_and_wait_respond(s, packet, address)
             else:
                 return r_header, r_data, r_address
         except KeyboardInterrupt:
-            close(re_sock, address)
+            close(s, address or s.getpeername())
             break
+        except ConnectionRefusedError:  # the receiver's socket is gone, retrying will not help
+            print("connection refused, giving up")
+            s.close()
+            return None
         except:  # timed out try sending the same packet again
             print(f"Timed out {i+1} times.")
-            t2 = time.time()
-            timeout_calc(t2-t1)
+            count_timeout()
+            rtt.backoff()
     print("timed out, giving up")
-    close(re_sock, address)
+    close(s, address or s.getpeername())
 
 
 def receive(rec_sock, buffer=BUFFER_SIZE):
     r, r_address = rec_sock.recvfrom(buffer)
-    r_header = r[:27]
-    r_header = unpack_header(r_header)
-    data = r[27:]
-    file_logging(f"{r_header[0]} | {r_header[1]} | {msg_type(r_header)} | {r_header[2]} | {timestamp()}")
+    r_header, data = SOLANO.decode(r)
+    logger.log(r_header.sport, r_header.rport, msg_type(r_header), r_header.win)
     return r_header, data, r_address
 
 
 
 def header(sender_port, receiver_port, data, seq, ack_seq=0, ack=False, syn=False, fin=False):
-    # create the header ('struct format', 'sender port', 'receiver port', 'win',
+    # create the header ('sender port', 'receiver port', 'win',
     # 'checksum', 'seq', 'ack seq', 'ack', 'syn', 'fin')
-    win = len(data)+27
+    win = len(data)+SOLANO.size
     checksum = checksum_calc(data)
     if ack_seq == 0:
         ack_seq = seq
-    header_packed = struct.pack("!IIIIII???", sender_port, receiver_port, win, checksum, seq,
-                                ack_seq, ack, syn, fin)
-    return header_packed, unpack_header(header_packed)
-
-
-def unpack_header(header):
-    return struct.unpack("!IIIIII???", header)
+    fields = Header(sender_port, receiver_port, win, checksum, seq,
+                    ack_seq, ack, syn, fin)
+    return SOLANO.pack(fields), fields
 
 
 def msg_type(header):
-    if header[2] > 27:
+    if header.win > SOLANO.size:
         return "DATA"
-    elif header[6] and header[7]:
+    elif header.ack and header.syn:
         return "ACK/SYN"
-    elif header[6]:
+    elif header.ack:
         return "ACK"
-    elif header[7]:
+    elif header.syn:
         return "SYN"
-    elif header[8]:
+    elif header.fin:
         return "FIN"
 
 
+class Segment:
+    __slots__ = ('data', 'sent', 'retries', 'acked', 'resent')
+
+    def __init__(self, data):
+        self.data = data
+        self.sent = 0.0
+        self.retries = 0
+        self.acked = False
+        self.resent = False  # sent more than once, its ACKs are no RTT samples
+
+
+class WindowSender:
+    # Keeps up to `window` segments in flight. Segments are numbered by byte offset from `base`,
+    # ACKs carry the next expected sequence number in ack_seq and the segment they answer in seq.
+    # 'gbn' retransmits everything outstanding when the oldest segment times out, 'sr' only
+    # retransmits the segment whose timer expired and also uses the per segment ACKs.
+    def __init__(self, sock, address, base, window=1, mode='gbn'):
+        self.sock = sock
+        self.address = address
+        self.base = base
+        self.window = max(1, window)
+        self.mode = mode
+        self.segments = {}  # offset -> Segment, for every segment that is not cumulatively ACKed
+        self.snd_una = 0  # oldest unacknowledged offset
+        self.next_offset = 0  # offset of the next new segment
+        self.reader = None  # SegmentReader of the input file
+
+    def wire_seq(self, offset):
+        return (self.base + offset) & SEQ_MASK
+
+    # offset of a sequence number from the receiver, None if it is behind the window
+    def offset_of(self, seq):
+        distance = (seq - self.wire_seq(self.snd_una)) & SEQ_MASK
+        if distance > self.next_offset - self.snd_una:
+            return None
+        return self.snd_una + distance
+
+    def transmit(self, offset):
+        segment = self.segments[offset]
+        data = segment.data
+        ping_pong_header_p, ping_pong_header = header(self.sock.getsockname()[1], self.address[1], data,
+                                                      self.wire_seq(offset),
+                                                      ack_seq=self.wire_seq(offset + len(data)), ack=True)
+        send(self.sock, ping_pong_header_p, payload=data)
+        segment.sent = time.time()
+
+    def on_ack(self, r_header, now):
+        answered = self.segments.get(self.offset_of(r_header.seq))
+        if answered is not None and not answered.resent and not answered.acked:
+            rtt.sample(now - answered.sent)
+        acked = self.offset_of(r_header.ack_seq)
+        if acked is not None:
+            for offset in [o for o in self.segments if o < acked]:
+                self.reader.release(self.segments.pop(offset).data)
+            self.snd_una = max(self.snd_una, acked)
+        if self.mode == 'sr' and r_header.seq != r_header.ack_seq:  # the receiver also names the segment it got
+            offset = self.offset_of(r_header.seq)
+            if offset in self.segments:
+                self.segments[offset].acked = True
+                self.segments[offset].retries = 0
+
+    # offsets of the segments whose retransmission timers are running
+    def timed(self):
+        if self.mode == 'sr':
+            # once everything is selectively ACKed the oldest segment keeps the timer
+            # in case the cumulative ACK got lost
+            return [o for o, seg in self.segments.items() if not seg.acked] or [self.snd_una]
+        return [self.snd_una]
+
+    # when the retransmission timer of a segment runs out
+    def deadline(self, offset):
+        return self.segments[offset].sent + rtt.rto
+
+    def on_timeout(self, now):
+        expired = [o for o in self.timed() if now >= self.deadline(o)]
+        if not expired:
+            return
+        count_timeout()
+        rtt.backoff()
+        # only a segment whose own timer ran out counts a retry, the rest of a go-back-n window
+        # is resent along with it and keeps its count
+        for offset in expired:
+            segment = self.segments[offset]
+            segment.retries += 1
+            if segment.retries > MAX_RETRIES:
+                raise TimeoutError
+        if self.mode == 'gbn':  # go back to the oldest segment and resend the whole window
+            expired = sorted(self.segments)
+        for offset in expired:
+            segment = self.segments[offset]
+            segment.resent = True
+            self.transmit(offset)
+
+    def run(self, f):
+        self.reader = SegmentReader(f, BUFFER_SIZE-SOLANO.size)
+        eof = False
+        while True:
+            # fill the window with new segments
+            while not eof and len(self.segments) < self.window:
+                data = self.reader.read()
+                if not data:
+                    eof = True
+                    break
+                self.segments[self.next_offset] = Segment(data)
+                self.transmit(self.next_offset)
+                self.next_offset += len(data)
+            if not self.segments:
+                return
+            # wait for an ACK until the oldest running timer expires
+            deadline = min(self.deadline(o) for o in self.timed())
+            self.sock.settimeout(max(deadline - time.time(), 0.0001))
+            try:
+                r_header, r_data, r_address = receive(self.sock)
+                self.on_ack(r_header, time.time())
+            except ConnectionRefusedError:  # the receiver's socket is gone
+                raise
+            except OSError:  # socket.timeout
+                self.on_timeout(time.time())
+
+
 tcp_sock, address = connect(host, port)
 print(f"handhsake complete, server address = {address}")
 
 if tcp_sock:
-    seq = SEQ
-    ack_seq = seq + BUFFER_SIZE
+    # the first data byte follows the SYN and the final handshake ACK
+    base = (SEQ + 2) & SEQ_MASK
+    window_sender = WindowSender(tcp_sock, address, base, window=args.window, mode=args.mode)
     with open(args.input, 'rb') as f:
-        while True:
-            data = f.read(BUFFER_SIZE-27)
-            if not data:
-                print("Finished transferring")
-                close(tcp_sock, address)
-                break
-            else:
-                try:
-                    ping_pong_header_p, ping_pong_header = header(tcp_sock.getsockname()[1], address[1],
-                                                                  data, seq, ack_seq=ack_seq, ack=True)
-                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                        r_header, r_data, r_address = send_and_wait_respond(s, ping_pong_header_p + data,
-                                                                            address, tcp_sock)
-                    r_data = r_data.decode()
-                    ack_seq += ping_pong_header[2]
-                except KeyboardInterrupt:
-                    print("Keyboard Interrupt, exiting and closing connections.")
-                    close(tcp_sock, address)
-                    break
-                except TypeError:
-                    break
+        try:
+            window_sender.run(f)
+            print("Finished transferring")
+            close(tcp_sock, address)
+        except KeyboardInterrupt:
+            print("Keyboard Interrupt, exiting and closing connections.")
+            close(tcp_sock, address)
+        except (TimeoutError, ConnectionRefusedError):
+            print("timed out, giving up")
+            close(tcp_sock, address)
 else:
     print("Server rejected the connection.")
@@ -0,0 +1,113 @@
+#! python3
+# bench_mmsg.py
+# usage: python3 bench_mmsg.py [--packets N] [--size BYTES] [--batch N]
+#
+# Loopback packets per second of one sendto/recvfrom per datagram against batched
+# sendmmsg/recvmmsg and against UDP GSO/GRO. A connected pair of sockets sends `batch`
+# datagrams and reads them back, over and over, so every number counts a send and a
+# receive per datagram.
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.gso import UDP_GRO, UDP_SEGMENT, OffloadSocket, supported  # noqa: E402
+from udp_common.mmsg import BatchSocket, available  # noqa: E402
+
+# create argument parser
+parser = argparse.ArgumentParser()
+# add the packets argument, datagrams moved per run
+parser.add_argument('-n', '--packets', type=int, default=200000)
+# add the size argument, bytes per datagram
+parser.add_argument('-s', '--size', type=int, default=1000)
+# add the batch argument, datagrams per sendmmsg/recvmmsg
+parser.add_argument('-b', '--batch', type=int, default=64)
+# parse the arguments
+args = parser.parse_args()
+
+
+def socket_pair():
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for s in (a, b):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        s.bind(('127.0.0.1', 0))
+    a.connect(b.getsockname())
+    b.connect(a.getsockname())
+    return a, b
+
+
+def plain(packets, payload, batch):
+    a, b = socket_pair()
+    start = time.perf_counter()
+    done = 0
+    while done < packets:
+        n = min(batch, packets - done)
+        for _ in range(n):
+            a.send(payload)
+        for _ in range(n):
+            b.recv(len(payload))
+        done += n
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    return packets / elapsed
+
+
+def batched(packets, payload, batch):
+    a, b = socket_pair()
+    out, inbox = BatchSocket(a, batch, len(payload)), BatchSocket(b, batch, len(payload))
+    start = time.perf_counter()
+    done = 0
+    while done < packets:
+        n = min(batch, packets - done)
+        for _ in range(n):
+            out.send(payload)
+        out.flush()
+        for _ in range(n):
+            inbox.recv(1)
+        done += n
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    return packets / elapsed
+
+
+def offload(packets, payload, batch):
+    a, b = socket_pair()
+    if not (supported(a, UDP_SEGMENT) and supported(b, UDP_GRO)):
+        return None
+    out, inbox = OffloadSocket(a, gso=True), OffloadSocket(b, gro=True)
+    start = time.perf_counter()
+    done = 0
+    while done < packets:
+        n = min(batch, packets - done)
+        for _ in range(n):
+            out.send(payload)
+        out.flush()
+        for _ in range(n):
+            inbox.recv(1)
+        done += n
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    return packets / elapsed
+
+
+payload = bytearray(os.urandom(args.size))
+print(f"{args.packets} datagrams of {args.size} bytes, batches of {args.batch}")
+before = plain(args.packets, payload, args.batch)
+print(f"sendto/recvfrom:     {before:12.0f} packets/s")
+if available():
+    after = batched(args.packets, payload, args.batch)
+    print(f"sendmmsg/recvmmsg:   {after:12.0f} packets/s  ({after / before:.2f}x)")
+else:
+    print("sendmmsg/recvmmsg not available on this platform")
+after = offload(args.packets, payload, args.batch)
+if after:
+    print(f"UDP_SEGMENT/UDP_GRO: {after:12.0f} packets/s  ({after / before:.2f}x)")
+else:
+    print("UDP GSO/GRO not available on this platform")
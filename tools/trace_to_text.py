@@ -0,0 +1,40 @@
+#! python3
+# trace_to_text.py
+# usage: python3 trace_to_text.py --trace sender_berryessa_XXXX.trace [--output out.log] [--csv]
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from udp_common.trace import read_trace, trace_header_size, to_text, msg_type  # noqa: E402
+
+# create argument parser
+parser = argparse.ArgumentParser()
+# add the required trace argument
+parser.add_argument('-t', '--trace', type=str, required=True)
+# add the optional output argument, defaults to stdout
+parser.add_argument('-o', '--output', type=str)
+# write csv rows with every recorded field instead of the text log format
+parser.add_argument('-c', '--csv', action='store_true')
+# add the optional time_format argument
+parser.add_argument('-f', '--time_format', type=str, default='%Y%m%d%H%M%S%f')
+# parse the arguments
+args = parser.parse_args()
+
+header_size = trace_header_size(args.trace)
+out = open(args.output, 'w') if args.output else sys.stdout
+try:
+    if args.csv:
+        out.write("sender_port,receiver_port,type,win,bdp,seq,ack_seq,ns\n")
+        for record in read_trace(args.trace):
+            out.write(f"{record.sender_port},{record.receiver_port},{msg_type(record, header_size)},"
+                      f"{record.win},{record.bdp},{record.seq},{record.ack_seq},{record.ns}\n")
+    else:
+        for record in read_trace(args.trace):
+            out.write(to_text(record, header_size, args.time_format) + '\n')
+except BrokenPipeError:
+    pass
+finally:
+    if out is not sys.stdout:
+        out.close()
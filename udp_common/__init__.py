@@ -0,0 +1,2 @@
+# udp_common
+# helpers shared by the UDP Putah, Solano and Berryessa scripts
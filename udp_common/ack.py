@@ -0,0 +1,39 @@
+# udp_common/ack.py
+# delayed, cumulative acknowledgements for the receivers
+
+import time
+
+
+class DelayedAck:
+    # Decides when a receiver acknowledges. In order segments are ACKed every `every` segments,
+    # or `delay` seconds after the first one that was held back, whichever comes first. A segment
+    # that arrives out of order or fills a gap is ACKed right away so the sender learns about it.
+    def __init__(self, every=1, delay=0.0):
+        self.every = max(1, every)
+        self.delay = delay
+        self.count = 0  # in order segments since the last ACK
+        self.deadline = None  # monotonic time the held back ACK is due
+        self.pending = None  # whatever the caller needs to build the held back ACK
+
+    # returns True when the ACK should go out now, otherwise keeps `pending` for later
+    def on_segment(self, in_order, pending=None):
+        self.count += 1
+        if not in_order or self.count >= self.every or self.delay <= 0:
+            self.clear()
+            return True
+        self.pending = pending
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.delay
+        return False
+
+    # seconds until the held back ACK is due, None when nothing is held back
+    def timeout(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    # the ACK was sent, start counting again
+    def clear(self):
+        self.count = 0
+        self.deadline = None
+        self.pending = None
@@ -0,0 +1,48 @@
+# udp_common/codec.py
+# the fixed packet headers of the Putah, Solano and Berryessa scripts
+#
+# Putah and Solano use a 27 byte header, Berryessa adds the sender's bdp for 31 bytes:
+#   sport, rport, win, checksum, seq, ack_seq (4 bytes each), ack, syn, fin (1 byte each)[, bdp]
+
+import struct
+import threading
+from collections import namedtuple
+
+# bdp is 0 for the headers that do not carry it
+Header = namedtuple('Header', 'sport rport win checksum seq ack_seq ack syn fin bdp', defaults=(0,))
+
+
+class HeaderCodec:
+    # One precompiled layout. Packing goes into a buffer that every thread reuses for each of
+    # its packets, unpacking reads straight out of the received packet through a memoryview.
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.fields = len(self.struct.unpack(bytes(self.size)))
+        self._local = threading.local()
+
+    # the packed header, only valid until this thread packs the next one
+    def pack(self, header):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray(self.size)
+        self.struct.pack_into(buffer, 0, *header[:self.fields])
+        return buffer
+
+    # pack in front of a payload the caller already placed after `offset + self.size`
+    def pack_into(self, buffer, header, offset=0):
+        self.struct.pack_into(buffer, offset, *header[:self.fields])
+
+    # the header at the start of a packet, or of any buffer holding one
+    def unpack(self, packet):
+        return Header(*self.struct.unpack_from(packet))
+
+    # split a received packet into its header and a view of the payload, nothing is copied
+    def decode(self, packet):
+        view = memoryview(packet)
+        return Header(*self.struct.unpack_from(view)), view[self.size:]
+
+
+PUTAH = HeaderCodec('!IIIIII???')
+SOLANO = PUTAH
+BERRYESSA = HeaderCodec('!IIIIII???I')
@@ -0,0 +1,44 @@
+# udp_common/compression.py
+# zlib compression of single segments, for payloads like plain text that shrink well
+
+import zlib
+
+# after a segment that did not shrink enough the next ones are not tried, at most this many
+MAX_SKIP = 64
+
+
+class Compressor:
+    # Compresses every segment on its own, so a lost segment never holds up the ones after it
+    # and a retransmission needs nothing but itself. A segment that does not come out below
+    # `ratio` of its size, `overhead` bytes of marking included, is sent as it is, and the next
+    # `skip` segments are not even tried. `skip` doubles while the data keeps not compressing
+    # and starts over once it does, so incompressible files cost little CPU.
+    def __init__(self, level=1, ratio=0.9):
+        self.level = level
+        self.ratio = ratio
+        self.skip = 0  # segments to pass on before the next try
+        self.backoff = 1
+        self.raw = 0  # bytes given to compress()
+        self.sent = 0  # bytes it handed back, compressed or not
+
+    # the compressed segment, None if it should go out as it is
+    def compress(self, data, overhead=0):
+        self.raw += len(data)
+        if self.skip:
+            self.skip -= 1
+            self.sent += len(data)
+            return None
+        compressed = zlib.compress(data, self.level)
+        if len(compressed) + overhead > self.ratio * len(data):
+            self.skip = self.backoff
+            self.backoff = min(2 * self.backoff, MAX_SKIP)
+            self.sent += len(data)
+            return None
+        self.backoff = 1
+        self.sent += len(compressed) + overhead
+        return compressed
+
+
+# the data of a segment the sender compressed, `size` is its size before compression
+def decompress(data, size=0):
+    return zlib.decompress(data, bufsize=max(size, zlib.DEF_BUF_SIZE))
@@ -0,0 +1,356 @@
+# udp_common/congestion.py
+# congestion controllers for the senders, one instance per connection
+#
+# A connection owns one controller and calls its hooks from the transmit path:
+#   on_send        a segment left
+#   on_ack         new data was ACKed or SACKed outside of fast recovery
+#   on_loss        a segment was found lost and resent (SACK hole, NAK, duplicate ACKs)
+#   on_rto         the oldest segment timed out, cuts the window at once
+#   enter_recovery / on_recovery_dupack / on_partial_ack / exit_recovery
+#                  NewReno fast recovery, only for controllers with fast_recovery set
+#   on_round_end   everything sent in the last round was ACKed
+# The connection reads back `cwnd` (segments) and `pacing_rate` (segments per second, None
+# sends as fast as the window allows). Controllers are looked up by name in CONTROLLERS.
+
+import random
+from collections import deque
+
+# a segment is taken as lost after this many duplicate ACKs, or SACKed segments past it
+DUP_THRESH = 3
+
+
+class CongestionControl:
+    # A fixed window of `cwnd` segments that only counts losses, and the base of the others.
+    fast_retransmit = False  # resend the oldest segment after DUP_THRESH duplicate ACKs
+    fast_recovery = False  # and cut the window instead of waiting for a timeout (NewReno)
+
+    def __init__(self, rtt, cwnd=1, ssthresh=16):
+        self.rtt = rtt  # the connection's RttEstimator
+        self.cwnd = cwnd
+        self.ssthresh = ssthresh
+        self.state = "SLOW START"
+        self.pacing_rate = None
+        self.losses = 0  # segments lost on this connection
+        self.round_losses = 0  # self.losses at the end of the last round
+
+    def on_send(self, segment, now):
+        pass
+
+    # `acked` segments were cumulatively ACKed, `delivered` are the segments the receiver got
+    # since the last ACK, `rtt_sample` is None when the ACK was no valid RTT sample
+    def on_ack(self, acked, delivered, now, rtt_sample, inflight):
+        pass
+
+    def on_loss(self):
+        self.losses += 1
+
+    # the ACK clock is gone, slow start from one segment up to half of the `flight` segments
+    # that were outstanding, right away since no round ends while the oldest segment is missing
+    def on_rto(self, flight=None):
+        self.on_loss()
+        self.round_losses = self.losses  # answered here, the round end must not cut again
+        self.ssthresh = max(int((self.cwnd if flight is None else flight) / 2), 2)
+        self.cwnd = 1
+        self.state = "SLOW START"
+
+    # the third duplicate ACK, `flight` segments were outstanding
+    def enter_recovery(self, flight):
+        self.losses += 1
+        self.ssthresh = max(int(flight / 2), 2)
+        self.cwnd = self.ssthresh + DUP_THRESH
+        self.state = "FAST RECOVERY"
+
+    # every further duplicate ACK is a segment that left the network
+    def on_recovery_dupack(self):
+        self.cwnd += 1
+
+    # an ACK inside fast recovery that moved snd_una by `acked` segments
+    def on_partial_ack(self, acked):
+        self.cwnd = max(self.cwnd - acked + 1, 1)
+
+    # the whole window of the loss is ACKed, deflate it
+    def exit_recovery(self):
+        self.cwnd = self.ssthresh
+        self.state = "AIMD"
+
+    # returns True when a segment was lost during the round
+    def on_round_end(self, recovery=False):
+        lost = self.losses > self.round_losses
+        self.round_losses = self.losses
+        return lost
+
+    def __str__(self):
+        return f"{self.state} CWND = {self.cwnd} ssthresh = {self.ssthresh} Packet Loss = {self.losses}"
+
+
+class Tahoe(CongestionControl):
+    # Doubles the window every round up to ssthresh, then grows it by one. Any loss in a round
+    # halves ssthresh and starts over from one segment.
+    def on_round_end(self, recovery=False):
+        if super().on_round_end(recovery):
+            self.ssthresh = int(self.cwnd/2)
+            self.cwnd = 1
+            self.state = "SLOW START"
+        elif self.cwnd < self.ssthresh:
+            self.cwnd = self.cwnd * 2
+            self.state = "FAST RETRANSMIT"
+        elif self.cwnd >= self.ssthresh:
+            self.cwnd += 1
+            self.state = "AIMD"
+
+
+class Reno(CongestionControl):
+    # Tahoe with fast retransmit and NewReno fast recovery, only a timeout resets the window.
+    # The reset itself is the one of CongestionControl.on_rto.
+    fast_retransmit = True
+    fast_recovery = True
+
+    def on_round_end(self, recovery=False):
+        lost = super().on_round_end(recovery)
+        if recovery:  # fast recovery already cut the window and sizes it from the ACKs
+            self.state = "FAST RECOVERY"
+        elif lost:  # a loss fast recovery did not answer, timeouts already reset the window
+            self.ssthresh = max(int(self.cwnd / 2), 2)
+            self.cwnd = 1
+            self.state = "SLOW START"
+        elif self.cwnd < self.ssthresh:
+            self.cwnd = self.cwnd * 2
+            self.state = "FAST RETRANSMIT"
+        elif self.cwnd >= self.ssthresh:
+            self.cwnd += 1
+            self.state = "AIMD"
+
+
+class Cubic(CongestionControl):
+    # CUBIC (RFC 9438). After a loss the window grows along a cubic curve of the time since
+    # the loss: fast while far below the window where the loss happened (w_max), flat around
+    # it and fast again beyond it. It never grows slower than reno would (w_est).
+    fast_retransmit = True
+    fast_recovery = True
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, rtt, cwnd=1, ssthresh=16):
+        super().__init__(rtt, cwnd, ssthresh)
+        self.window = float(cwnd)  # self.cwnd without rounding
+        self.w_max = 0.0  # the window before the last reduction
+        self.k = 0.0  # seconds the curve takes to get back to w_max
+        self.epoch_start = None  # start of the current growth period
+        self.w_est = 0.0  # the window reno would have by now
+        self.timed_out = False  # reset by a timeout and no new data ACKed since
+
+    def on_ack(self, acked, delivered, now, rtt_sample, inflight):
+        if not acked:
+            return
+        self.timed_out = False
+        if self.window < self.ssthresh:
+            self.window += acked
+            self.state = "SLOW START"
+        else:
+            if self.epoch_start is None:
+                self.epoch_start = now
+                if self.window < self.w_max:
+                    self.k = ((self.w_max - self.window) / self.C) ** (1 / 3)
+                else:
+                    self.k = 0.0
+                    self.w_max = self.window
+                self.w_est = self.window
+            # aim for the window one round trip from now, at most 1.5 times the current one
+            t = now - self.epoch_start + (self.rtt.srtt or 0.0)
+            target = self.w_max + self.C * (t - self.k) ** 3
+            target = min(max(target, self.window), 1.5 * self.window)
+            self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.window
+            if self.w_est > target:  # TCP friendly region
+                target = self.w_est
+                self.state = "TCP FRIENDLY"
+            else:
+                self.state = "CUBIC"
+            self.window += (target - self.window) * acked / self.window
+        self.cwnd = max(int(self.window), 1)
+
+    def _reduce(self):
+        self.epoch_start = None
+        if self.window < self.w_max:  # fast convergence, release bandwidth to newer flows
+            self.w_max = self.window * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.window
+        self.window = max(self.window * self.BETA, 2.0)
+        self.ssthresh = int(self.window)
+
+    def enter_recovery(self, flight):
+        self.losses += 1
+        self._reduce()
+        self.cwnd = self.ssthresh + DUP_THRESH
+        self.state = "FAST RECOVERY"
+
+    # fast recovery is over, continue from the reduced window
+    def exit_recovery(self):
+        super().exit_recovery()
+        self.window = float(self.ssthresh)
+
+    # slow start up to the reduced window, _reduce also starts a new growth period
+    # only the first timeout of a segment reduces, the backed-off ones after it find the window
+    # at one segment already and would wipe out w_max and ssthresh
+    def on_rto(self, flight=None):
+        self.on_loss()
+        self.round_losses = self.losses
+        if not self.timed_out:
+            self._reduce()
+        self.timed_out = True
+        self.window = 1.0
+        self.cwnd = 1
+        self.state = "SLOW START"
+
+    def on_round_end(self, recovery=False):
+        lost = super().on_round_end(recovery)
+        if recovery:
+            self.state = "FAST RECOVERY"
+        elif lost:  # a loss fast recovery did not answer, timeouts already reset the window
+            if not self.timed_out:
+                self._reduce()
+            self.window = 1.0
+            self.cwnd = 1
+            self.state = "SLOW START"
+        # otherwise the window already grew with every ACK
+
+
+class Bbr(CongestionControl):
+    # BBR. Models the path as a bottleneck bandwidth (the highest delivery rate of the last
+    # rounds) and a round trip propagation time (the lowest RTT of the last seconds). Segments
+    # are paced at about that bandwidth and about one bandwidth-delay product is kept in flight,
+    # so random loss that is not caused by congestion does not shrink the window.
+    fast_retransmit = True
+    STARTUP_GAIN = 2.89  # 2/ln(2), doubles the delivery rate every round
+    PROBE_BW_GAINS = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+    BW_ROUNDS = 10  # rounds the bandwidth filter remembers
+    RTPROP_TIME = 10.0  # seconds before the min RTT is probed again
+    PROBE_RTT_TIME = 0.2
+    MIN_CWND = 4
+
+    def __init__(self, rtt, cwnd=1, ssthresh=16):
+        super().__init__(rtt, cwnd, ssthresh)
+        self.state = "STARTUP"
+        self.pacing_gain = self.STARTUP_GAIN
+        self.cwnd_gain = self.STARTUP_GAIN
+        self.bw_samples = deque()  # (round, delivery rate in segments per second)
+        self.btl_bw = 0.0
+        self.rt_prop = None
+        self.rt_prop_stamp = None
+        self.delivered = 0  # segments delivered so far
+        self.delivered_time = None  # when self.delivered last changed
+        self.round_count = 0
+        self.next_round_delivered = 0
+        self.full_bw = 0.0
+        self.full_bw_count = 0
+        self.cycle_index = 0
+        self.cycle_stamp = 0.0
+        self.probe_rtt_done = None
+
+    def bdp(self):
+        return self.btl_bw * self.rt_prop
+
+    # the window comes from the model, the next ACK sizes it again
+    def on_rto(self, flight=None):
+        self.on_loss()
+
+    # remember the delivery state when a segment leaves, its ACK turns it into a rate sample
+    def on_send(self, segment, now):
+        if self.delivered_time is None:
+            self.delivered_time = now
+        segment.delivered = self.delivered
+        segment.delivered_time = self.delivered_time
+
+    def on_ack(self, acked, delivered, now, rtt_sample, inflight):
+        if not delivered:
+            return
+        self.delivered += len(delivered)
+        self.delivered_time = now
+        latest = max(delivered, key=lambda segment: segment.delivered)
+        round_start = latest.delivered >= self.next_round_delivered
+        if round_start:
+            self.next_round_delivered = self.delivered
+            self.round_count += 1
+        # bottleneck bandwidth, a max filter over the last BW_ROUNDS rounds
+        interval = now - latest.delivered_time
+        if interval > 0:
+            self.bw_samples.append((self.round_count, (self.delivered - latest.delivered) / interval))
+        while self.bw_samples and self.bw_samples[0][0] <= self.round_count - self.BW_ROUNDS:
+            self.bw_samples.popleft()
+        self.btl_bw = max((rate for r, rate in self.bw_samples), default=0.0)
+        # round trip propagation time, a min filter over the last RTPROP_TIME seconds
+        rt_prop_expired = self.rt_prop_stamp is not None and now - self.rt_prop_stamp > self.RTPROP_TIME
+        if rtt_sample is not None and (self.rt_prop is None or rtt_sample <= self.rt_prop or rt_prop_expired):
+            self.rt_prop = rtt_sample
+            self.rt_prop_stamp = now
+        self.update_mode(now, round_start, inflight, rt_prop_expired)
+        if self.btl_bw and self.rt_prop is not None:
+            self.pacing_rate = self.pacing_gain * self.btl_bw
+            if self.state == "PROBE_RTT":
+                self.cwnd = self.MIN_CWND
+            else:
+                self.cwnd = max(int(self.cwnd_gain * self.bdp()) + 1, self.MIN_CWND)
+        else:  # no model yet, grow like slow start
+            self.cwnd += len(delivered)
+
+    def update_mode(self, now, round_start, inflight, rt_prop_expired):
+        if self.state == "STARTUP" and round_start:
+            # the pipe is full once the bandwidth stops growing by 25% for three rounds
+            if self.btl_bw >= self.full_bw * 1.25:
+                self.full_bw = self.btl_bw
+                self.full_bw_count = 0
+            else:
+                self.full_bw_count += 1
+            if self.full_bw_count >= 3:
+                self.state = "DRAIN"
+                self.pacing_gain = 1 / self.STARTUP_GAIN
+                self.cwnd_gain = self.STARTUP_GAIN
+        if self.state == "DRAIN" and inflight <= self.bdp():
+            self.enter_probe_bw(now)
+        if self.state == "PROBE_BW" and self.rt_prop is not None and now - self.cycle_stamp > self.rt_prop:
+            self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_BW_GAINS)
+            self.cycle_stamp = now
+            self.pacing_gain = self.PROBE_BW_GAINS[self.cycle_index]
+        if self.state != "PROBE_RTT" and rt_prop_expired and self.rt_prop is not None:
+            self.state = "PROBE_RTT"
+            self.pacing_gain = 1
+            self.probe_rtt_done = None
+        if self.state == "PROBE_RTT":
+            if self.probe_rtt_done is None and inflight <= self.MIN_CWND:
+                self.probe_rtt_done = now + max(self.PROBE_RTT_TIME, self.rt_prop)
+            elif self.probe_rtt_done is not None and now >= self.probe_rtt_done:
+                self.rt_prop_stamp = now
+                if self.full_bw_count >= 3:
+                    self.enter_probe_bw(now)
+                else:
+                    self.state = "STARTUP"
+                    self.pacing_gain = self.STARTUP_GAIN
+                    self.cwnd_gain = self.STARTUP_GAIN
+
+    def enter_probe_bw(self, now):
+        self.state = "PROBE_BW"
+        self.cwnd_gain = 2
+        # start anywhere in the cycle but the draining phase
+        self.cycle_index = random.choice([i for i in range(len(self.PROBE_BW_GAINS)) if i != 1])
+        self.cycle_stamp = now
+        self.pacing_gain = self.PROBE_BW_GAINS[self.cycle_index]
+
+    def __str__(self):
+        rt_prop = f"{self.rt_prop:.6f}" if self.rt_prop is not None else "-"
+        return f"BBR {self.state} BtlBw = {self.btl_bw:.1f} seg/s RTprop = {rt_prop} pacing gain = {self.pacing_gain}"
+
+
+CONTROLLERS = {
+    'tahoe': Tahoe,
+    'reno': Reno,
+    'cubic': Cubic,
+    'bbr': Bbr,
+}
+
+
+# a new controller for one connection, no name keeps a fixed window
+def create(name, rtt, cwnd=1, ssthresh=16):
+    if name is None:
+        return CongestionControl(rtt, cwnd, ssthresh)
+    if name not in CONTROLLERS:
+        raise ValueError(f"unknown congestion control {name!r}, one of {', '.join(CONTROLLERS)}")
+    return CONTROLLERS[name](rtt, cwnd, ssthresh)
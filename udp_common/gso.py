@@ -0,0 +1,131 @@
+# udp_common/gso.py
+# UDP segmentation offload on connected sockets, Linux UDP_SEGMENT (GSO) and UDP_GRO
+#
+# With GSO a whole run of equal sized datagrams goes to the kernel as one buffer and one
+# sendmsg, the segment size in a cmsg, and is only cut into datagrams on its way out. With
+# GRO the kernel hands a run of datagrams from the same flow back as one buffer, the
+# segment size again in a cmsg. Both work on loopback. Where the options are missing
+# supported() is False and the scripts keep their plain socket path.
+
+import errno
+import socket
+import struct
+
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+# the kernel's UDP_MAX_SEGMENTS, and the largest UDP payload over IPv4
+MAX_SEGMENTS = 64
+MAX_BYTES = 65507
+# UDP_SEGMENT is a u16, the UDP_GRO cmsg an int
+SEGMENT_SIZE = struct.Struct('=H')
+GRO_SIZE = struct.Struct('=i')
+
+
+# whether this socket accepts `option` (UDP_SEGMENT or UDP_GRO), enabling GRO on the way
+def supported(sock, option):
+    try:
+        sock.setsockopt(SOL_UDP, option, 1 if option == UDP_GRO else 0)
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+class OffloadSocket:
+    # Wraps a connected datagram socket with the interface of mmsg.BatchSocket. With `gso`
+    # send() queues equal sized datagrams, header and payload as separate buffers so nothing
+    # is joined, and flush() hands the run to the kernel at once: when the next datagram has
+    # a different size, when the run is full, or before recv() has to wait. A shorter
+    # datagram may only end a run, so it is queued and flushed right away. Without `gso`
+    # every datagram is sent on its own.
+    #
+    # With `gro` recv() reads one coalesced buffer and hands out its datagrams, cut at the
+    # segment size the kernel reports, as views valid until the next buffer is read.
+    def __init__(self, sock, gso=False, gro=False, slot=2048):
+        self.sock = sock
+        self.gso = gso
+        self.gro = gro
+        self.slot = slot
+        self.peer = sock.getpeername()
+        self.buffers = []  # header, payload, header, payload... of the queued run
+        self.segment = 0  # datagram size of the queued run
+        self.queued = 0
+        self.bytes = 0
+        self.inbox = bytearray(MAX_BYTES if gro else slot)
+        self.inbox_view = memoryview(self.inbox)
+        self.datagrams = []  # (start, end) of the datagrams of the last buffer
+        self.next = 0
+
+    # datagrams read and not handed out yet
+    @property
+    def pending(self):
+        return len(self.datagrams) - self.next
+
+    def send(self, packet, payload=None):
+        if not self.gso:
+            self.sock.sendmsg([packet, payload] if payload is not None else [packet])
+            return
+        size = len(packet) + (len(payload) if payload is not None else 0)
+        if self.queued and (size > self.segment or self.queued == MAX_SEGMENTS
+                            or self.bytes + size > MAX_BYTES):
+            self.flush()
+        if not self.queued:
+            self.segment = size
+        self.buffers.append(bytes(packet))  # the header codec reuses its buffer for the next packet
+        if payload is not None:
+            self.buffers.append(payload)
+        self.queued += 1
+        self.bytes += size
+        if size < self.segment:  # the run may not go on after a short datagram
+            self.flush()
+
+    def flush(self):
+        if not self.queued:
+            return
+        buffers, self.buffers = self.buffers, []
+        try:
+            if self.queued == 1:
+                self.sock.sendmsg(buffers)
+            else:
+                self.sock.sendmsg(buffers, [(SOL_UDP, UDP_SEGMENT, SEGMENT_SIZE.pack(self.segment))])
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EIO, errno.EOPNOTSUPP):
+                raise
+            # the route cannot offload after all (no checksum offload, a fragmenting path),
+            # send this run one datagram at a time and stop batching
+            self.gso = False
+            self.resend(buffers)
+        finally:
+            self.queued = 0
+            self.bytes = 0
+
+    def resend(self, buffers):
+        datagram = []
+        size = 0
+        for buffer in buffers:
+            datagram.append(buffer)
+            size += len(buffer)
+            if size >= self.segment or buffer is buffers[-1]:
+                self.sock.sendmsg(datagram)
+                datagram = []
+                size = 0
+
+    # the next datagram and the peer's address, raises socket.timeout after `timeout` seconds
+    def recv(self, timeout=None):
+        if self.next == len(self.datagrams):
+            self.flush()
+            self.sock.settimeout(timeout)
+            if self.gro:
+                n, ancdata, _, _ = self.sock.recvmsg_into([self.inbox], socket.CMSG_SPACE(GRO_SIZE.size))
+                stride = n
+                for level, kind, data in ancdata:
+                    if level == SOL_UDP and kind == UDP_GRO:
+                        stride = GRO_SIZE.unpack(data[:GRO_SIZE.size])[0]
+            else:
+                n = self.sock.recv_into(self.inbox)
+                stride = n
+            self.datagrams = [(start, min(start + stride, n)) for start in range(0, n, max(stride, 1))]
+            self.next = 0
+        start, end = self.datagrams[self.next]
+        self.next += 1
+        return self.inbox_view[start:end], self.peer
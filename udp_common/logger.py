@@ -0,0 +1,116 @@
+# udp_common/logger.py
+# asynchronous, batched log writer used in place of the per-packet file_logging()
+
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from queue import Queue
+
+# marks the end of the queue for the writer thread
+_STOP = object()
+
+
+class AsyncLogger:
+    # Lines are queued with a monotonic nanosecond timestamp and only formatted
+    # by the background writer thread, which appends them to the file in batches.
+    def __init__(self, path, time_format='%Y%m%d%H%M%S', max_bytes=50 * 1024 * 1024,
+                 backup_count=5, queue_size=65536, batch_size=1024, echo=False):
+        self.path = path
+        self.time_format = time_format
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.echo = echo
+        # offset used to turn monotonic timestamps back into wall clock time
+        self._wall_offset = time.time_ns() - time.monotonic_ns()
+        # the last second that was formatted, reused while it does not change
+        self._cached_second = None
+        self._cached_stamp = ''
+        self._queue = Queue(maxsize=queue_size)
+        self._file = None
+        self._size = 0
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name=f"logger-{os.path.basename(path)}",
+                                        daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # queue a pipe delimited line, the timestamp is appended when it is written
+    def log(self, *fields):
+        self._queue.put((time.monotonic_ns(), fields))
+
+    # queue a line that is written exactly as given
+    def write(self, msg):
+        self._queue.put((None, msg))
+
+    # flush everything that is queued and stop the writer thread
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+
+    def _format_time(self, ts):
+        wall = ts + self._wall_offset
+        second = wall // 1_000_000_000
+        if '%f' not in self.time_format:
+            if second != self._cached_second:
+                self._cached_second = second
+                self._cached_stamp = datetime.fromtimestamp(second, timezone.utc).strftime(self.time_format)
+            return self._cached_stamp
+        stamp = datetime.fromtimestamp(second, timezone.utc).replace(microsecond=(wall % 1_000_000_000) // 1000)
+        return stamp.strftime(self.time_format)
+
+    def _format(self, item):
+        ts, fields = item
+        if ts is None:
+            return fields + '\n'
+        return ' | '.join(map(str, fields)) + ' | ' + self._format_time(ts) + '\n'
+
+    def _open(self):
+        self._file = open(self.path, 'a')
+        self._size = self._file.tell()
+
+    # move path -> path.1 -> path.2 ... keeping at most backup_count old files
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            item = self._queue.get()
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size or self._queue.empty():
+                    break
+                item = self._queue.get_nowait()
+            if not batch:
+                continue
+            if self._file is None:
+                self._open()
+            text = ''.join(self._format(item) for item in batch)
+            if self.max_bytes and self._size and self._size + len(text) > self.max_bytes:
+                self._rotate()
+            self._file.write(text)
+            self._file.flush()
+            self._size += len(text)
+            if self.echo:
+                print(text, end='')
+        if self._file is not None:
+            self._file.close()
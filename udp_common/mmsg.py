@@ -0,0 +1,178 @@
+# udp_common/mmsg.py
+# batched datagram I/O on connected sockets, Linux sendmmsg/recvmmsg through ctypes
+#
+# One syscall moves a whole batch of segments or ACKs instead of one sendto/recvfrom per
+# datagram. Where the calls are missing (not Linux, no libc) available() is False and the
+# scripts keep their plain socket path.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import sys
+
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendmmsg, recvmmsg = libc.sendmmsg, libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load()
+
+
+def available():
+    return _libc is not None
+
+
+def _address(buffer):
+    return ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+
+
+def _error():
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))  # OSError picks the matching subclass, e.g. ConnectionRefusedError
+
+
+class BatchSocket:
+    # Wraps a connected datagram socket. send() queues a datagram and the queue goes out with
+    # one sendmmsg once it is full, or before recv() has to wait. recv() reads up to `size`
+    # datagrams of at most `slot` bytes with one recvmmsg and hands them out one at a time.
+    #
+    # A queued packet is copied into a preallocated slot, its payload is sent from where it
+    # lies when that memory is writable (a readinto slot, a copy-on-write file mapping) and
+    # copied behind the packet otherwise. A packet that does not fit in a slot goes out with a
+    # plain sendmsg after the queue. A received datagram is a view of the receive buffer,
+    # valid until the batch is used up and the next one is read.
+    def __init__(self, sock, size=64, slot=2048):
+        self.sock = sock
+        self.size = max(1, size)
+        self.slot = slot
+        self.peer = sock.getpeername()
+        # send side, two iovecs per message: the packet slot and the payload
+        self.out = bytearray(self.size * slot)
+        self.out_base = _address(self.out)
+        self.out_iov = (iovec * (2 * self.size))()
+        self.out_msgs = (mmsghdr * self.size)()
+        for i in range(self.size):
+            self.out_iov[2 * i].iov_base = self.out_base + i * slot
+            self.out_msgs[i].msg_hdr.msg_iov = ctypes.cast(ctypes.byref(self.out_iov, 2 * i * ctypes.sizeof(iovec)),
+                                                           ctypes.POINTER(iovec))
+        self.queued = 0
+        self.exported = []  # payloads handed to the kernel by address, kept alive until sent
+        # receive side, one slot per message
+        self.inbox = bytearray(self.size * slot)
+        self.inbox_view = memoryview(self.inbox)
+        self.in_iov = (iovec * self.size)()
+        self.in_msgs = (mmsghdr * self.size)()
+        in_base = _address(self.inbox)
+        for i in range(self.size):
+            self.in_iov[i].iov_base = in_base + i * slot
+            self.in_iov[i].iov_len = slot
+            self.in_msgs[i].msg_hdr.msg_iov = ctypes.cast(ctypes.byref(self.in_iov, i * ctypes.sizeof(iovec)),
+                                                          ctypes.POINTER(iovec))
+            self.in_msgs[i].msg_hdr.msg_iovlen = 1
+        self.received = 0
+        self.next = 0
+
+    # datagrams read and not handed out yet
+    @property
+    def pending(self):
+        return self.received - self.next
+
+    def send(self, packet, payload=None):
+        view = memoryview(payload) if payload is not None and len(payload) else None
+        length = len(packet)
+        if length + (len(view) if view is not None and view.readonly else 0) > self.slot:
+            # does not fit in a slot, send it on its own behind the queued ones
+            self.flush()
+            self.sock.sendmsg([packet] if view is None else [packet, view])
+            return
+        if self.queued == self.size:
+            self.flush()
+        i = self.queued
+        start = i * self.slot
+        self.out[start:start + length] = packet
+        iovlen = 1
+        if view is not None:
+            if view.readonly:
+                self.out[start + length:start + length + len(view)] = view
+                length += len(view)
+            else:
+                self.exported.append(view)
+                iov = self.out_iov[2 * i + 1]
+                iov.iov_base = _address(view)
+                iov.iov_len = len(view)
+                iovlen = 2
+        self.out_iov[2 * i].iov_len = length
+        self.out_msgs[i].msg_hdr.msg_iovlen = iovlen
+        self.queued += 1
+
+    def flush(self):
+        fd = self.sock.fileno()
+        sent = 0
+        while sent < self.queued:
+            n = _libc.sendmmsg(fd, ctypes.addressof(self.out_msgs) + sent * ctypes.sizeof(mmsghdr),
+                               self.queued - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):  # send buffer full, wait for room
+                    select.select([], [fd], [])
+                    continue
+                if err == errno.EINTR:
+                    continue
+                self.queued = 0
+                self.exported.clear()
+                raise _error()
+            sent += n
+        self.queued = 0
+        self.exported.clear()
+
+    # the next datagram and the peer's address, raises socket.timeout after `timeout` seconds
+    def recv(self, timeout=None):
+        if self.next == self.received:
+            self.flush()
+            fd = self.sock.fileno()
+            while True:
+                readable, _, _ = select.select([fd], [], [], timeout)
+                if not readable:
+                    raise socket.timeout('timed out')
+                n = _libc.recvmmsg(fd, ctypes.addressof(self.in_msgs), self.size, MSG_DONTWAIT, None)
+                if n >= 0:
+                    break
+                if ctypes.get_errno() not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise _error()
+            self.received = n
+            self.next = 0
+        i = self.next
+        self.next += 1
+        start = i * self.slot
+        return self.inbox_view[start:start + self.in_msgs[i].msg_len], self.peer
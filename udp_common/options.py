@@ -0,0 +1,75 @@
+# udp_common/options.py
+# header extensions carried in a trailer after the segment data
+#
+# The fixed header stays as it is, `win` still covers the header and the data,
+# and anything past `win` bytes is a list of (kind, length, value) options.
+# A peer that does not know an option simply never echoes it in the handshake,
+# so both sides fall back to the plain protocol.
+
+import struct
+
+# kinds
+END = 0  # ends the list, whatever follows is padding, so a run of zero bytes pads a segment
+SACK_PERMITTED = 1  # SYN and ACK/SYN, value: the most SACK blocks the side handles
+SACK = 2  # ACK, value: (start, end) sequence number pairs of data held past a gap
+FILE_SIZE = 3  # SYN, value: the size of the file that follows, so the receiver can preallocate it
+MSS = 4  # SYN and ACK/SYN, value: the largest datagram the side sends and receives, header included
+COMPRESS_PERMITTED = 5  # SYN and ACK/SYN, value: the compression method, ZLIB
+COMPRESSED = 6  # data, value: the size of the data before compression, the data is compressed
+STRIPE = 7  # SYN and ACK/SYN, value: transfer id, file offset and file size of one stream of a striped transfer
+TOKEN = 8  # SYN and ACK/SYN, value: a resumption token, empty in a SYN that only asks for one
+EARLY_DATA = 9  # ACK/SYN, no value: the data the SYN carried was accepted (0-RTT)
+
+# compression methods
+ZLIB = 1
+
+OPTION = struct.Struct('!BB')
+SACK_BLOCK = struct.Struct('!II')
+SIZE = struct.Struct('!Q')
+DATAGRAM_SIZE = struct.Struct('!H')
+STRIPE_VALUE = struct.Struct('!QQQ')
+
+# an option value is at most 255 bytes, so at most 31 SACK blocks fit
+MAX_SACK_BLOCKS = 255 // SACK_BLOCK.size
+
+
+# pack a list of (kind, value) pairs into a trailer
+def pack_options(options):
+    trailer = bytearray()
+    for kind, value in options:
+        trailer += OPTION.pack(kind, len(value))
+        trailer += value
+    return bytes(trailer)
+
+
+# parse a trailer into a dict of kind -> value, END or a truncated option ends the list
+def parse_options(trailer):
+    options = {}
+    offset = 0
+    while offset + OPTION.size <= len(trailer) and trailer[offset] != END:
+        kind, length = OPTION.unpack_from(trailer, offset)
+        offset += OPTION.size
+        if offset + length > len(trailer):
+            break
+        options[kind] = bytes(trailer[offset:offset + length])
+        offset += length
+    return options
+
+
+# split what follows the fixed header into the segment data and its options
+def split(payload, data_length):
+    return payload[:data_length], parse_options(payload[data_length:])
+
+
+# a trailer of exactly `length` bytes that carries nothing, it makes a segment bigger
+def padding(length):
+    return bytes(length)
+
+
+def pack_sack(blocks):
+    return b''.join(SACK_BLOCK.pack(start, end) for start, end in blocks[:MAX_SACK_BLOCKS])
+
+
+def parse_sack(value):
+    return [SACK_BLOCK.unpack_from(value, offset)
+            for offset in range(0, len(value) - SACK_BLOCK.size + 1, SACK_BLOCK.size)]
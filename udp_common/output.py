@@ -0,0 +1,89 @@
+# udp_common/output.py
+# the receivers' output files, written in place as segments arrive
+
+import argparse
+import os
+
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+
+
+# the argparse type of --fsync, so a bad value fails at startup instead of at the first segment
+def fsync_policy(value):
+    if value in ('never', 'close'):
+        return value
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"{value!r} is not never, close or a positive number of bytes")
+    return size
+
+
+class OutputFile:
+    # One received file, opened once for the whole connection. Every new segment is written at
+    # its own offset from the first data byte `base` (seq - ISN) as soon as it arrives, in order
+    # or not, so nothing waits in memory for a gap to close and every byte is written once.
+    # `size`, when the sender advertised it, preallocates the file. `fsync` is 'never',
+    # 'close' or a number of bytes written between two fsyncs, as fsync_policy() returns it.
+    # A `shared` file is written by several connections, one stripe each, with `base` landing
+    # at file offset `start`. It is sized to `size` instead of truncated, both when it is
+    # opened and when it is closed, so no stripe cuts off another.
+    def __init__(self, path, base, size=None, fsync='close', start=0, shared=False):
+        self.path = path
+        self.base = base & SEQ_MASK
+        self.fsync = fsync
+        self.start = start
+        self.shared = shared
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self.fd = os.open(path, flags if shared else flags | os.O_TRUNC, 0o644)
+        self.end = 0  # one past the highest byte written, from `start`
+        self.unsynced = 0  # bytes written since the last fsync
+        self.preallocated = False
+        if shared and size:  # drop whatever an older, longer file left past the end
+            os.ftruncate(self.fd, size)
+        if size:
+            self.preallocate(size)
+
+    def preallocate(self, size):
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):  # not on this platform or file system
+            os.ftruncate(self.fd, size)
+        self.preallocated = True
+
+    # file offset of a sequence number, sequence numbers wrap every 4 GiB so the offset is
+    # taken relative to the data written so far
+    def offset_of(self, seq):
+        distance = (seq - self.base - self.end) & SEQ_MASK
+        if distance >= 1 << 31:  # behind the highest byte written
+            distance -= 1 << 32
+        return self.end + distance
+
+    def write(self, seq, data):
+        offset = self.start + self.offset_of(seq)
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+        self.end = max(self.end, offset - self.start)
+        self.unsynced += len(data)
+        if self.fsync not in ('never', 'close') and self.unsynced >= self.fsync:
+            os.fsync(self.fd)
+            self.unsynced = 0
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.preallocated and not self.shared:  # the transfer may have ended short of the advertised size
+            os.ftruncate(self.fd, self.end)
+        if self.fsync != 'never' and self.unsynced:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
@@ -0,0 +1,50 @@
+# udp_common/reassembly.py
+# bounded out of order reassembly of received segments, by their sequence numbers and lengths
+
+# sequence numbers wrap around at 32 bits
+SEQ_MASK = 0xFFFFFFFF
+
+
+class ReassemblyBuffer:
+    # Tracks the segments that arrived ahead of a gap, keyed by sequence number, and moves the
+    # next expected byte past them as soon as the gap closes. The caller writes every segment in
+    # place itself, only their lengths are held, for the next expected byte and the SACK blocks.
+    # Segments starting `window` bytes or more past the next expected byte are dropped, so memory
+    # is bounded by the window, not the file size.
+    def __init__(self, expected, window):
+        self.expected = expected & SEQ_MASK  # the next in order sequence number
+        self.window = window
+        self.segments = {}  # seq -> length
+        self.buffered = 0  # bytes held in self.segments
+
+    # track a segment, returns (new, ready): whether the segment is new data inside the window,
+    # and how many segments are in order now, 0 if it had to wait for a gap or was dropped
+    def track(self, seq, length):
+        distance = (seq - self.expected) & SEQ_MASK
+        if distance == 0:
+            ready = 1
+            self.expected = (self.expected + length) & SEQ_MASK
+            while self.segments and self.expected in self.segments:
+                held = self.segments.pop(self.expected)
+                self.buffered -= held
+                ready += 1
+                self.expected = (self.expected + held) & SEQ_MASK
+            return True, ready
+        if distance < self.window and seq not in self.segments:
+            self.segments[seq] = length
+            self.buffered += length
+            return True, 0
+        return False, 0
+
+    # the held data as at most `limit` (start, end) sequence ranges, closest to the gap first
+    def sack_blocks(self, limit):
+        blocks = []
+        for seq in sorted(self.segments, key=lambda s: (s - self.expected) & SEQ_MASK):
+            end = (seq + self.segments[seq]) & SEQ_MASK
+            if blocks and blocks[-1][1] == seq:
+                blocks[-1][1] = end
+            elif len(blocks) < limit:
+                blocks.append([seq, end])
+            else:
+                break
+        return [(start, end) for start, end in blocks]
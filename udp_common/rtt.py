@@ -0,0 +1,45 @@
+# udp_common/rtt.py
+# round trip time estimation and retransmission timeouts (RFC 6298)
+
+
+class RttEstimator:
+    # Smoothed RTT and RTT variance from ACK timing. Only segments that were sent once may be
+    # sampled (Karn's rule), an ACK for a retransmitted segment could answer any of its copies.
+    # The timeout is clamped to [min_rto, max_rto]. Every retransmission timeout doubles it and
+    # it stays backed off until the next valid sample, new segments wait as long as the resent one.
+    def __init__(self, initial=1.0, min_rto=0.2, max_rto=60.0, alpha=0.125, beta=0.25, k=4, granularity=0.0001):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.granularity = granularity  # clock granularity G
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self._clamp(initial)
+        self.samples = 0
+
+    def _clamp(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    # feed one measured round trip time in seconds
+    def sample(self, rtt):
+        if rtt < 0:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = self._clamp(self.srtt + max(self.granularity, self.k * self.rttvar))
+        self.samples += 1
+
+    # a retransmission timer ran out, back off until a new sample arrives (RFC 6298 5.5-5.7)
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_rto)
+
+    def __str__(self):
+        if self.srtt is None:
+            return f"SRTT = - RTTVAR = - RTO = {self.rto:.6f}"
+        return f"SRTT = {self.srtt:.6f} RTTVAR = {self.rttvar:.6f} RTO = {self.rto:.6f}"
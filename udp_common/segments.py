@@ -0,0 +1,65 @@
+# udp_common/segments.py
+# the senders' data path: file segments without copies and scatter/gather sends
+
+import io
+import mmap
+
+
+class SegmentReader:
+    # Hands out the input file as memoryviews of at most `size` bytes. A regular file is mapped,
+    # so every segment is a view of the page cache and a retransmission sends the same view
+    # again. Anything that cannot be mapped (an empty file, a pipe) is read with readinto into
+    # preallocated slots, and release() gives a slot back once its segment was ACKed.
+    # `length` limits the reader to that many bytes from the file's current position.
+    def __init__(self, f, size, length=None):
+        self.f = f
+        self.size = size
+        self.map = None
+        self.offset = 0
+        self.end = None  # where the reader stops, None for the end of the file
+        self.free = []  # slots ready to be read into
+        try:
+            self.offset = f.tell()
+            # copy on write is never written, but lets batched sends hand the pages to the kernel
+            self.map = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+        except (ValueError, OSError, io.UnsupportedOperation):
+            pass
+        if length is not None:
+            self.end = self.offset + length
+
+    # the next segment, empty at the end of the file
+    def read(self):
+        size = self.size if self.end is None else max(0, min(self.size, self.end - self.offset))
+        if self.map is not None:
+            view = self.map[self.offset:self.offset + size]
+            self.offset += len(view)
+            return view
+        slot = self.free.pop() if self.free else bytearray(self.size)
+        n = (self.f.readinto(memoryview(slot)[:size]) or 0) if size else 0
+        self.offset += n
+        if not n:
+            self.free.append(slot)
+        return memoryview(slot)[:n]
+
+    # segments from now on hold up to `size` bytes, slots of the old size are dropped as they come back
+    def resize(self, size):
+        self.size = size
+        self.free.clear()
+
+    # the segment was ACKed, its slot may be read into again
+    def release(self, view):
+        if self.map is None and len(view.obj) == self.size:
+            self.free.append(view.obj)
+
+
+# send a header and its payload as one datagram without joining them first
+def send_segment(sock, header, payload, address=None):
+    if hasattr(sock, 'sendmsg'):
+        if address:
+            sock.sendmsg([header, payload], [], 0, address)
+        else:
+            sock.sendmsg([header, payload])
+    elif address:  # no scatter/gather on this platform
+        sock.sendto(bytes(header) + payload, address)
+    else:
+        sock.send(bytes(header) + payload)
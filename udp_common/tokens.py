@@ -0,0 +1,94 @@
+# udp_common/tokens.py
+# resumption tokens, a sender that has one puts its first segment in the SYN (0-RTT)
+
+import hashlib
+import hmac
+import json
+import os
+import socket
+import struct
+import time
+
+# how long a token is good for, in seconds
+TOKEN_LIFETIME = 600
+# redeemed tokens remembered at most, 0-RTT is refused while all of them are still live
+MAX_REDEEMED = 65536
+
+# when the token was issued and a nonce, followed by the MAC
+TOKEN_FIELDS = struct.Struct('!Q8s')
+MAC_SIZE = 16
+TOKEN_SIZE = TOKEN_FIELDS.size + MAC_SIZE
+
+
+class TokenIssuer:
+    # The receiver's side. A token holds the time it was issued, a nonce, and a MAC over both
+    # and the client's IP address under a secret of this process, so it is only good from the
+    # address it went to, for `lifetime` seconds, and the receiver keeps nothing until it comes
+    # back. Every token is good for one connection: redeemed ones are remembered until they
+    # expire, and a SYN that repeats one, a replay, gets the full handshake instead. A new token
+    # goes out with every ACK/SYN for the next connection.
+    def __init__(self, lifetime=TOKEN_LIFETIME, capacity=MAX_REDEEMED):
+        self.secret = os.urandom(32)
+        self.lifetime = lifetime
+        self.capacity = capacity
+        self.redeemed = {}  # MAC -> time the token expires
+
+    def mac(self, fields, ip):
+        return hmac.new(self.secret, fields + socket.inet_aton(ip), hashlib.sha256).digest()[:MAC_SIZE]
+
+    def issue(self, ip):
+        fields = TOKEN_FIELDS.pack(int(time.time()), os.urandom(8))
+        return fields + self.mac(fields, ip)
+
+    # whether `token` lets the client at `ip` send data with its SYN, it cannot be used again
+    def redeem(self, token, ip):
+        if len(token) != TOKEN_SIZE:
+            return False
+        fields, mac = token[:TOKEN_FIELDS.size], token[TOKEN_FIELDS.size:]
+        if not hmac.compare_digest(mac, self.mac(fields, ip)):
+            return False
+        issued, nonce = TOKEN_FIELDS.unpack(fields)
+        now = time.time()
+        if not issued <= now < issued + self.lifetime or mac in self.redeemed:
+            return False
+        if len(self.redeemed) >= self.capacity:
+            self.redeemed = {key: expires for key, expires in self.redeemed.items() if expires > now}
+            if len(self.redeemed) >= self.capacity:
+                return False
+        self.redeemed[mac] = issued + self.lifetime
+        return True
+
+
+class TokenCache:
+    # The sender's side, the last token of every receiver and the datagram size agreed on with
+    # it, in a JSON file kept between runs. take() removes the token, it is good for one try.
+    # The file is read again before every change so senders running side by side keep theirs.
+    def __init__(self, path):
+        self.path = path
+
+    # the token and datagram size for `server`, (None, None) without one
+    def take(self, server):
+        entries = self.load()
+        entry = entries.pop(server, None)
+        if entry is None:
+            return None, None
+        self.save(entries)
+        return bytes.fromhex(entry['token']), entry['mss']
+
+    def put(self, server, token, mss):
+        entries = self.load()
+        entries[server] = {'token': token.hex(), 'mss': mss}
+        self.save(entries)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, entries):
+        temporary = f"{self.path}.{os.getpid()}"
+        with open(temporary, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temporary, self.path)
@@ -0,0 +1,129 @@
+# udp_common/trace.py
+# compact binary packet trace, written into a memory mapped file
+
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+# file header: magic, version, record size, protocol header size, wall clock offset (ns), record count
+TRACE_MAGIC = b'UDPTRACE'
+TRACE_VERSION = 1
+FILE_HEADER = struct.Struct('<8sHHHxxqQ')
+# record: sender port, receiver port, win, bdp, seq, ack seq, monotonic time (ns), flags
+RECORD = struct.Struct('<IIIIIIQB3x')
+
+FLAG_ACK = 1
+FLAG_SYN = 2
+FLAG_FIN = 4
+
+TraceRecord = namedtuple('TraceRecord', 'sender_port receiver_port win bdp seq ack_seq ns ack syn fin')
+
+
+class TraceWriter:
+    # Fixed size records are packed straight into a preallocated, memory mapped
+    # file that grows by `chunk` records whenever it fills up.
+    def __init__(self, path, header_size, chunk=65536):
+        self.path = path
+        self.header_size = header_size
+        self.chunk_bytes = chunk * RECORD.size
+        self.wall_offset = time.time_ns() - time.monotonic_ns()
+        self.count = 0
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._length = FILE_HEADER.size + self.chunk_bytes
+        os.ftruncate(self._fd, self._length)
+        self._mm = mmap.mmap(self._fd, self._length)
+        self._offset = FILE_HEADER.size
+        self._write_file_header()
+
+    def _write_file_header(self):
+        FILE_HEADER.pack_into(self._mm, 0, TRACE_MAGIC, TRACE_VERSION, RECORD.size, self.header_size,
+                              self.wall_offset, self.count)
+
+    def _grow(self):
+        self._mm.close()
+        self._length += self.chunk_bytes
+        os.ftruncate(self._fd, self._length)
+        self._mm = mmap.mmap(self._fd, self._length)
+
+    # record one packet header
+    def record(self, sender_port, receiver_port, win, bdp, seq, ack_seq, ack, syn, fin):
+        flags = (FLAG_ACK if ack else 0) | (FLAG_SYN if syn else 0) | (FLAG_FIN if fin else 0)
+        ns = time.monotonic_ns()
+        with self._lock:
+            if self._offset + RECORD.size > self._length:
+                self._grow()
+            RECORD.pack_into(self._mm, self._offset, sender_port, receiver_port, win, bdp, seq, ack_seq,
+                             ns, flags)
+            self._offset += RECORD.size
+            self.count += 1
+
+    # store the record count and cut the unused preallocated space off the file
+    def close(self):
+        with self._lock:
+            if self._mm is None:
+                return
+            self._write_file_header()
+            self._mm.close()
+            self._mm = None
+            os.ftruncate(self._fd, self._offset)
+            os.close(self._fd)
+
+
+def _records(buf, start, count, header_size, wall_offset):
+    for offset in range(start, start + count * RECORD.size, RECORD.size):
+        sport, rport, win, bdp, seq, ack_seq, ns, flags = RECORD.unpack_from(buf, offset)
+        if ns == 0:  # preallocated space that was never written, the trace was not closed
+            return
+        yield TraceRecord(sport, rport, win, bdp, seq, ack_seq, ns + wall_offset,
+                          bool(flags & FLAG_ACK), bool(flags & FLAG_SYN), bool(flags & FLAG_FIN))
+
+
+# iterate over the records of a trace file, `ns` is converted to wall clock time
+def read_trace(path):
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, record_size, header_size, wall_offset, count = FILE_HEADER.unpack_from(buf, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} packet trace")
+        # a trace that was never closed still has a zero count, read until the first empty record
+        if count == 0:
+            count = (len(buf) - FILE_HEADER.size) // RECORD.size
+        yield from _records(buf, FILE_HEADER.size, count, header_size, wall_offset)
+    finally:
+        buf.close()
+
+
+# the header size of the protocol that produced the trace
+def trace_header_size(path):
+    with open(path, 'rb') as f:
+        return FILE_HEADER.unpack(f.read(FILE_HEADER.size))[3]
+
+
+def msg_type(record, header_size):
+    if record.win > header_size:
+        return "DATA"
+    elif record.ack and record.syn:
+        return "ACK/SYN"
+    elif record.ack:
+        return "ACK"
+    elif record.syn:
+        return "SYN"
+    elif record.fin:
+        return "FIN"
+
+
+def format_time(ns, time_format='%Y%m%d%H%M%S%f'):
+    stamp = datetime.fromtimestamp(ns // 1_000_000_000, timezone.utc)
+    return stamp.replace(microsecond=(ns % 1_000_000_000) // 1000).strftime(time_format)
+
+
+# the same `sender | receiver | type | win | bdp | time` line the text logs use
+def to_text(record, header_size, time_format='%Y%m%d%H%M%S%f'):
+    return (f"{record.sender_port} | {record.receiver_port} | {msg_type(record, header_size)} | "
+            f"{record.win} | {record.bdp} | {format_time(record.ns, time_format)}")
@@ -0,0 +1,58 @@
+# udp_common/workers.py
+# receivers that serve one welcome port from several processes, SO_REUSEPORT (Linux, BSD)
+#
+# Every worker binds its own welcome socket to the same port and the kernel picks one of them
+# for each client by hashing its address, so a client's SYN, its handshake ACK and the
+# connection after it all end up with the same worker. A worker owns its connections end to
+# end, sockets, threads and logs, and has its own interpreter lock.
+
+import multiprocessing
+import signal
+import socket
+
+
+# whether this platform can share a port between forked workers
+def available():
+    return hasattr(socket, 'SO_REUSEPORT') and 'fork' in multiprocessing.get_all_start_methods()
+
+
+# a welcome socket bound to (host, port), shared with the other workers when `reuse_port` is set
+def welcome_socket(host, port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+# run serve(index) in `count` forked workers until all of them are done. Ctrl-C reaches the
+# workers directly, a SIGTERM to this process is passed on, and a worker sees either one as
+# KeyboardInterrupt so it shuts down the way a single process receiver does.
+def run_workers(count, serve):
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_worker, args=(serve, index), name=f"worker{index}")
+               for index in range(count)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    previous = signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in workers:
+            while True:
+                try:
+                    worker.join()
+                    break
+                except KeyboardInterrupt:  # the workers got it too, wait for them to close
+                    pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def _worker(serve, index):
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    serve(index)